@@ -0,0 +1,441 @@
+import heapq
+import math
+import os
+import random
+import socket
+import time
+from array import array
+from struct import Struct
+import config
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# inner IPv4 total length, source and destination addresses
+INNER_IPV4_FIELDS = Struct('!2xH8xII')
+# inner TCP / UDP destination port
+L4_DST_PORT = Struct('!2xH')
+# Geneve VNI (followed by a reserved byte)
+GENEVE_VNI = Struct('!4xI')
+# batched fields of a packet : inner source address, destination address, protocol and destination port, inner IPv4
+# packet length, AWS flow cookie, VNI and GWLB endpoint ID
+BATCH_RECORD = Struct('=7Q')
+PROTOCOLS = {1: "icmp", 6: "tcp", 17: "udp"}
+MASK_64 = (1 << 64) - 1
+
+
+def mix64(value):
+    """
+    64-bits hash of an integer (splitmix64 finalizer), so that the sketches get evenly distributed bits from keys
+    such as IPv4 addresses
+    :param value: (int) Integer up to 64 bits
+    :return: (int)
+    """
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+def mix64_array(values):
+    """
+    mix64 of a numpy uint64 array (the multiplications wrap around 2^64)
+    :return: (numpy.ndarray)
+    """
+    values = (values ^ (values >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return values ^ (values >> numpy.uint64(31))
+
+
+class CountMinSketch:
+    """
+    Count-min sketch of the bytes sent by each key, in depth rows of width counters
+
+    A key is counted in one counter of each row (multiply-shift hashing of its mix64 hash, with one odd multiplier
+    per row), and its estimate is the minimum of its counters : it is never lower than the actual count, and higher by
+    at most e * total / width with a probability of 1 - e^-depth. The counters are only raised as much as needed for
+    the estimates to stay upper bounds (conservative update), which lowers the error of the small keys.
+    The memory used is fixed : width * depth 64-bits counters.
+    """
+
+    def __init__(self, width=config.ANALYTICS_SKETCH_WIDTH, depth=config.ANALYTICS_SKETCH_DEPTH, seed=0):
+        """
+        :param width: (int) Counters per row, which has to be a power of 2
+        :param depth: (int) Number of rows
+        """
+        if width < 2 or width & (width - 1):
+            raise ValueError(f"the sketch width ({width}) has to be a power of 2")
+        self.width = width
+        self.depth = depth
+        self.shift = 64 - width.bit_length() + 1
+        rng = random.Random(seed)
+        self.multipliers = [rng.getrandbits(64) | 1 for _ in range(depth)]
+        if numpy:
+            self.counters = numpy.zeros((depth, width), dtype=numpy.uint64)
+        else:
+            self.counters = array('Q', bytes(8 * width * depth))
+
+    @property
+    def memory(self):
+        return self.width * self.depth * 8
+
+    def reset(self):
+        if numpy:
+            self.counters.fill(0)
+        else:
+            self.counters = array('Q', bytes(8 * self.width * self.depth))
+
+    def update(self, keys, values):
+        """
+        Adds the counts of a batch
+        :param keys: (list) Distinct integer keys (numpy uint64 array with numpy)
+        :param values: (list) Count of each key (numpy uint64 array with numpy)
+        :return: (list) Estimates of the keys after the update (numpy uint64 array with numpy)
+        """
+        if numpy:
+            keys = mix64_array(keys)
+            shift = numpy.uint64(self.shift)
+            indexes = [(keys * numpy.uint64(multiplier)) >> shift for multiplier in self.multipliers]
+            estimates = self.counters[0][indexes[0]]
+            for row in range(1, self.depth):
+                estimates = numpy.minimum(estimates, self.counters[row][indexes[row]])
+            estimates += values
+            for row in range(self.depth):
+                numpy.maximum.at(self.counters[row], indexes[row], estimates)
+            return estimates
+
+        counters = self.counters
+        estimates = list()
+        for key, value in zip(keys, values):
+            key = mix64(key)
+            slots = [row * self.width + (((key * multiplier) & MASK_64) >> self.shift)
+                     for row, multiplier in enumerate(self.multipliers)]
+            estimate = min(counters[slot] for slot in slots) + value
+            for slot in slots:
+                if counters[slot] < estimate:
+                    counters[slot] = estimate
+            estimates.append(estimate)
+        return estimates
+
+
+class TopK:
+    """
+    Keys with the k highest estimates, kept in a min-heap
+
+    The estimates of a count-min sketch only increase : the heap entries of a key which is updated are left in the
+    heap (and skipped once they come out of it), and the heap is rebuilt when it holds too many of them.
+    """
+
+    def __init__(self, k=config.ANALYTICS_TOP_K):
+        self.k = k
+        self.estimates = dict()
+        self.heap = list()
+
+    def reset(self):
+        self.estimates.clear()
+        self.heap.clear()
+
+    def offer(self, key, estimate):
+        """
+        :param key: (int) Key
+        :param estimate: (int) Current estimate of the key
+        :return:
+        """
+        if key in self.estimates:
+            self.estimates[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+            if len(self.heap) > 4 * self.k:
+                self.heap = [(estimate, key) for key, estimate in self.estimates.items()]
+                heapq.heapify(self.heap)
+            return
+        if len(self.estimates) >= self.k:
+            if estimate <= self.threshold:
+                return
+            del self.estimates[heapq.heappop(self.heap)[1]]
+        self.estimates[key] = estimate
+        heapq.heappush(self.heap, (estimate, key))
+
+    @property
+    def threshold(self):
+        """
+        :return: (int) Estimate a key has to exceed to enter the top-k, 0 if it is not full
+        """
+        if len(self.estimates) < self.k:
+            return 0
+        while self.estimates.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+    def items(self):
+        """
+        :return: (list) (key, estimate) tuples, by decreasing estimate
+        """
+        return sorted(self.estimates.items(), key=lambda item: item[1], reverse=True)
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct keys, with 2^precision one-byte registers (a standard error of
+    1.04 / sqrt(2^precision), 1.6% with the default precision of 12)
+
+    The first precision bits of the mix64 hash of a key select a register, which keeps the highest rank (position of
+    the first bit set) seen in the following bits.
+    """
+
+    def __init__(self, precision=config.ANALYTICS_HLL_PRECISION):
+        self.precision = precision
+        self.registers_count = 1 << precision
+        # bits of the hash used for the rank : 52 at most, so that the ranks can be computed from float64 values
+        self.rank_bits = min(64 - precision, 52)
+        self.rank_shift = 64 - precision - self.rank_bits
+        if numpy:
+            self.registers = numpy.zeros(self.registers_count, dtype=numpy.uint8)
+        else:
+            self.registers = bytearray(self.registers_count)
+
+    def add(self, keys):
+        """
+        :param keys: (iterable) Integer keys (numpy uint64 array with numpy)
+        :return:
+        """
+        if numpy:
+            keys = mix64_array(keys)
+            indexes = keys >> numpy.uint64(64 - self.precision)
+            bits = (keys >> numpy.uint64(self.rank_shift)) & numpy.uint64((1 << self.rank_bits) - 1)
+            # frexp returns the bit length of the values as exponent
+            ranks = self.rank_bits + 1 - numpy.frexp(bits.astype(numpy.float64))[1]
+            numpy.maximum.at(self.registers, indexes, ranks.astype(numpy.uint8))
+            return
+        registers = self.registers
+        rank_mask = (1 << self.rank_bits) - 1
+        for key in keys:
+            key = mix64(key)
+            index = key >> (64 - self.precision)
+            rank = self.rank_bits + 1 - ((key >> self.rank_shift) & rank_mask).bit_length()
+            if registers[index] < rank:
+                registers[index] = rank
+
+    def estimate(self):
+        """
+        :return: (int) Estimated number of distinct keys
+        """
+        m = self.registers_count
+        registers = self.registers.tolist() if numpy else self.registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in registers)
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small cardinalities : linear counting
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class Analytics:
+    """
+    Traffic analytics with a fixed memory, whatever the traffic : top talkers (inner sources, destinations and
+    destination ports by bytes) and distinct flows and sources by VNI and GWLB endpoint
+
+    Each top talkers kind is a count-min sketch of the bytes by key, with a top-k heap of the keys with the highest
+    estimates. The distinct counts are HyperLogLog estimates of the AWS flow cookies and of the inner source addresses,
+    for up to config.ANALYTICS_MAX_GROUPS (VNI, GWLB endpoint ID) couples (the others being counted together).
+    The packets only go through add(), which reads a few fields of the raw packet and packs them in the batch buffer :
+    the sketches are updated by batches of config.ANALYTICS_BATCH_SIZE packets, the counts of a batch being
+    aggregated by key first. When numpy is installed, the batch buffer is used as an array without copy, and the
+    updates of a batch are vectorized.
+    The results cover the packets since the last reset, and are reported every config.ANALYTICS_INTERVAL seconds.
+    """
+
+    def __init__(self, batch_size=config.ANALYTICS_BATCH_SIZE, max_groups=config.ANALYTICS_MAX_GROUPS):
+        self.batch_size = batch_size
+        self.max_groups = max_groups
+        self.batch = bytearray(BATCH_RECORD.size * batch_size)
+        self.batch_length = 0
+        self.sketches = {kind: (CountMinSketch(seed=seed), TopK())
+                         for seed, kind in enumerate(("sources", "destinations", "ports"))}
+        # (flows HyperLogLog, sources HyperLogLog) by (VNI, GWLB endpoint ID), the other groups being (None, None)
+        self.groups = dict()
+        self.packets = 0
+        self.bytes = 0
+        self.started_at = time.time()
+        self.next_report = time.monotonic() + config.ANALYTICS_INTERVAL
+
+    @property
+    def vectorized(self):
+        return numpy is not None
+
+    @property
+    def memory(self):
+        """
+        :return: (int) Maximum memory used by the sketches, in bytes
+        """
+        return sum(sketch.memory for sketch, _ in self.sketches.values()) \
+            + (self.max_groups + 1) * 2 * (1 << config.ANALYTICS_HLL_PRECISION)
+
+    def add(self, packet):
+        """
+        :param packet: (rawpacket.RawPacket) Received packet
+        :return:
+        """
+        data = packet.raw_data
+        inner_start = packet.inner_start
+        protocol = packet.inner_protocol
+        port = protocol << 16
+        total_length, src_addr, dst_addr = INNER_IPV4_FIELDS.unpack_from(data, inner_start)
+        if protocol == 6 or protocol == 17:
+            l4_start = inner_start + (data[inner_start] & 0x0F) * 4
+            # the destination port is only read if the packet holds it
+            if len(data) >= l4_start + 4:
+                port |= L4_DST_PORT.unpack_from(data, l4_start)[0]
+        flow_cookie, gwlbe_id, _ = packet.aws_options
+        if flow_cookie is None:
+            # the packets without flow cookie are counted by addresses pair
+            flow_cookie = src_addr << 32 | dst_addr
+        BATCH_RECORD.pack_into(self.batch, self.batch_length * BATCH_RECORD.size, src_addr, dst_addr, port,
+                               total_length, flow_cookie, GENEVE_VNI.unpack_from(data, packet.geneve_start)[0] >> 8,
+                               gwlbe_id or 0)
+        self.batch_length += 1
+        if self.batch_length == self.batch_size:
+            self.flush()
+
+    def group(self, group):
+        """
+        :param group: (tuple) (VNI, GWLB endpoint ID)
+        :return: (tuple) (flows HyperLogLog, sources HyperLogLog) of the group
+        """
+        sketches = self.groups.get(group)
+        if sketches is None:
+            if len(self.groups) >= self.max_groups:
+                group = (None, None)
+                sketches = self.groups.get(group)
+            if sketches is None:
+                sketches = self.groups[group] = (HyperLogLog(), HyperLogLog())
+        return sketches
+
+    def flush(self):
+        """
+        Updates the sketches with the batched packets
+        :return:
+        """
+        batch_length = self.batch_length
+        if not batch_length:
+            return
+        self.batch_length = 0
+        self.packets += batch_length
+        if numpy:
+            self.flush_vectorized(numpy.frombuffer(self.batch, dtype=numpy.uint64, count=batch_length * 7)
+                                  .reshape(batch_length, 7))
+            return
+
+        counts = {kind: dict() for kind in self.sketches}
+        groups = dict()
+        sources, destinations, ports = counts["sources"], counts["destinations"], counts["ports"]
+        for src_addr, dst_addr, port, length, flow_cookie, vni, gwlbe_id in \
+                BATCH_RECORD.iter_unpack(memoryview(self.batch)[:batch_length * BATCH_RECORD.size]):
+            sources[src_addr] = sources.get(src_addr, 0) + length
+            destinations[dst_addr] = destinations.get(dst_addr, 0) + length
+            ports[port] = ports.get(port, 0) + length
+            keys = groups.get((vni, gwlbe_id))
+            if keys is None:
+                keys = groups[(vni, gwlbe_id)] = (set(), set())
+            keys[0].add(flow_cookie)
+            keys[1].add(src_addr)
+        self.bytes += sum(sources.values())
+
+        for kind, (sketch, top) in self.sketches.items():
+            threshold = top.threshold
+            for key, estimate in zip(counts[kind], sketch.update(counts[kind].keys(), counts[kind].values())):
+                if estimate > threshold:
+                    top.offer(key, estimate)
+                    threshold = top.threshold
+        for group, (flow_cookies, src_addrs) in groups.items():
+            flows, sources = self.group(group)
+            flows.add(flow_cookies)
+            sources.add(src_addrs)
+
+    def flush_vectorized(self, fields):
+        """
+        flush() with numpy : the counts are aggregated by key with numpy.unique and numpy.bincount
+        :param fields: (numpy.ndarray) Batched packets fields, one row per packet (BATCH_RECORD values)
+        :return:
+        """
+        lengths = fields[:, 3]
+        self.bytes += int(lengths.sum())
+        for column, (sketch, top) in zip((0, 1, 2), self.sketches.values()):
+            keys, inverse = numpy.unique(fields[:, column], return_inverse=True)
+            values = numpy.bincount(inverse, weights=lengths).astype(numpy.uint64)
+            estimates = sketch.update(keys, values)
+            # only the keys which may enter the top-k are offered
+            candidates = numpy.flatnonzero(estimates > top.threshold)
+            for key, estimate in zip(keys[candidates].tolist(), estimates[candidates].tolist()):
+                top.offer(key, estimate)
+        vnis, gwlbe_ids = fields[:, 5], fields[:, 6]
+        if (vnis == vnis[0]).all() and (gwlbe_ids == gwlbe_ids[0]).all():
+            # usual case : a single VNI and GWLB endpoint in the batch
+            groups = [(0, None)]
+        else:
+            _, first_rows, inverse = numpy.unique(mix64_array(gwlbe_ids) ^ vnis, return_index=True,
+                                                  return_inverse=True)
+            groups = [(row, inverse == index) for index, row in enumerate(first_rows.tolist())]
+        for row, rows in groups:
+            flows, sources = self.group((int(vnis[row]), int(gwlbe_ids[row])))
+            flows.add(fields[:, 4] if rows is None else fields[rows, 4])
+            sources.add(fields[:, 0] if rows is None else fields[rows, 0])
+
+    def reset(self):
+        self.batch_length = 0
+        for sketch, top in self.sketches.values():
+            sketch.reset()
+            top.reset()
+        self.groups.clear()
+        self.packets = 0
+        self.bytes = 0
+        self.started_at = time.time()
+
+    def report(self):
+        """
+        Builds the report of the packets since the last reset
+        :return: (list) Lines of the report
+        """
+        self.flush()
+        lines = [f"# analytics since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at))} : "
+                 f"{self.packets} packets, {self.bytes} bytes (inner IPv4 packets length)"]
+        for kind, title in (("sources", "sources"), ("destinations", "destinations"),
+                            ("ports", "destination ports")):
+            lines.append(f"\n# top {title} by bytes (estimated)")
+            for key, estimate in self.sketches[kind][1].items():
+                if kind == "ports":
+                    name = f"{PROTOCOLS.get(key >> 16, key >> 16)}/{key & 0xFFFF}"
+                else:
+                    name = socket.inet_ntoa(key.to_bytes(4, 'big'))
+                lines.append(f"{name} {estimate}")
+        lines.append("\n# distinct flows and sources by VNI and GWLB endpoint (estimated)")
+        lines.append("vni gwlbe_id flows sources")
+        for (vni, gwlbe_id), (flows, sources) in self.groups.items():
+            group = "other other" if vni is None else f"{vni} {gwlbe_id:#x}"
+            lines.append(f"{group} {flows.estimate()} {sources.estimate()}")
+        return lines
+
+    def report_due(self):
+        """
+        :return: (bool) True once config.ANALYTICS_INTERVAL seconds have elapsed since the last report
+        """
+        if time.monotonic() < self.next_report:
+            return False
+        self.next_report = time.monotonic() + config.ANALYTICS_INTERVAL
+        return True
+
+    def write_report(self, logger, path):
+        """
+        Writes the report to a file (replaced atomically, so that it can be read at any time), and resets the sketches
+        :param path: (str) Report file path
+        :return:
+        """
+        lines = self.report()
+        self.reset()
+        try:
+            with open(f"{path}.tmp", 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.error(f"ANALYTICS - Unable to write the report to {path} : {e}")
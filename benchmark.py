@@ -0,0 +1,310 @@
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import timeit
+import config
+from headers import ipv4, udp, tcp, geneve
+from rawpacket import RawPacket
+from flow_tracker import FlowTracker, flow_sampling_hash
+from policy import Policy, Rule
+from analytics import Analytics
+from packet_builder import gwlb_packet, inner_packet, TCP_SYN, TCP_ACK, TCP_PSH
+
+RESULTS_VERSION = 1
+# offset of the Geneve header in a packet built by gwlb_packet, and of its first option
+GENEVE_OFFSET = 28
+GENEVE_OPTION_OFFSET = GENEVE_OFFSET + 8
+# packets handed to update_flow in each measure of the flow tracker benchmarks
+FLOW_UPDATES = 50000
+# flow and packet sampling rates of the unsampled packets benchmarks
+FLOW_SAMPLING = 16
+# rules count of the policy benchmarks
+POLICY_RULES_COUNTS = (10, 1000, 10000)
+# distinct inner sources of the analytics benchmark packets
+ANALYTICS_SOURCES = 8192
+
+
+def measure(stmt, number, repeat):
+    """
+    Runs stmt number times, repeat times, and keeps the fastest run (the slower ones being disturbed by the system)
+    :param stmt: (callable) Benchmarked statement
+    :return: (float) Duration of a single call, in nanoseconds
+    """
+    return min(timeit.Timer(stmt).repeat(repeat, number)) / number * 1e9
+
+
+def headers_benchmarks(repeat):
+    """
+    :return: (dict) ns per operation, by benchmark name
+    """
+    packet = bytes(gwlb_packet(inner_packet(6, "10.1.0.1", "10.2.0.1", 40000, 443, TCP_ACK | TCP_PSH, b'x' * 512),
+                               0x12345678, gwlbe_id=0x1111, attachment_id=0x2222))
+    inner_start = GENEVE_OFFSET + 8 + (packet[GENEVE_OFFSET] & 0x3F) * 4
+    number = 100000
+    return {
+        "headers.ipv4": measure(lambda: ipv4.IPv4(packet), number, repeat),
+        "headers.udp": measure(lambda: udp.UDP(packet, 20), number, repeat),
+        "headers.tcp": measure(lambda: tcp.TCP(packet, inner_start + 20, len(packet) - inner_start - 20), number,
+                               repeat),
+        "headers.geneve": measure(lambda: geneve.Geneve(packet, GENEVE_OFFSET), number, repeat),
+        "headers.geneve_option": measure(lambda: geneve.GeneveOption(packet, GENEVE_OPTION_OFFSET), number, repeat),
+        "headers.extract_aws_options": measure(lambda: geneve.extract_aws_options(packet, GENEVE_OFFSET), number,
+                                               repeat),
+    }
+
+
+def rawpacket_benchmarks(logger, repeat):
+    """
+    The outter header of a packet received on the raw socket is patched in place : the packet is copied into the
+    receive buffer before each run, as recvfrom_into does, and this copy is included in the measures
+    :return: (dict) ns per operation, by benchmark name
+    """
+    packet = bytes(gwlb_packet(inner_packet(6, "10.1.0.1", "10.2.0.1", 40000, 443, TCP_ACK | TCP_PSH, b'x' * 512),
+                               0x12345678, gwlbe_id=0x1111, attachment_id=0x2222))
+    length = len(packet)
+    buffer = memoryview(bytearray(config.BUFFER_SIZE))
+    data = buffer[:length]
+    geneve_payload = packet[GENEVE_OFFSET:]
+    number = 50000
+
+    def copy():
+        buffer[:length] = packet
+
+    def lazy():
+        buffer[:length] = packet
+        return RawPacket(logger, data, None, False, lazy=True).resp
+
+    def full():
+        buffer[:length] = packet
+        return RawPacket(logger, data, None, False, lazy=False).resp
+
+    def udp_only():
+        return RawPacket(logger, geneve_payload, None, True).resp
+
+    return {
+        "rawpacket.buffer_copy": measure(copy, number, repeat),
+        "rawpacket.lazy": measure(lazy, number, repeat),
+        "rawpacket.full": measure(full, number, repeat),
+        "rawpacket.udp_only": measure(udp_only, number, repeat),
+    }
+
+
+def random_rules(count, seed=0):
+    """
+    Builds policy rules on random prefixes of 10.0.0.0/8 (so that they overlap), half of them with a destination port
+    :return: (list) Rule objects
+    """
+    generator = random.Random(seed)
+    rules = list()
+    for i in range(count):
+        length = generator.choice((8, 16, 24, 32))
+        network = (10 << 24 | generator.getrandbits(24)) & ~((1 << (32 - length)) - 1)
+        port = generator.randint(1, 1024)
+        rules.append(Rule(i, generator.random() < 0.5, generator.choice((None, 6, 17)), (network, length), None,
+                          None, (port, port) if generator.random() < 0.5 else None))
+    return rules
+
+
+def policy_benchmarks(logger, repeat):
+    """
+    Measures the evaluation of a flow first packet against policies of POLICY_RULES_COUNTS rules, and the processing
+    of a packet whose flow verdict is cached (to compare with rawpacket.lazy)
+    :return: (dict) ns per operation, by benchmark name
+    """
+    results = dict()
+    generator = random.Random(1)
+    tuples = [(6, 10 << 24 | generator.getrandbits(24), generator.getrandbits(32), generator.randint(1024, 65535),
+               generator.randint(1, 1024), 0, 0x1111) for _ in range(1000)]
+    for rules_count in POLICY_RULES_COUNTS:
+        policy = Policy(random_rules(rules_count))
+        results[f"policy.evaluate[{rules_count}]"] = measure(lambda: [policy.evaluate(*t) for t in tuples], 20,
+                                                            repeat) / len(tuples)
+
+    packet = bytes(gwlb_packet(inner_packet(6, "10.1.0.1", "10.2.0.1", 40000, 443, TCP_ACK | TCP_PSH, b'x' * 512),
+                               0x12345678, gwlbe_id=0x1111, attachment_id=0x2222))
+    length = len(packet)
+    buffer = memoryview(bytearray(config.BUFFER_SIZE))
+    data = buffer[:length]
+    policy = Policy(random_rules(POLICY_RULES_COUNTS[-1]))
+
+    def cached():
+        buffer[:length] = packet
+        return RawPacket(logger, data, None, False, policy=policy).resp
+
+    cached()
+    results["policy.rawpacket_cached"] = measure(cached, 50000, repeat)
+    return results
+
+
+def analytics_benchmarks(logger, repeat):
+    """
+    Measures Analytics.add, including its share of the batch updates, with packets of ANALYTICS_SOURCES distinct
+    sources and flow cookies. The RawPacket objects are built out of the measure
+    :return: (dict) ns per packet, by benchmark name
+    """
+    generator = random.Random(2)
+    packets = list()
+    for i in range(ANALYTICS_SOURCES):
+        inner = inner_packet(6, f"10.{i >> 16 & 0xFF}.{i >> 8 & 0xFF}.{i & 0xFF}", f"172.16.{i & 0x0F}.1",
+                             generator.randint(1024, 65535), generator.choice((22, 80, 443)), TCP_ACK, b'x' * 512)
+        packets.append(RawPacket(logger, bytes(gwlb_packet(inner, generator.getrandbits(32))[GENEVE_OFFSET:]), None,
+                                 True))
+    analytics = Analytics()
+
+    def add():
+        for packet in packets:
+            analytics.add(packet)
+        analytics.flush()
+
+    add()
+    return {f"analytics.add{'' if analytics.vectorized else '[no numpy]'}": measure(add, 1, repeat) / len(packets)}
+
+
+def flow_tracker_benchmarks(logger, flows_count, repeat):
+    """
+    Fills a flow tracker with flows_count established TCP flows (SYN, SYN-ACK, ACK), then measures update_flow with
+    data packets of those flows. A new RawPacket is built for each packet (out of the measure), so the inner headers
+    are parsed by update_flow as in the packets processing path.
+    The packets of the flows which are not sampled are then measured, with FLOW_SAMPLING flow and packet sampling
+    rates
+    :return: (dict) ns per operation, by benchmark name
+    """
+    tracker = FlowTracker(logger, max_flows=0)
+    buffers = list()
+    for i in range(flows_count):
+        client, server = f"10.{i >> 16 & 0xFF}.{i >> 8 & 0xFF}.{i & 0xFF}", "172.16.0.1"
+        client_port = 1024 + i % 60000
+        for inner in (inner_packet(6, client, server, client_port, 443, TCP_SYN),
+                      inner_packet(6, server, client, 443, client_port, TCP_SYN | TCP_ACK),
+                      inner_packet(6, client, server, client_port, 443, TCP_ACK)):
+            tracker.update_flow(RawPacket(logger, gwlb_packet(inner, i)[GENEVE_OFFSET:], None, True))
+        # the packets of the measures are taken from a few thousands flows spread over the table
+        if i % max(flows_count // 4096, 1) == 0:
+            buffers.append(bytes(gwlb_packet(
+                inner_packet(6, client, server, client_port, 443, TCP_ACK | TCP_PSH, b'x' * 512), i)[GENEVE_OFFSET:]))
+
+    update_flow = tracker.update_flow
+    durations = list()
+    for _ in range(repeat):
+        packets = [RawPacket(logger, buffers[i % len(buffers)], None, True) for i in range(FLOW_UPDATES)]
+        start = time.perf_counter_ns()
+        for packet in packets:
+            update_flow(packet)
+        durations.append((time.perf_counter_ns() - start) / FLOW_UPDATES)
+    results = {f"flow_tracker.update_flow[{flows_count}]": min(durations)}
+
+    tracker.set_sampling(FLOW_SAMPLING, FLOW_SAMPLING)
+    cookies = [cookie for cookie in range(flows_count, flows_count + 2 * len(buffers))
+               if flow_sampling_hash(cookie) % FLOW_SAMPLING][:len(buffers)]
+    buffers = [bytes(gwlb_packet(inner_packet(6, "10.255.0.1", "172.16.0.1", 1024 + i % 60000, 443,
+                                              TCP_ACK | TCP_PSH, b'x' * 512), cookie)[GENEVE_OFFSET:])
+               for i, cookie in enumerate(cookies)]
+    durations = list()
+    for _ in range(repeat):
+        packets = [RawPacket(logger, buffers[i % len(buffers)], None, True) for i in range(FLOW_UPDATES)]
+        start = time.perf_counter_ns()
+        for packet in packets:
+            update_flow(packet)
+        durations.append((time.perf_counter_ns() - start) / FLOW_UPDATES)
+    results[f"flow_tracker.update_flow[{flows_count}].unsampled"] = min(durations)
+    tracker.tracked_flows.clear()
+    tracker.established_flows.clear()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the results with a baseline
+    :param threshold: (float) Maximum slowdown allowed, in percent
+    :return: (list) Names of the benchmarks slower than the baseline by more than threshold percent
+    """
+    regressions = list()
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            print(f"{name:48} {value:10.0f} ns   (no baseline)")
+            continue
+        change = (value - reference) * 100 / reference
+        regression = change > threshold
+        print(f"{name:48} {value:10.0f} ns   baseline {reference:10.0f} ns   {change:+6.1f}%"
+              f"{'   REGRESSION' if regression else ''}")
+        if regression:
+            regressions.append(name)
+    return regressions
+
+
+def cli_parser():
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Micro-benchmarks of the Geneve router packets processing path. Exits with status 1 if a "
+                    "benchmark is slower than the baseline by more than the threshold",
+    )
+    parser.add_argument("-o", "--output", metavar="FILE", help="Writes the results to a JSON file")
+    parser.add_argument("-b", "--baseline", metavar="FILE", help="Compares the results with a JSON results file")
+    parser.add_argument("-t", "--threshold", type=float, default=10.0,
+                        help="Maximum slowdown allowed against the baseline, in percent (10 by default)")
+    parser.add_argument("-f", "--flows", default="1000,100000,1000000",
+                        help="Comma-separated tracked flows counts of the flow tracker benchmarks "
+                             "(1000,100000,1000000 by default)")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="Number of runs of each benchmark, the fastest one being kept (5 by default)")
+    parser.add_argument("-k", "--filter", metavar="PREFIX", default="",
+                        help="Only runs the benchmarks whose name starts with PREFIX (e.g. headers, rawpacket.lazy)")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_parser()
+    logger = logging.getLogger("geneve-router-benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+
+    groups = [
+        ("headers", lambda: headers_benchmarks(args.repeat)),
+        ("rawpacket", lambda: rawpacket_benchmarks(logger, args.repeat)),
+        ("policy", lambda: policy_benchmarks(logger, args.repeat)),
+        ("analytics", lambda: analytics_benchmarks(logger, args.repeat)),
+    ]
+    for flows_count in (int(f) for f in args.flows.split(',') if f):
+        groups.append((f"flow_tracker.update_flow[{flows_count}]",
+                       lambda flows_count=flows_count: flow_tracker_benchmarks(logger, flows_count, args.repeat)))
+
+    results = dict()
+    for name, run in groups:
+        # the names of the benchmarks of a group start with the group name
+        if not name.startswith(args.filter) and not args.filter.startswith(name):
+            continue
+        results.update({k: v for k, v in run().items() if k.startswith(args.filter)})
+
+    regressions = list()
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+    else:
+        for name, value in results.items():
+            print(f"{name:48} {value:10.0f} ns")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "version": RESULTS_VERSION,
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "results": results,
+            }, f, indent=2)
+
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold}%")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
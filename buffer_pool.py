@@ -0,0 +1,29 @@
+import config
+
+
+class BufferPool:
+    """
+    Pool of preallocated receive buffers
+
+    Each buffer is a bytearray of config.BUFFER_SIZE bytes (large enough for the GWLB 8500 bytes MTU), exposed through
+    a memoryview. Packets are received directly into those buffers with recvfrom_into, parsed and patched in place,
+    and the same memoryview slice is then given back to sendto. The payload is never copied.
+
+    A buffer is reused as soon as the batch it belongs to has been flushed, so the pool must contain at least as many
+    buffers as the batch size.
+    """
+
+    def __init__(self, buffers_count, buffer_size=config.BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.buffers = [bytearray(buffer_size) for _ in range(buffers_count)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __getitem__(self, index):
+        """
+        Returns the memoryview over the buffer at the given index of the pool
+        :return: (memoryview) Writable view over the whole buffer
+        """
+        return self.views[index]
@@ -1,8 +1,64 @@
 GENEVE_PORT = 6081
 HEALTH_CHECK_PORT = 80
+HEALTH_CHECK_BACKLOG = 128
+HEALTH_CHECK_TIMEOUT = 1.0
+METRICS_PORT = None
+METRICS_PUBLISH_INTERVAL = 1.0
 LOG_LEVEL = "warning"
 LOG_FILE = "logging.log"
+LOG_QUEUE_SIZE = 10000
 TCP_FLOW_TIMEOUT = 300
+TCP_SYN_TIMEOUT = 20
+TCP_SYN_FLOOD_TIMEOUT = 5
+TCP_FIN_TIMEOUT = 30
+TCP_CLOSED_TIMEOUT = 5
 FLOW_TIMEOUT = 30
+ICMP_FLOW_TIMEOUT = 10
+TIMER_WHEEL_RESOLUTION = 1
+TIMER_WHEEL_SLOTS = 512
 TCP_IMMEDIATE_CLEAN = True
-TCP_NONSYN_BLOCK = True
\ No newline at end of file
+TCP_NONSYN_BLOCK = True
+MAX_FLOWS = 1 << 19
+MAX_HALF_OPEN_FLOWS = 1 << 16
+FLOW_SAMPLING = 1
+PACKET_SAMPLING = 0
+SAMPLING_CONTROL_FILE = "geneve-router-sampling"
+SAMPLING_CONTROL_INTERVAL = 1
+FLOW_EXPORT = None
+FLOW_EXPORT_MAX_BYTES = 64 << 20
+FLOW_EXPORT_BACKUP_COUNT = 5
+FLOW_EXPORT_QUEUE_SIZE = 100000
+FLOW_EXPORT_FLUSH_INTERVAL = 1.0
+FLOW_TABLE = None
+FLOW_TABLE_SLOTS = 1 << 20
+FLOW_TABLE_SWEEP_INTERVAL = 60
+POLICY = None
+POLICY_DEFAULT = "allow"
+POLICY_CACHE_SIZE = 1 << 20
+POLICY_CACHE_TIMEOUT = 300
+ANALYTICS = False
+ANALYTICS_INTERVAL = 60
+ANALYTICS_BATCH_SIZE = 4096
+ANALYTICS_SKETCH_WIDTH = 1 << 14
+ANALYTICS_SKETCH_DEPTH = 4
+ANALYTICS_TOP_K = 20
+ANALYTICS_HLL_PRECISION = 12
+ANALYTICS_MAX_GROUPS = 256
+ENGINE = "raw"
+BATCH_SIZE = 32
+BUFFER_SIZE = 8500
+SOCKET_RCVBUF = 4 << 20
+SOCKET_SNDBUF = 1 << 20
+BATCH_STATS_INTERVAL = 60
+BUSY_POLL = 0
+BUSY_POLL_THRESHOLD = 64
+WORKERS = 1
+WORKER_RESTART_DELAY = 5
+RING_BLOCK_SIZE = 1 << 20
+RING_BLOCKS_COUNT = 64
+RING_FRAME_SIZE = 2048
+RING_BLOCK_TIMEOUT = 10
+LAZY_PARSING = True
+VALIDATE_CHECKSUM = False
+PROFILE_DURATION = 30
+PROFILE_INTERVAL = 0.005
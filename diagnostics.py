@@ -0,0 +1,129 @@
+import os
+import signal
+import threading
+import time
+import config
+from headers.geneve import format_flow_cookie
+
+
+def dump_path(directory, kind, worker_id=None):
+    """
+    :param directory: (str) Directory of the dump files (the log file one)
+    :param kind: (str) "profile" or "snapshot"
+    :return: (str) Path of a new dump file, unique per process and second
+    """
+    worker = f"-worker{worker_id}" if worker_id is not None else ""
+    return os.path.join(directory, f"geneve-router-{kind}{worker}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the packets processing thread, which can be started on a running process
+
+    A SIGPROF timer (ITIMER_PROF, counting the CPU time of the process) interrupts the main thread every
+    config.PROFILE_INTERVAL seconds of CPU time, and the call stack of the interrupted frame is counted. The cost is a
+    stack walk per sample, and nothing at all when the profiler is not running, so it can be used on a loaded router.
+    The report lists the functions by own and cumulative samples, and the sampled stacks in the collapsed format
+    used by the flame graph tools (one "caller;callee;... count" line per stack).
+    """
+
+    def __init__(self):
+        self.samples = dict()
+        self.samples_count = 0
+        self.running = False
+        self.started_at = 0
+        self.deadline = 0
+
+    def start(self, duration=config.PROFILE_DURATION):
+        """
+        :param duration: (float) Profiling time, in seconds. The owner has to call stop() once the deadline is passed
+        :return:
+        """
+        self.samples = dict()
+        self.samples_count = 0
+        self.running = True
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + duration
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, config.PROFILE_INTERVAL, config.PROFILE_INTERVAL)
+
+    def sample(self, signum, frame):
+        stack = list()
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        # the stack is stored from the outermost caller
+        stack = tuple(reversed(stack))
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+        self.samples_count += 1
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        # a signal may still be pending, and SIGPROF terminates the process by default
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+
+    def report(self, top=40):
+        """
+        :param top: (int) Number of functions listed by own and cumulative samples
+        :return: (str) Profiling report
+        """
+        own = dict()
+        cumulative = dict()
+        for stack, count in self.samples.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            # recursive functions are counted once per stack
+            for function in set(stack):
+                cumulative[function] = cumulative.get(function, 0) + count
+
+        def name(function):
+            filename, line, function_name = function
+            return f"{function_name} ({os.path.basename(filename)}:{line})"
+
+        total = self.samples_count or 1
+        lines = [f"# {self.samples_count} samples in {time.monotonic() - self.started_at:.1f}s "
+                 f"(every {config.PROFILE_INTERVAL * 1000:g}ms of CPU time)", "", "# own samples"]
+        for function, count in sorted(own.items(), key=lambda i: -i[1])[:top]:
+            lines.append(f"{count:8} {count * 100 / total:6.2f}%  {name(function)}")
+        lines += ["", "# cumulative samples"]
+        for function, count in sorted(cumulative.items(), key=lambda i: -i[1])[:top]:
+            lines.append(f"{count:8} {count * 100 / total:6.2f}%  {name(function)}")
+        lines += ["", "# collapsed stacks"]
+        for stack, count in sorted(self.samples.items(), key=lambda i: -i[1]):
+            lines.append(f"{';'.join(name(function) for function in stack)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def write_snapshot(logger, path, counters, flows):
+    """
+    Writes a snapshot of the counters and of the flows table. The flows are written in the background, as the table
+    may be large : the caller only has to copy the flows list
+    :param path: (str) Dump file path
+    :param counters: (dict) Counter values by name
+    :param flows: (list) flow_tracker.Flow objects
+    :return: (threading.Thread) Writer thread
+    """
+    def write():
+        now = time.monotonic()
+        try:
+            with open(path, 'w') as f:
+                f.write("# counters\n")
+                for name, value in counters.items():
+                    f.write(f"{name} {value}\n")
+                f.write(f"\n# flows ({len(flows)} tracked)\n")
+                f.write("cookie protocol state source destination source_port destination_port packets_sent "
+                        "packets_received bytes_sent bytes_received age_s idle_s\n")
+                for flow in flows:
+                    f.write(f"{format_flow_cookie(flow.aws_flow_cookie)} {flow.protocol} {flow.state} "
+                            f"{flow.src_addr_str} {flow.dst_addr_str} {flow.src_port} {flow.dst_port} "
+                            f"{flow.pkts_sent} {flow.pkts_received} {flow.bytes_sent} {flow.bytes_received} "
+                            f"{now - flow.start_timestamp:.1f} {now - flow.lastpacket_timestamp:.1f}\n")
+        except OSError as e:
+            logger.error(f"DIAGNOSTICS - Unable to write the snapshot to {path} : {e}")
+            return
+        logger.warning(f"DIAGNOSTICS - Snapshot of {len(flows)} flows written to {path}")
+
+    writer = threading.Thread(target=write, name="snapshot", daemon=True)
+    writer.start()
+    return writer
@@ -0,0 +1,182 @@
+import os
+import queue
+import socket
+import threading
+import time
+from struct import Struct
+import config
+
+FLOW_RECORD_VERSION = 1
+# version, inner IP protocol, TCP state, end reason, AWS flow cookie, source address, destination address, source
+# port, destination port, packets sent, packets received, bytes sent, bytes received, start time (ms since epoch),
+# end time (ms since epoch, last packet seen)
+FLOW_RECORD = Struct('!BBBBIIIHHQQQQQQ')
+
+TCP_STATE_CODES = {
+    None: 0,
+    'SYN': 1,
+    'SYNACK': 2,
+    'RUN': 3,
+    'FIN': 4,
+    'FINACK': 5,
+    'CLOSED': 6,
+}
+
+END_TIMEOUT = 1
+END_TCP_CLOSED = 2
+END_SHUTDOWN = 3
+END_EVICTED = 4
+
+END_REASONS = {
+    END_TIMEOUT: "timeout",
+    END_TCP_CLOSED: "TCP closed",
+    END_SHUTDOWN: "shutdown",
+    END_EVICTED: "evicted",
+}
+
+# maximum size of a datagram sent to a flow records collector
+DATAGRAM_MAX_SIZE = 1400
+
+
+class FlowExporter(threading.Thread):
+    """
+    Writes flow records from a background thread
+
+    A fixed-size binary record (FLOW_RECORD, big-endian, FLOW_RECORD.size bytes) is built for each ended flow. The
+    records are queued (in a queue of config.FLOW_EXPORT_QUEUE_SIZE records, dropped when it is full) and written by
+    batches, at least every config.FLOW_EXPORT_FLUSH_INTERVAL seconds, either :
+    - to a file, rotated once larger than config.FLOW_EXPORT_MAX_BYTES (keeping config.FLOW_EXPORT_BACKUP_COUNT
+      previous files, as <file>.1, <file>.2...)
+    - or to a collector, as UDP datagrams of up to DATAGRAM_MAX_SIZE bytes, when the destination is "udp://host:port"
+    The records of a batch which can't be written are lost, and counted in failed. The file is reopened on the next
+    batch if it has been left closed (by a failed rotation).
+    """
+
+    def __init__(self, logger, destination):
+        """
+        :param destination: (str) File path, or "udp://host:port" collector address
+        """
+        super().__init__(name="flow-export", daemon=True)
+        self.logger = logger
+        self.destination = destination
+        self.queue = queue.Queue(config.FLOW_EXPORT_QUEUE_SIZE)
+        self.dropped = 0
+        self.exported = 0
+        self.failed = 0
+        self.stopping = False
+        self.file = None
+        self.socket = None
+        self.collector = None
+
+        if destination.startswith("udp://"):
+            host, port = destination[len("udp://"):].rsplit(':', 1)
+            self.collector = (host, int(port))
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.file = open(destination, 'ab')
+
+    def export(self, flow, end_reason):
+        """
+        Builds the record of an ended flow, and queues it without blocking
+        :param flow: (flow_tracker.Flow) Ended flow
+        :param end_reason: (int) One of the END_* values
+        :return:
+        """
+        # flows timestamps are time.monotonic() values
+        clock_offset = time.time() - time.monotonic()
+        record = FLOW_RECORD.pack(
+            FLOW_RECORD_VERSION,
+            flow.protocol,
+            TCP_STATE_CODES.get(flow.state, 0),
+            end_reason,
+            flow.aws_flow_cookie,
+            flow.src_addr,
+            flow.dst_addr,
+            flow.src_port,
+            flow.dst_port,
+            # the counters of a sampled flow stand for all the flows it has been selected among
+            flow.pkts_sent * flow.sampling_rate,
+            flow.pkts_received * flow.sampling_rate,
+            flow.bytes_sent * flow.sampling_rate,
+            flow.bytes_received * flow.sampling_rate,
+            int((flow.start_timestamp + clock_offset) * 1000),
+            int((flow.lastpacket_timestamp + clock_offset) * 1000)
+        )
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        self.logger.info(f"FLOW-EXPORT - Exporting flow records to {self.destination}")
+        while not self.stopping or not self.queue.empty():
+            try:
+                records = [self.queue.get(timeout=config.FLOW_EXPORT_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(records)
+            except OSError as e:
+                self.logger.error(f"FLOW-EXPORT - Unable to export {len(records)} flow records : {e}")
+                self.failed += len(records)
+                continue
+            self.exported += len(records)
+
+    def write(self, records):
+        if self.collector:
+            records_per_datagram = DATAGRAM_MAX_SIZE // FLOW_RECORD.size
+            for i in range(0, len(records), records_per_datagram):
+                self.socket.sendto(b''.join(records[i:i + records_per_datagram]), self.collector)
+            return
+        if self.file.closed:
+            self.file = open(self.destination, 'ab')
+        if self.file.tell() >= config.FLOW_EXPORT_MAX_BYTES:
+            self.rotate()
+        self.file.write(b''.join(records))
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(config.FLOW_EXPORT_BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(f"{self.destination}.{i}"):
+                os.replace(f"{self.destination}.{i}", f"{self.destination}.{i + 1}")
+        if config.FLOW_EXPORT_BACKUP_COUNT:
+            os.replace(self.destination, f"{self.destination}.1")
+        else:
+            os.remove(self.destination)
+        self.file = open(self.destination, 'ab')
+
+    def stop(self):
+        """
+        Writes the queued records and stops the thread
+        :return:
+        """
+        self.stopping = True
+        if self.is_alive():
+            self.join(timeout=config.FLOW_EXPORT_FLUSH_INTERVAL + 5)
+        if self.dropped:
+            self.logger.warning(f"FLOW-EXPORT - {self.dropped} flow records dropped (queue full)")
+        if self.failed:
+            self.logger.warning(f"FLOW-EXPORT - {self.failed} flow records lost (write errors)")
+        self.logger.info(f"FLOW-EXPORT - {self.exported} flow records exported")
+        if self.file:
+            self.file.close()
+        if self.socket:
+            self.socket.close()
+
+
+def read_records(path):
+    """
+    Reads a flow records file
+    :param path: (str) Path of the file
+    :return: (generator) FLOW_RECORD tuples
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    for offset in range(0, len(data) - FLOW_RECORD.size + 1, FLOW_RECORD.size):
+        yield FLOW_RECORD.unpack_from(data, offset)
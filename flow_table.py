@@ -0,0 +1,259 @@
+import fcntl
+import mmap
+import os
+from struct import Struct
+import config
+from flow_export import TCP_STATE_CODES
+
+FLOW_TABLE_MAGIC = b'GRFT'
+FLOW_TABLE_VERSION = 1
+# magic, version, record size, slots count, used slots, deleted slots
+TABLE_HEADER = Struct('=4sHHQQQ')
+# the records start on their own cache line
+RECORDS_OFFSET = 64
+
+# slot status
+SLOT_EMPTY = 0
+SLOT_USED = 1
+SLOT_DELETED = 2
+
+# status, inner IP protocol, AWS flow cookie, source address, destination address, source port, destination port,
+# start time (seconds since epoch)
+FLOW_KEY = Struct('=BBxxIIIHHxxxxd')
+# TCP state, PID of the owner process, last packet time (seconds since epoch), packets sent, packets received,
+# bytes sent, bytes received. Rewritten on each packet of the flow
+FLOW_STATE = Struct('=BxxxIdQQQQ')
+FLOW_STATE_OFFSET = FLOW_KEY.size
+RECORD_SIZE = FLOW_KEY.size + FLOW_STATE.size
+# status and AWS flow cookie, read while probing
+SLOT_PREFIX = Struct('=BxxxI')
+
+TCP_STATES = {code: state for state, code in TCP_STATE_CODES.items()}
+# maximum ratio of used slots, to keep the probe sequences short
+MAX_LOAD = 0.9
+
+
+class FlowTableError(Exception):
+    "raised when the flow table file can't be used"
+    pass
+
+
+class SharedFlowTable:
+    """
+    Flows table kept in a memory-mapped file, shared by the processes which map the same file
+
+    The table is an open-addressing hash table (linear probing) of config.FLOW_TABLE_SLOTS fixed-size records of
+    RECORD_SIZE bytes, indexed by AWS flow cookie. As the file outlives the processes (in /dev/shm by default), a
+    restarted process finds the flows which were tracked before, and a worker receiving a flow handled by another one
+    so far (e.g. after a GWLB rebalancing) finds it as well.
+
+    A flow is expected to be handled by a single process at a time : the owner rewrites the FLOW_STATE part of the
+    record on each packet, without locking. The slots are only taken and released with an exclusive lock on the file
+    (fcntl, so across the processes), which the threads of a process must serialize themselves. Deleted slots are
+    marked as such (a flow keeps its slot as long as it is tracked), and emptied again once they are at the end of a
+    probe sequence.
+    Timestamps are stored as seconds since epoch, as time.monotonic() values are not comparable after a reboot.
+    """
+
+    def __init__(self, logger, path, slots_count=config.FLOW_TABLE_SLOTS):
+        """
+        :param path: (str) Table file, created if it does not exist, and reset if its format does not match
+        :param slots_count: (int) Number of records, which has to be a power of 2
+        """
+        if slots_count < 2 or slots_count & (slots_count - 1):
+            raise FlowTableError(f"the slots count ({slots_count}) has to be a power of 2")
+        self.logger = logger
+        self.path = path
+        self.slots_count = slots_count
+        self.mask = slots_count - 1
+        self.hash_shift = 32 - slots_count.bit_length() + 1
+        self.pid = os.getpid()
+        self.sweep_position = 0
+        size = RECORDS_OFFSET + slots_count * RECORD_SIZE
+
+        try:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            raise FlowTableError(f"unable to open {path} : {e}")
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                header = None
+                if os.fstat(self.fd).st_size == size:
+                    header = TABLE_HEADER.unpack(os.pread(self.fd, TABLE_HEADER.size, 0))
+                if header and header[:4] == (FLOW_TABLE_MAGIC, FLOW_TABLE_VERSION, RECORD_SIZE, slots_count):
+                    self.logger.warning(f"FLOW-TABLE - {header[4]} flows found in {path}")
+                else:
+                    if os.fstat(self.fd).st_size:
+                        self.logger.warning(f"FLOW-TABLE - Format of {path} not matching, resetting it")
+                    # the file is sparse : the pages of the records are only allocated once written
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, TABLE_HEADER.pack(FLOW_TABLE_MAGIC, FLOW_TABLE_VERSION, RECORD_SIZE,
+                                                         slots_count, 0, 0), 0)
+                    self.logger.info(f"FLOW-TABLE - {path} created with {slots_count} slots")
+                self.map = mmap.mmap(self.fd, size)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        except OSError as e:
+            os.close(self.fd)
+            raise FlowTableError(f"unable to map {path} : {e}")
+
+    @property
+    def count(self):
+        """
+        :return: (int) Number of flows in the table, for all the processes
+        """
+        return TABLE_HEADER.unpack_from(self.map)[4]
+
+    def first_slot(self, flow_cookie):
+        # multiplicative hash : the cookies are random, but the high bits of the product are mixed better
+        return ((flow_cookie * 0x9E3779B1) & 0xFFFFFFFF) >> self.hash_shift
+
+    def find(self, flow_cookie):
+        """
+        Must be called with the file locked
+        :return: (tuple) (slot of the flow or None, first free slot of the probe sequence or None)
+        """
+        free_slot = None
+        slot = self.first_slot(flow_cookie)
+        for _ in range(self.slots_count):
+            status, cookie = SLOT_PREFIX.unpack_from(self.map, RECORDS_OFFSET + slot * RECORD_SIZE)
+            if status == SLOT_EMPTY:
+                return None, slot if free_slot is None else free_slot
+            if status == SLOT_DELETED:
+                if free_slot is None:
+                    free_slot = slot
+            elif cookie == flow_cookie:
+                return slot, free_slot
+            slot = (slot + 1) & self.mask
+        return None, free_slot
+
+    def lookup(self, flow_cookie):
+        """
+        :param flow_cookie: (int) AWS flow cookie
+        :return: (tuple) (slot, record) of the flow, (None, None) if it is not in the table. The record is a tuple
+                 of the FLOW_KEY values followed by the FLOW_STATE ones
+        """
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            slot, _ = self.find(flow_cookie)
+            if slot is None:
+                return None, None
+            return slot, self.read(slot)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def read(self, slot):
+        offset = RECORDS_OFFSET + slot * RECORD_SIZE
+        return FLOW_KEY.unpack_from(self.map, offset) + FLOW_STATE.unpack_from(self.map, offset + FLOW_STATE_OFFSET)
+
+    def insert(self, flow, clock_offset):
+        """
+        Writes the record of a new flow (replacing the one of a former flow with the same cookie, if any)
+        :param flow: (flow_tracker.Flow) New flow
+        :param clock_offset: (float) Difference between time.time() and time.monotonic()
+        :return: (int) Slot of the flow, None if the table is full
+        """
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            slot, free_slot = self.find(flow.aws_flow_cookie)
+            magic, version, record_size, slots_count, used, deleted = TABLE_HEADER.unpack_from(self.map)
+            if slot is None:
+                if free_slot is None or used >= self.slots_count * MAX_LOAD:
+                    return None
+                slot = free_slot
+                if SLOT_PREFIX.unpack_from(self.map, RECORDS_OFFSET + slot * RECORD_SIZE)[0] == SLOT_DELETED:
+                    deleted -= 1
+                used += 1
+                TABLE_HEADER.pack_into(self.map, 0, magic, version, record_size, slots_count, used, deleted)
+            offset = RECORDS_OFFSET + slot * RECORD_SIZE
+            FLOW_KEY.pack_into(self.map, offset, SLOT_USED, flow.protocol, flow.aws_flow_cookie, flow.src_addr,
+                               flow.dst_addr, flow.src_port, flow.dst_port, flow.start_timestamp + clock_offset)
+            self.update(flow, slot, clock_offset)
+            return slot
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def update(self, flow, slot, clock_offset):
+        """
+        Rewrites the state and statistics of a flow, on each of its packets
+        :return:
+        """
+        FLOW_STATE.pack_into(self.map, RECORDS_OFFSET + slot * RECORD_SIZE + FLOW_STATE_OFFSET,
+                             TCP_STATE_CODES.get(flow.state, 0), self.pid, flow.lastpacket_timestamp + clock_offset,
+                             flow.pkts_sent, flow.pkts_received, flow.bytes_sent, flow.bytes_received)
+
+    def remove(self, flow_cookie, slot, owned_only=False):
+        """
+        Releases the slot of a flow
+        :param slot: (int) Slot of the flow, as returned by insert() or lookup()
+        :param owned_only: (bool) Keeps the record if the last packet of the flow has been seen by another process
+        :return: (bool) True if the record has been removed, False if it was not the one of the flow anymore, or if
+                 the flow has been taken over by another process
+        """
+        offset = RECORDS_OFFSET + slot * RECORD_SIZE
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            status, cookie = SLOT_PREFIX.unpack_from(self.map, offset)
+            if status != SLOT_USED or cookie != flow_cookie:
+                return False
+            if owned_only and FLOW_STATE.unpack_from(self.map, offset + FLOW_STATE_OFFSET)[1] != self.pid:
+                return False
+            self.release(slot)
+            return True
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def release(self, slot):
+        """
+        Marks a slot as deleted. Must be called with the file locked
+        :return:
+        """
+        offset = RECORDS_OFFSET + slot * RECORD_SIZE
+        magic, version, record_size, slots_count, used, deleted = TABLE_HEADER.unpack_from(self.map)
+        self.map[offset] = SLOT_DELETED
+        used -= 1
+        deleted += 1
+        # a deleted slot followed by an empty one is not part of any probe sequence anymore
+        if self.map[RECORDS_OFFSET + ((slot + 1) & self.mask) * RECORD_SIZE] == SLOT_EMPTY:
+            while self.map[offset] == SLOT_DELETED:
+                self.map[offset] = SLOT_EMPTY
+                deleted -= 1
+                slot = (slot - 1) & self.mask
+                offset = RECORDS_OFFSET + slot * RECORD_SIZE
+        TABLE_HEADER.pack_into(self.map, 0, magic, version, record_size, slots_count, used, deleted)
+
+    def sweep(self, slots_count, is_expired):
+        """
+        Removes the expired records of the next slots_count slots. This is how the flows left by a stopped process
+        are eventually removed, if they are not taken over
+        :param slots_count: (int) Number of slots checked by this run, the next run starting where this one stopped
+        :param is_expired: (callable) Takes a record, returns True if it has to be removed
+        :return: (list) Removed records
+        """
+        expired = list()
+        for _ in range(min(slots_count, self.slots_count)):
+            slot = self.sweep_position
+            self.sweep_position = (slot + 1) & self.mask
+            if self.map[RECORDS_OFFSET + slot * RECORD_SIZE] == SLOT_USED:
+                record = self.read(slot)
+                if is_expired(record):
+                    expired.append((slot, record))
+        removed = list()
+        if not expired:
+            return removed
+        # the records are checked again with the file locked, they may have been updated in the meantime
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            for slot, record in expired:
+                if self.read(slot) == record:
+                    self.release(slot)
+                    removed.append(record)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        return removed
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
@@ -1,94 +1,368 @@
-import datetime
-import math
 import config
+import logging
+import os
+import socket
+import sys
 import threading
-from time import sleep
+from collections import OrderedDict
+from struct import Struct
+from time import sleep, monotonic, time
+from headers.geneve import format_flow_cookie
+from timer_wheel import TimerWheel
+from flow_export import END_TIMEOUT, END_TCP_CLOSED, END_SHUTDOWN, END_EVICTED, END_REASONS
+from flow_table import TCP_STATES
+
+# inner IPv4 total length, source and destination addresses
+INNER_IPV4_FIELDS = Struct('!2xH8xII')
+# TCP control bits which may change the state of an established flow : FIN, SYN and RST
+TCP_STATE_FLAGS = 0x07
+# TCP states of the half-open flows, which have a dedicated budget and are evicted first
+HALF_OPEN_STATES = ('SYN', 'SYNACK')
+# reasons for which the flows are evicted, counted separately :
+# - max_flows_half_open : half-open flow evicted to make room for a new flow, when the max flows count is reached
+# - max_flows_lru : least recently used flow evicted to make room for a new flow, when there is no half-open flow
+# - half_open_budget : half-open flow evicted to make room for a new one, when the half-open budget is used
+# - half_open_timeout : half-open flow not established after config.TCP_SYN_FLOOD_TIMEOUT, during a SYN flood
+EVICTION_REASONS = ('max_flows_half_open', 'max_flows_lru', 'half_open_budget', 'half_open_timeout')
+# entries of a flow in the tracked flows dict, in the half-open or established flows OrderedDict and in the timer
+# wheel, in bytes (measured with tracemalloc on CPython 3.11)
+FLOW_ENTRIES_MEMORY = 160
+# multiplier of the flow cookies hash, which selects the sampled flows (64 bits golden ratio)
+FLOW_SAMPLING_MULTIPLIER = 0x9E3779B97F4A7C15
+
+# TCP flows inactivity timeout, depending on their state. Half-open and closing flows expire quicker than the
+# established ones
+TCP_STATE_TIMEOUTS = {
+    'SYN': config.TCP_SYN_TIMEOUT,
+    'SYNACK': config.TCP_SYN_TIMEOUT,
+    'RUN': config.TCP_FLOW_TIMEOUT,
+    'FIN': config.TCP_FIN_TIMEOUT,
+    'FINACK': config.TCP_FIN_TIMEOUT,
+    'CLOSED': config.TCP_CLOSED_TIMEOUT,
+}
+
+
+def flow_timeout(protocol, state):
+    """
+    Returns the inactivity timeout of a flow
+    :param protocol: (int) Inner IP protocol of the flow
+    :param state: (str) State of the flow
+    :return: (int) Timeout, in seconds
+    """
+    if protocol == 6:
+        # TCP flows which have not been seen starting with a SYN are handled as established ones
+        return TCP_STATE_TIMEOUTS.get(state, config.TCP_FLOW_TIMEOUT)
+    if protocol == 1:
+        return config.ICMP_FLOW_TIMEOUT
+    return config.FLOW_TIMEOUT
+
+
+def flow_sampling_hash(flow_cookie):
+    """
+    Hashes an AWS flow cookie, so that the sampled flows don't depend on how the cookies are allocated
+    :param flow_cookie: (int) AWS flow cookie
+    :return: (int) 32 bits hash
+    """
+    return (flow_cookie * FLOW_SAMPLING_MULTIPLIER) >> 32 & 0xFFFFFFFF
+
+
+def estimate_flow_memory():
+    """
+    Estimates the memory used by a tracked flow : the Flow object, the values of its attributes which are not shared
+    with the other flows (addresses, ports, counters and timestamps), and its entries in the tracker dicts
+    :return: (int) Bytes
+    """
+    # AWS flow cookie and addresses, ports, wheel tick and counters, timestamps
+    values = 3 * sys.getsizeof(1 << 31) + 7 * sys.getsizeof(1 << 16) + 3 * sys.getsizeof(0.0)
+    return sys.getsizeof(Flow.__new__(Flow)) + values + FLOW_ENTRIES_MEMORY
 
 
 class Flow:
-    def __init__(self, logger, flow_packet, tracker):
-        self.full_init = False
-        self.aws_flow_cookie = flow_packet.geneve.flow_cookie
-        self.logger = logger
-        self.state = None
-        self.protocol = flow_packet.inner_ipv4.protocol
-        self.src_addr = flow_packet.inner_ipv4.src_addr_str
-        self.dst_addr = flow_packet.inner_ipv4.dst_addr_str
+    """
+    State and statistics of a tracked flow
+
+    Flows are kept as compact slotted objects : IP addresses are stored as 4-bytes integers, and timestamps are
+    time.monotonic() values. The logger is reached through the tracker.
+    expires is the time after which the flow is removed if no other packet is seen, and wheel_tick the tick of the
+    tracker timer wheel at which the flow is currently scheduled.
+    slot is the index of the flow record in the shared flow table of the tracker, if any.
+    sampling_rate is the flow sampling rate of the tracker when the flow started to be tracked (1 in sampling_rate
+    flows tracked) : the flow stands for sampling_rate flows, and its counters are scaled by it when exported.
+    allowed is the verdict of the policy for the flow (policy.Policy), which ends with the flow.
+    """
+
+    __slots__ = ('aws_flow_cookie', 'tracker', 'state', 'protocol', 'src_addr', 'dst_addr', 'src_port', 'dst_port',
+                 'start_timestamp', 'lastpacket_timestamp', 'pkts_sent', 'pkts_received', 'bytes_sent',
+                 'bytes_received', 'expires', 'wheel_tick', 'slot', 'sampling_rate', 'allowed')
+
+    def __init__(self, flow_packet, tracker, flow_cookie):
+        self.aws_flow_cookie = flow_cookie
         self.tracker = tracker
+        self.state = None
+        self.protocol = flow_packet.inner_protocol
+        self.src_addr, self.dst_addr = flow_packet.inner_addresses
         if self.protocol in [6, 17]:
             self.src_port = flow_packet.inner_l4.src_port
             self.dst_port = flow_packet.inner_l4.dst_port
             if self.protocol == 6:
                 if flow_packet.inner_l4.syn and not flow_packet.inner_l4.ack:
                     self.state = 'SYN'
+                elif monotonic() < self.tracker.nonsyn_block_from:
+                    # the flow may have started before the flow sampling rate was lowered : it is handled as an
+                    # established one
+                    self.state = 'RUN'
                 else:
-                    self.logger.warning("FLOW-TRACKER - First packet for un-initialized TCP flow is not a SYN !")
+                    self.tracker.logger.warning(
+                        "FLOW-TRACKER - First packet for un-initialized TCP flow is not a SYN !")
                     if config.TCP_NONSYN_BLOCK:
-                        self.tracker.delete_flow(self.aws_flow_cookie)
+                        # the flow is not tracked, and its packet is dropped
+                        self.state = 'BLOCKED'
+                        return
+                    # the flow is handled as an established one, so its packets take the fast path and its end is
+                    # seen
+                    self.state = 'RUN'
             else:
                 self.state = 'RUN'
         else:
             self.state = 'RUN'
             self.src_port = 0
             self.dst_port = 0
-        self.start_timestamp = math.floor(datetime.datetime.utcnow().timestamp())
+        self.start_timestamp = monotonic()
         self.lastpacket_timestamp = self.start_timestamp
+        self.expires = self.start_timestamp + flow_timeout(self.protocol, self.state)
+        self.wheel_tick = None
+        self.slot = None
+        self.sampling_rate = self.tracker.flow_sampling
+        # only the packets allowed by the policy reach the flow tracker
+        self.allowed = True
         self.pkts_sent = 1
         self.pkts_received = 0
         self.bytes_sent = flow_packet.inner_l4.payload_length
         self.bytes_received = 0
-        self.logger.info(f"FLOW-TRACKER - New flow added (AWS flow cookie : {self.aws_flow_cookie})")
-        self.logger.info(self)
-        self.full_init = True
+        # flows are logged only when they are not exported
+        if not self.tracker.exporter and self.tracker.logger.isEnabledFor(logging.INFO):
+            self.tracker.logger.info(
+                f"FLOW-TRACKER - New flow added (AWS flow cookie : {format_flow_cookie(self.aws_flow_cookie)})")
+            self.tracker.logger.info(self)
+
+    @classmethod
+    def from_record(cls, tracker, record, slot):
+        """
+        Builds a flow from its record in the shared flow table
+        :param record: (tuple) Record, as returned by flow_table.SharedFlowTable.lookup()
+        :param slot: (int) Slot of the record
+        :return: (Flow)
+        """
+        flow = cls.__new__(cls)
+        (_, flow.protocol, flow.aws_flow_cookie, flow.src_addr, flow.dst_addr, flow.src_port, flow.dst_port,
+         start_time, state_code, _, lastpacket_time, flow.pkts_sent, flow.pkts_received, flow.bytes_sent,
+         flow.bytes_received) = record
+        flow.tracker = tracker
+        flow.state = TCP_STATES.get(state_code)
+        if flow.protocol == 6 and flow.state is None:
+            # flow recorded by a previous version, not seen starting with a SYN : handled as an established one
+            flow.state = 'RUN'
+        flow.start_timestamp = start_time - tracker.clock_offset
+        flow.lastpacket_timestamp = lastpacket_time - tracker.clock_offset
+        flow.expires = flow.lastpacket_timestamp + flow_timeout(flow.protocol, flow.state)
+        flow.wheel_tick = None
+        flow.slot = slot
+        flow.sampling_rate = tracker.flow_sampling
+        flow.allowed = True
+        return flow
+
+    def update_established(self, flow_packet):
+        """
+        Fast path of the packets which don't change the state of their flow : packets of UDP and ICMP flows, and of
+        TCP flows in RUN state without FIN, SYN or RST bit. The counters are updated from the inner IPv4 total length
+        and the TCP flags and data offset bytes, read directly in the raw packet, so the inner headers objects are not
+        built
+        :return: (bool) False if the packet has to go through update_flow
+        """
+        protocol = self.protocol
+        if protocol == 6 and self.state != 'RUN':
+            return False
+        data = flow_packet.raw_data
+        inner_start = flow_packet.inner_start
+        total_length, src_addr, dst_addr = INNER_IPV4_FIELDS.unpack_from(data, inner_start)
+        l4_start = inner_start + (data[inner_start] & 0x0F) * 4
+        if protocol == 6:
+            if data[l4_start + 13] & TCP_STATE_FLAGS:
+                return False
+            payload_length = total_length - (l4_start - inner_start) - (data[l4_start + 12] >> 4) * 4
+        elif protocol == 17:
+            payload_length = total_length - (l4_start - inner_start) - 8
+        else:
+            payload_length = 0
+
+        if dst_addr == self.dst_addr:
+            self.pkts_sent += 1
+            self.bytes_sent += payload_length
+        elif dst_addr == self.src_addr:
+            self.pkts_received += 1
+            self.bytes_received += payload_length
+        else:
+            # reported by update_flow
+            return False
+        self.lastpacket_timestamp = monotonic()
+        self.expires = self.lastpacket_timestamp + flow_timeout(protocol, self.state)
+        if self.slot is not None:
+            self.tracker.flow_table.update(self, self.slot, self.tracker.clock_offset)
+        if self.tracker.logger.isEnabledFor(logging.DEBUG):
+            self.tracker.logger.debug(
+                f"FLOW-TRACKER - Updated flow statistics for flow cookie {format_flow_cookie(self.aws_flow_cookie)}")
+        return True
 
     def update_flow(self, flow_packet):
-        if flow_packet.inner_ipv4.dst_addr_str == self.dst_addr:
+        dst_addr = flow_packet.inner_addresses[1]
+        if dst_addr == self.dst_addr:
             self.pkts_sent += 1
             self.bytes_sent += flow_packet.inner_l4.payload_length
-        elif flow_packet.inner_ipv4.dst_addr_str == self.src_addr:
+        elif dst_addr == self.src_addr:
             self.pkts_received += 1
             self.bytes_received += flow_packet.inner_l4.payload_length
         else:
-            self.logger.error(
-                f"FLOW-TRACKER - Error matching flow while trying to update statistics for flow cookie {flow_packet.geneve.flow_cookie}")
+            self.tracker.logger.error(
+                f"FLOW-TRACKER - Error matching flow while trying to update statistics for flow cookie "
+                f"{format_flow_cookie(self.aws_flow_cookie)}")
             return 0
 
         if self.protocol == 6:
             if self.state == 'FINACK':
                 if (flow_packet.inner_l4.ack or flow_packet.inner_l4.rst) and not flow_packet.inner_l4.syn:
-                    self.state = 'CLOSED'
-                    self.logger.info(f"FLOW-TRACKER - Flow {flow_packet.geneve.flow_cookie} TCP moved to CLOSED state")
+                    self.set_state('CLOSED')
+                    if self.tracker.logger.isEnabledFor(logging.INFO):
+                        self.tracker.logger.info(
+                            f"FLOW-TRACKER - Flow {format_flow_cookie(self.aws_flow_cookie)} TCP moved to CLOSED state")
                     if config.TCP_IMMEDIATE_CLEAN:
-                        self.tracker.delete_flow(self.aws_flow_cookie)
+                        self.tracker.delete_flow(self, END_TCP_CLOSED)
             elif self.state == 'FIN':
                 if flow_packet.inner_l4.fin and flow_packet.inner_l4.ack:
-                    self.state = 'FINACK'
+                    self.set_state('FINACK')
             elif self.state == 'RUN':
                 if flow_packet.inner_l4.fin:
-                    self.state = 'FIN'
+                    self.set_state('FIN')
             elif self.state == 'SYNACK':
                 if flow_packet.inner_l4.ack and not flow_packet.inner_l4.syn and not flow_packet.inner_l4.rst:
-                    self.state = 'RUN'
-                    self.logger.info(f"FLOW-TRACKER - Flow {flow_packet.geneve.flow_cookie} TCP moved to RUN state")
+                    self.set_state('RUN')
+                    if self.tracker.logger.isEnabledFor(logging.INFO):
+                        self.tracker.logger.info(
+                            f"FLOW-TRACKER - Flow {format_flow_cookie(self.aws_flow_cookie)} TCP moved to RUN state")
             elif self.state == 'SYN':
                 if flow_packet.inner_l4.syn and flow_packet.inner_l4.ack:
-                    self.state = 'SYNACK'
-        self.lastpacket_timestamp = math.floor(datetime.datetime.utcnow().timestamp())
-        self.logger.debug(f"FLOW-TRACKER - Updated flow statistics for flow cookie {flow_packet.geneve.flow_cookie}")
+                    self.set_state('SYNACK')
+        self.lastpacket_timestamp = monotonic()
+        # the flow is not moved in the timer wheel : the new expiry time is checked when its current tick comes
+        self.expires = self.lastpacket_timestamp + flow_timeout(self.protocol, self.state)
+        if self.slot is not None:
+            self.tracker.flow_table.update(self, self.slot, self.tracker.clock_offset)
+        if self.tracker.logger.isEnabledFor(logging.DEBUG):
+            self.tracker.logger.debug(
+                f"FLOW-TRACKER - Updated flow statistics for flow cookie {format_flow_cookie(self.aws_flow_cookie)}")
+
+    def set_state(self, state):
+        self.tracker.flow_state_changed(self, state)
+        self.state = state
+
+    @property
+    def src_addr_str(self):
+        return socket.inet_ntoa(self.src_addr.to_bytes(4, 'big'))
+
+    @property
+    def dst_addr_str(self):
+        return socket.inet_ntoa(self.dst_addr.to_bytes(4, 'big'))
 
     def __repr__(self):
-        return f"Flow {self.aws_flow_cookie} - IP {self.protocol} - SRC {self.src_addr}:{self.src_port} - DST {self.dst_addr}:{self.dst_port} - " \
+        return f"Flow {format_flow_cookie(self.aws_flow_cookie)} - IP {self.protocol} - SRC {self.src_addr_str}:{self.src_port} - DST {self.dst_addr_str}:{self.dst_port} - " \
                f"Pkts/bytes sent {self.pkts_sent}/{self.bytes_sent} - Pkts/bytes received {self.pkts_received}/{self.bytes_received} - State {self.state}"
 
-    def __del__(self):
-        if self.full_init:
-            self.logger.info(f"FLOW-TRACKER - Post-deletion info for flow {self.aws_flow_cookie}")
-            self.logger.info(self)
 
 class FlowTracker:
-    def __init__(self, logger):
+    """
+    Tracks the flows seen in the Geneve packets, indexed by AWS flow cookie
+
+    Flows are expired by a cleaning thread using a timer wheel, so each run only handles the flows which are due
+    instead of scanning the whole table. The flows table and the wheel are protected by a lock, as flows are added
+    and deleted by the packets processing thread.
+    Each flow removal is an end-of-flow event : the flow is handed to the exporter (flow_export.FlowExporter) if any,
+    or logged otherwise.
+    flow_counts keeps the number of tracked flows by (protocol, state). It is updated with the lock held.
+
+    With a shared flow table (flow_table.SharedFlowTable), each tracked flow also has a record in the table, updated
+    on each of its packets. A packet of a flow which is not tracked by this process is first looked up in the table :
+    a flow tracked by a previous process, or by another worker, is taken over instead of being handled as a new one
+    (which would drop a TCP flow seen in the middle of the stream, with config.TCP_NONSYN_BLOCK). The flows are left
+    in the table when the tracker is stopped, and a process only ends the flows it is still the owner of when they
+    expire. The records not tracked by any process anymore are expired by the cleaning thread, which checks the whole
+    table every config.FLOW_TABLE_SWEEP_INTERVAL seconds.
+
+    The number of tracked flows is bounded by max_flows : a new flow first evicts the oldest half-open (SYN / SYNACK)
+    flow, or the least recently used flow if there is none. The half-open flows have their own budget
+    (max_half_open_flows), a new half-open flow evicting the oldest one when it is used, and the half-open flows are
+    also evicted after config.TCP_SYN_FLOOD_TIMEOUT once half of the budget is used. The evicted flows are ended with
+    the END_EVICTED reason, and counted by EVICTION_REASONS.
+    The flows other than the half-open ones are kept in least recently used order (established_flows, with their
+    packets count when they were queued) with a second chance policy : a flow which has seen a packet since it was
+    queued is queued again instead of being evicted, so the order is not updated on each packet.
+
+    With a flow sampling rate N (flow_sampling), only 1 in N flows are tracked, selected by a hash of their AWS flow
+    cookie, so that the packets of the other flows cost a dict lookup instead of a flow update. With a packet sampling
+    rate M (packet_sampling), 1 in M packets of the flows which are not tracked are counted, as M packets of the same
+    L4 payload length (untracked_packets and untracked_bytes). The rates can be changed at any time with
+    set_sampling() (see SamplingControl) : the flows already tracked are kept until they end, and a flow whose hash is
+    a multiple of k * N is also a multiple of N, so multiplying the rate keeps tracking a subset of the new flows
+    tracked before. As the flows selected after any other change may have started before, config.TCP_NONSYN_BLOCK is
+    not applied for config.TCP_FLOW_TIMEOUT seconds after that (the flows which have not sent a packet for that long
+    have expired anyway), and it never applies to the flows which are not tracked.
+    """
+
+    def __init__(self, logger, exporter=None, flow_table=None, max_flows=config.MAX_FLOWS,
+                 max_half_open_flows=config.MAX_HALF_OPEN_FLOWS, flow_sampling=config.FLOW_SAMPLING,
+                 packet_sampling=config.PACKET_SAMPLING):
+        """
+        :param flow_table: (flow_table.SharedFlowTable) Shared flow table, closed when the tracker is stopped
+        :param max_flows: (int) Maximum number of tracked flows, 0 for no limit
+        :param max_half_open_flows: (int) Maximum number of half-open TCP flows, 0 for no dedicated budget
+        :param flow_sampling: (int) 1 in flow_sampling flows are tracked, 1 to track all the flows
+        :param packet_sampling: (int) 1 in packet_sampling packets of the flows which are not tracked are counted, 0 to
+        count none
+        """
         self.tracked_flows = dict()
+        self.half_open_flows = OrderedDict()
+        self.established_flows = OrderedDict()
+        self.max_flows = max_flows
+        self.max_half_open_flows = max_half_open_flows
+        self.evictions = dict.fromkeys(EVICTION_REASONS, 0)
+        self.flow_memory = estimate_flow_memory()
+        # rates set when the tracker is started, restored when the sampling control file is removed
+        self.initial_sampling = (flow_sampling, packet_sampling)
+        self.flow_sampling = flow_sampling
+        self.packet_sampling = packet_sampling
+        self.packet_countdown = packet_sampling
+        self.untracked_packets = 0
+        self.untracked_bytes = 0
+        # time (time.monotonic() value) from which the first packet of a TCP flow has to be a SYN again
+        self.nonsyn_block_from = 0
         self.logger = logger
+        self.exporter = exporter
+        self.flow_table = flow_table
+        self.flow_counts = dict()
+        self.lock = threading.Lock()
+        self.wheel = TimerWheel(monotonic())
+        # the shared flow table timestamps are seconds since epoch
+        self.clock_offset = time() - monotonic()
+        self.flows_taken_over = 0
+        self.flow_table_full = 0
+        if flow_table:
+            # number of slots checked by each cleaning thread run
+            self.sweep_slots = int(-(-flow_table.slots_count * self.wheel.resolution
+                                     // config.FLOW_TABLE_SWEEP_INTERVAL))
+        if max_flows:
+            self.logger.info(f"FLOW-TRACKER - Up to {max_flows} tracked flows (about "
+                             f"{max_flows * self.flow_memory >> 20} MB)")
+        if flow_sampling > 1:
+            self.logger.info(f"FLOW-TRACKER - Tracking 1 in {flow_sampling} flows"
+                             + (f", counting 1 in {packet_sampling} packets of the others" if packet_sampling else ""))
         self.logger.info("FlowTracker initialized")
         cleaner_thread = threading.Thread(target=self.tracker_cleaner)
         cleaner_thread.daemon = True
@@ -96,26 +370,355 @@ class FlowTracker:
         self.logger.info("FLOW-TRACKER - Cleaning thread initialized")
 
     def update_flow(self, flow_packet):
-        if flow_packet.geneve.flow_cookie not in self.tracked_flows:
-            self.tracked_flows[flow_packet.geneve.flow_cookie] = Flow(self.logger, flow_packet, self)
+        """
+        :param flow_packet: (rawpacket.RawPacket) Received packet
+        :return: (bool) False if the packet has to be dropped : first packet of a TCP flow which is not a SYN, with
+        config.TCP_NONSYN_BLOCK
+        """
+        # the tracked flows are indexed by the integer value of the AWS flow cookie
+        flow_cookie = flow_packet.flow_cookie
+        if flow_cookie is None:
+            self.logger.warning("FLOW-TRACKER - Received packet without AWS flow cookie option")
+            return True
+        flow = self.tracked_flows.get(flow_cookie)
+        if flow is None:
+            if self.flow_sampling > 1 and flow_sampling_hash(flow_cookie) % self.flow_sampling:
+                # flow not sampled
+                if self.packet_sampling:
+                    self.packet_countdown -= 1
+                    if self.packet_countdown <= 0:
+                        self.sample_packet(flow_packet)
+                return True
+            if self.flow_table and self.take_over(flow_cookie, flow_packet):
+                return True
+            flow = Flow(flow_packet, self, flow_cookie)
+            if flow.state == 'BLOCKED':
+                return False
+            with self.lock:
+                self.track(flow)
+                if self.flow_table:
+                    flow.slot = self.flow_table.insert(flow, self.clock_offset)
+                    if flow.slot is None:
+                        # the flow is only tracked by this process
+                        self.flow_table_full += 1
+        elif not flow.update_established(flow_packet):
+            # new state, or state transition
+            flow.update_flow(flow_packet)
+        return True
+
+    def sample_packet(self, flow_packet):
+        """
+        Counts a sampled packet of a flow which is not tracked, as packet_sampling packets of its length. The bytes are
+        the inner L4 payload, as in the counters of the tracked flows
+        :param flow_packet: (rawpacket.RawPacket) Sampled packet
+        :return:
+        """
+        self.packet_countdown = self.packet_sampling
+        self.untracked_packets += self.packet_sampling
+        self.untracked_bytes += flow_packet.inner_l4.payload_length * self.packet_sampling
+
+    def set_sampling(self, flow_sampling, packet_sampling):
+        """
+        Changes the sampling rates. The flows already tracked are kept until they end
+        :param flow_sampling: (int) 1 in flow_sampling new flows are tracked
+        :param packet_sampling: (int) 1 in packet_sampling packets of the flows which are not tracked are counted, 0 to
+        count none
+        :return:
+        """
+        if flow_sampling % self.flow_sampling:
+            # unless the new rate is a multiple of the current one, flows which are already running are going to be
+            # tracked
+            self.nonsyn_block_from = monotonic() + config.TCP_FLOW_TIMEOUT
+        self.flow_sampling = flow_sampling
+        self.packet_sampling = packet_sampling
+        self.packet_countdown = min(self.packet_countdown, packet_sampling) or packet_sampling
+        self.logger.warning(f"FLOW-TRACKER - Tracking 1 in {flow_sampling} flows, counting "
+                            + (f"1 in {packet_sampling}" if packet_sampling else "none of the")
+                            + " packets of the others")
+
+    def take_over(self, flow_cookie, flow_packet):
+        """
+        Starts tracking a flow found in the shared flow table
+        :return: (Flow) The flow, None if it is not in the table (or if it has expired)
+        """
+        with self.lock:
+            slot, record = self.flow_table.lookup(flow_cookie)
+            if slot is None:
+                return None
+            flow = Flow.from_record(self, record, slot)
+            if flow.expires <= monotonic():
+                # ended flow not removed yet : its record is replaced by the new flow one
+                return None
+            self.track(flow)
+            self.flows_taken_over += 1
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(f"FLOW-TRACKER - Flow {format_flow_cookie(flow_cookie)} taken over from the shared flow "
+                             f"table")
+        flow.update_flow(flow_packet)
+        return flow
+
+    def track(self, flow):
+        """
+        Adds a flow to the tracked flows, after evicting other flows if the limits are reached. Must be called with
+        the lock held
+        :param flow: (Flow) New flow
+        :return:
+        """
+        half_open = flow.protocol == 6 and flow.state in HALF_OPEN_STATES
+        if half_open and self.max_half_open_flows and len(self.half_open_flows) >= self.max_half_open_flows:
+            self.evict(next(iter(self.half_open_flows.values())), 'half_open_budget')
+        if self.max_flows and len(self.tracked_flows) >= self.max_flows:
+            self.evict_one()
+        if half_open:
+            self.half_open_flows[flow.aws_flow_cookie] = flow
         else:
-            self.tracked_flows.get(flow_packet.geneve.flow_cookie).update_flow(flow_packet)
+            self.established_flows[flow.aws_flow_cookie] = flow.pkts_sent + flow.pkts_received
+        self.tracked_flows[flow.aws_flow_cookie] = flow
+        self.count_flow(flow.protocol, flow.state, 1)
+        flow.wheel_tick = self.wheel.schedule(flow.aws_flow_cookie, flow.expires)
+
+    def untrack(self, flow):
+        """
+        Removes a flow from the tracked flows. Must be called with the lock held
+        :return:
+        """
+        del(self.tracked_flows[flow.aws_flow_cookie])
+        self.count_flow(flow.protocol, flow.state, -1)
+        if self.half_open_flows.pop(flow.aws_flow_cookie, None) is None:
+            self.established_flows.pop(flow.aws_flow_cookie, None)
+
+    def evict_one(self):
+        """
+        Evicts the oldest half-open flow, or the least recently used flow if there is none. Must be called with the
+        lock held
+        :return:
+        """
+        if self.half_open_flows:
+            self.evict(next(iter(self.half_open_flows.values())), 'max_flows_half_open')
+            return
+        while self.established_flows:
+            flow_cookie, queued_pkts = self.established_flows.popitem(last=False)
+            flow = self.tracked_flows[flow_cookie]
+            if flow.pkts_sent + flow.pkts_received != queued_pkts:
+                # second chance : the flow has seen a packet since it was queued
+                self.established_flows[flow_cookie] = flow.pkts_sent + flow.pkts_received
+            else:
+                self.evict(flow, 'max_flows_lru')
+                return
+
+    def evict(self, flow, reason):
+        """
+        Ends a tracked flow before it expires. Must be called with the lock held
+        :param reason: (str) One of EVICTION_REASONS
+        :return:
+        """
+        self.untrack(flow)
+        if flow.slot is not None:
+            self.flow_table.remove(flow.aws_flow_cookie, flow.slot)
+            flow.slot = None
+        self.evictions[reason] += 1
+        self.end_flow(flow, END_EVICTED)
+
+    def evict_half_open(self, now):
+        """
+        Evicts the half-open flows older than config.TCP_SYN_FLOOD_TIMEOUT, if half of the half-open budget is used.
+        Must be called with the lock held
+        :param now: (float) Current time (time.monotonic() value)
+        :return: (int) Number of evicted flows
+        """
+        evicted_count = 0
+        if not self.max_half_open_flows or len(self.half_open_flows) < self.max_half_open_flows // 2:
+            return evicted_count
+        deadline = now - config.TCP_SYN_FLOOD_TIMEOUT
+        # the half-open flows are ordered by start time
+        while self.half_open_flows:
+            flow = next(iter(self.half_open_flows.values()))
+            if flow.start_timestamp > deadline:
+                break
+            self.evict(flow, 'half_open_timeout')
+            evicted_count += 1
+        return evicted_count
+
+    @property
+    def memory_usage(self):
+        """
+        :return: (int) Estimated memory used by the tracked flows, in bytes
+        """
+        return len(self.tracked_flows) * self.flow_memory
 
     def tracker_cleaner(self):
         while True:
-            sleep(min(config.FLOW_TIMEOUT, config.TCP_FLOW_TIMEOUT))
-            removable_flows_cookies = [
-                x for x, y in self.tracked_flows.items()
-                if y.lastpacket_timestamp < math.floor(datetime.datetime.utcnow().timestamp()) - config.FLOW_TIMEOUT
-                and y.protocol != 6]
-            removable_flows_cookies.extend([
-                x for x, y in self.tracked_flows.items()
-                if y.lastpacket_timestamp < math.floor(datetime.datetime.utcnow().timestamp()) - config.TCP_FLOW_TIMEOUT
-                and y.protocol == 6
-            ])
-            for flow_cookie in removable_flows_cookies:
-                del(self.tracked_flows[flow_cookie])
-            self.logger.info("FLOW-TRACKER - Cleaning thread run ended")
-
-    def delete_flow(self, flow_cookie):
-        del(self.tracked_flows[flow_cookie])
\ No newline at end of file
+            sleep(self.wheel.resolution)
+            now = monotonic()
+            expired_count = 0
+            with self.lock:
+                for tick, flows_cookies in self.wheel.advance(now):
+                    for flow_cookie in flows_cookies:
+                        flow = self.tracked_flows.get(flow_cookie)
+                        # deleted flow, or flow re-created and scheduled at another tick since
+                        if flow is None or flow.wheel_tick != tick:
+                            continue
+                        if flow.expires <= now:
+                            self.untrack(flow)
+                            # the flow may have been taken over by another process since its last packet here
+                            if flow.slot is None or self.flow_table.remove(flow_cookie, flow.slot, owned_only=True):
+                                self.end_flow(flow, END_TIMEOUT)
+                                expired_count += 1
+                        else:
+                            flow.wheel_tick = self.wheel.schedule(flow_cookie, flow.expires)
+                expired_count += self.evict_half_open(now)
+                if self.flow_table:
+                    expired_count += self.sweep_flow_table(now)
+            if expired_count:
+                self.logger.info(f"FLOW-TRACKER - Cleaning thread run ended ({expired_count} flows expired)")
+
+    def sweep_flow_table(self, now):
+        """
+        Ends the flows of the next slots of the shared flow table which expired without being tracked by any process
+        (left by a stopped process, and not taken over). Must be called with the lock held
+        :param now: (float) Current time (time.monotonic() value)
+        :return: (int) Number of expired flows
+        """
+        # the processes tracking the flows are given some time to expire them first
+        deadline = now + self.clock_offset - 2 * self.wheel.resolution
+
+        def is_expired(record):
+            protocol, flow_cookie, state_code, lastpacket_time = record[1], record[2], record[8], record[10]
+            return flow_cookie not in self.tracked_flows \
+                and lastpacket_time + flow_timeout(protocol, TCP_STATES.get(state_code)) <= deadline
+
+        expired = self.flow_table.sweep(self.sweep_slots, is_expired)
+        for record in expired:
+            self.end_flow(Flow.from_record(self, record, None), END_TIMEOUT)
+        return len(expired)
+
+    def delete_flow(self, flow, end_reason=END_TCP_CLOSED):
+        """
+        Ends a tracked flow before it expires
+        :param flow: (Flow) Flow to end
+        :param end_reason: (int) One of the flow_export.END_* values
+        :return:
+        """
+        with self.lock:
+            # the flow may have expired or been evicted by the cleaning thread in the meantime
+            if self.tracked_flows.get(flow.aws_flow_cookie) is not flow:
+                return
+            self.untrack(flow)
+            if flow.slot is not None:
+                self.flow_table.remove(flow.aws_flow_cookie, flow.slot)
+                flow.slot = None
+        self.end_flow(flow, end_reason)
+
+    def count_flow(self, protocol, state, delta):
+        """
+        Updates the number of tracked flows for a protocol and state. Must be called with the lock held
+        :return:
+        """
+        self.flow_counts[(protocol, state)] = self.flow_counts.get((protocol, state), 0) + delta
+
+    def flow_state_changed(self, flow, state):
+        """
+        Moves a flow to the count of its new state, and out of the half-open flows once established
+        :param state: (str) New state of the flow
+        :return:
+        """
+        with self.lock:
+            # the flow may have expired in the meantime
+            if self.tracked_flows.get(flow.aws_flow_cookie) is flow:
+                self.count_flow(flow.protocol, flow.state, -1)
+                self.count_flow(flow.protocol, state, 1)
+                if state not in HALF_OPEN_STATES and self.half_open_flows.pop(flow.aws_flow_cookie, None):
+                    self.established_flows[flow.aws_flow_cookie] = flow.pkts_sent + flow.pkts_received
+
+    def end_flow(self, flow, end_reason):
+        """
+        Reports a flow which has been removed from the tracked flows
+        :param end_reason: (int) One of the flow_export.END_* values
+        :return:
+        """
+        if self.exporter:
+            self.exporter.export(flow, end_reason)
+        elif self.logger.isEnabledFor(logging.INFO):
+            sampling = f", 1 in {flow.sampling_rate} flows tracked" if flow.sampling_rate > 1 else ""
+            self.logger.info(f"FLOW-TRACKER - End of flow {format_flow_cookie(flow.aws_flow_cookie)} "
+                             f"({END_REASONS[end_reason]}{sampling})")
+            self.logger.info(flow)
+
+    def stop(self):
+        """
+        Ends all the tracked flows (or leaves them in the shared flow table), and stops the exporter
+        :return:
+        """
+        with self.lock:
+            flows = list(self.tracked_flows.values())
+            self.tracked_flows.clear()
+            self.half_open_flows.clear()
+            self.established_flows.clear()
+            self.flow_counts.clear()
+            flow_table, self.flow_table = self.flow_table, None
+        if flow_table:
+            # the flows will be ended by the process taking them over, or when they expire
+            self.logger.warning(f"FLOW-TRACKER - {len(flows)} flows left in the shared flow table {flow_table.path}")
+            flow_table.close()
+        else:
+            for flow in flows:
+                self.end_flow(flow, END_SHUTDOWN)
+        if self.exporter:
+            self.exporter.stop()
+
+
+class SamplingControl:
+    """
+    Sampling rates of a flow tracker, changed at runtime through a control file
+
+    The file holds the flow sampling rate N, optionally followed by the packet sampling rate M (e.g. "16 4"). It is
+    checked every config.SAMPLING_CONTROL_INTERVAL seconds, and the rates are applied when it has been modified
+    (including when it exists at startup). The initial rates of the tracker are restored when the file is removed.
+    """
+
+    def __init__(self, logger, tracker, path):
+        """
+        :param tracker: (FlowTracker) Flow tracker whose sampling rates are controlled
+        :param path: (str) Control file
+        """
+        self.logger = logger
+        self.tracker = tracker
+        self.path = path
+        # modification time of the file when it was last applied, None if it doesn't exist
+        self.mtime = None
+        self.next_check = 0
+
+    def check_due(self):
+        return monotonic() >= self.next_check
+
+    def check(self):
+        """
+        Applies the rates of the control file if it has been modified or removed since the last check
+        :return:
+        """
+        self.next_check = monotonic() + config.SAMPLING_CONTROL_INTERVAL
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        if mtime is None:
+            self.logger.warning(f"FLOW-TRACKER - Sampling control file {self.path} removed, restoring the initial "
+                                f"sampling rates")
+            self.tracker.set_sampling(*self.tracker.initial_sampling)
+            return
+        try:
+            with open(self.path) as f:
+                values = f.read().split()
+            if not 1 <= len(values) <= 2:
+                raise ValueError("expected 'N' or 'N M'")
+            flow_sampling = int(values[0])
+            packet_sampling = int(values[1]) if len(values) == 2 else self.tracker.packet_sampling
+            if flow_sampling < 1 or packet_sampling < 0:
+                raise ValueError("N must be at least 1, and M can't be negative")
+        except (OSError, ValueError) as e:
+            self.logger.error(f"FLOW-TRACKER - Invalid sampling control file {self.path} : {e}")
+            return
+        self.tracker.set_sampling(flow_sampling, packet_sampling)
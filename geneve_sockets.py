@@ -0,0 +1,216 @@
+import ctypes
+import os
+import socket
+import struct
+import config
+
+# Linux constants which are not exposed by the socket module
+ETH_P_IP = 0x0800
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_STATISTICS = 6
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+SO_SNDBUFFORCE = 32
+SO_RCVBUFFORCE = 33
+SO_RXQ_OVFL = 40
+SO_ATTACH_FILTER = 26
+PACKET_IGNORE_OUTGOING = 23
+# classic BPF ancillary data offset of the packet type (SKF_AD_OFF + SKF_AD_PKTTYPE)
+SKF_AD_PKTTYPE = 0xFFFFF000 + 4
+
+# ancillary data buffer size needed to receive the SO_RXQ_OVFL counter (an unsigned 32-bits integer)
+RXQ_OVFL_CMSG_SIZE = socket.CMSG_SPACE(4)
+RXQ_OVFL_COUNTER = struct.Struct('I')
+
+
+def set_buffer_sizes(sock, rcvbuf=0, sndbuf=0):
+    """
+    Sets the receive and send buffer sizes of a socket. When running as root, SO_RCVBUFFORCE / SO_SNDBUFFORCE are used
+    so that the net.core.rmem_max / net.core.wmem_max limits do not apply
+    :param rcvbuf: (int) Receive buffer size in bytes. 0 keeps the current size
+    :param sndbuf: (int) Send buffer size in bytes. 0 keeps the current size
+    :return: (tuple) (receive buffer size, send buffer size) granted by the kernel (which doubles the requested
+             values, to account for its own bookkeeping overhead)
+    """
+    for size, option, force_option in ((rcvbuf, socket.SO_RCVBUF, SO_RCVBUFFORCE),
+                                       (sndbuf, socket.SO_SNDBUF, SO_SNDBUFFORCE)):
+        if not size:
+            continue
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, force_option if os.geteuid() == 0 else option, size)
+        except PermissionError:
+            # root without CAP_NET_ADMIN (e.g. in a container) : the size is capped by the sysctl limits
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
+
+def build_raw_socket():
+    """
+    Builds the raw socket used to receive the Geneve packets, and to send them back
+    :return: (socket) Raw IP socket, with IP_HDRINCL enabled
+    """
+    raw_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
+    # IP_HDRINCL permits to ask the system that we want to receive (and create) our own IP/UDP headers
+    # this is needed as Geneve requires that we send back the "routed" traffic on the GENEVE_PORT (src/dst ports
+    # are not swapped)
+    raw_socket.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+    raw_socket.bind(('0.0.0.0', 0))
+    return raw_socket
+
+
+def build_raw_send_socket():
+    """
+    Builds a send-only raw socket. IPPROTO_RAW implies IP_HDRINCL, and such a socket never receives any packet
+    :return: (socket) Raw IP socket
+    """
+    return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+
+
+def build_udp_socket(reuse_port=False):
+    """
+    Builds the UDP socket used to receive the Geneve payloads if started with the --udp-only parameter (replacing the
+    raw socket)
+
+    Using this mode permits to start without root privileges, but it has an impact in the way Geneve packets will
+    be sent back to the GWLB : when sending using a binded SOCK_DGRAM socket, the source port of the sent packets
+    will always be the port used for the bind. Then, Geneve packets will be sent to port 6081, with a source port
+    of 6081. AWS could block it at some time (this is even weird that it works actually)
+    :param reuse_port: (bool) Sets SO_REUSEPORT, so that multiple workers can bind the GENEVE_PORT. The kernel then
+                       spreads the datagrams across those sockets using a hash of the outter 4-tuple, so all the
+                       packets of a GWLB flow are received by the same worker
+    :return: (socket) UDP socket bound to the GENEVE_PORT
+    """
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    udp_socket.bind(('0.0.0.0', config.GENEVE_PORT))
+    return udp_socket
+
+
+def geneve_bpf_filter():
+    """
+    Builds the classic BPF program equivalent to "udp dst port config.GENEVE_PORT and not outbound", for a SOCK_DGRAM
+    packet socket (where the program offsets are relative to the IP header). The packets sent by the host (including
+    our own responses, which are sent to the GENEVE_PORT) are rejected, and so are the non-first fragments, as they
+    don't contain the UDP header.
+    :return: (list) List of (code, jt, jf, k) sock_filter instructions
+    """
+    return [
+        (0x20, 0, 0, SKF_AD_PKTTYPE),       # ld pkttype               packet type
+        (0x15, 7, 0, 4),                    # jeq #OUTGOING, drop, next
+        (0x30, 0, 0, 9),                    # ldb [9]                  IP protocol
+        (0x15, 0, 5, 17),                   # jeq #17, next, drop      UDP
+        (0x28, 0, 0, 6),                    # ldh [6]                  flags + fragment offset
+        (0x45, 3, 0, 0x1FFF),               # jset #0x1fff, drop, next
+        (0xB1, 0, 0, 0),                    # ldxb 4*([0]&0xf)         IP header length
+        (0x48, 0, 0, 2),                    # ldh [x + 2]              UDP destination port
+        (0x15, 1, 0, config.GENEVE_PORT),   # jeq #GENEVE_PORT, accept, drop
+        (0x06, 0, 0, 0),                    # drop: ret #0
+        (0x06, 0, 0, 0x40000),              # accept: ret #262144
+    ]
+
+
+def attach_filter(sock, instructions):
+    """
+    Attaches a classic BPF program to a socket (SO_ATTACH_FILTER)
+    :param instructions: (list) List of (code, jt, jf, k) sock_filter instructions
+    """
+    program = ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *i) for i in instructions))
+    # struct sock_fprog : instructions count, pointer to the instructions. The kernel copies the program, so the
+    # buffer only needs to live until setsockopt returns
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                    struct.pack('HL', len(instructions), ctypes.addressof(program)))
+
+
+def build_packet_socket(fanout_group):
+    """
+    Builds an AF_PACKET socket receiving the IP packets (without link-layer header, as SOCK_DGRAM is used) and joins it
+    to a PACKET_FANOUT_HASH group. The kernel then dispatches each packet to one of the sockets of the group, based on
+    the flow hash of the outter headers, so all the packets of a GWLB flow are received by the same worker.
+
+    This socket is used in raw mode when running multiple workers, as raw IP sockets can't share the traffic (each raw
+    socket receives a copy of every packet). It can only receive : responses are sent using a raw IP socket.
+    The Geneve classic BPF filter is attached before joining the group, so only the incoming Geneve packets are copied
+    to the socket by the kernel.
+    :param fanout_group: (int) 16-bits fanout group ID, shared by all the workers
+    :return: (socket) AF_PACKET socket
+    """
+    packet_socket = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+    attach_filter(packet_socket, geneve_bpf_filter())
+    # the DEFRAG flag makes the kernel reassemble IP fragments before hashing, so that all the fragments of a packet
+    # are received by the same socket. The option value doesn't fit in a signed int, so it is given as raw bytes
+    packet_socket.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                             struct.pack('I', fanout_group | ((PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG) << 16)))
+    return packet_socket
+
+
+def build_geneve_sockets(udp_only, fanout_group=None):
+    """
+    Builds the sockets used to receive and send back the Geneve packets
+    :param udp_only: (bool) Use an UDP socket bound to the GENEVE_PORT instead of the raw socket
+    :param fanout_group: (int) If set, the sockets are built to share the traffic with other workers
+    :return: (tuple) (receive socket, send socket). Both are the same socket unless an AF_PACKET socket is used
+    """
+    if udp_only:
+        udp_socket = build_udp_socket(reuse_port=fanout_group is not None)
+        return udp_socket, udp_socket
+    if fanout_group is not None:
+        return build_packet_socket(fanout_group), build_raw_send_socket()
+    raw_socket = build_raw_socket()
+    return raw_socket, raw_socket
+
+
+class KernelDrops:
+    """
+    Total number of packets dropped by the kernel for a receive socket, because its receive queue was full
+
+    With SO_RXQ_OVFL enabled, the kernel attaches its cumulative drops counter for the socket to the received packets,
+    as ancillary data : this counter is given to update() by the receive loop. It is only delivered with the packets,
+    so the drops are seen when the next packet is received.
+    The PACKET_MMAP ring is not read with recvmsg : its drops are read with PACKET_STATISTICS instead (with statistics),
+    which resets the kernel counter on each read.
+    """
+
+    def __init__(self, sock, statistics=False):
+        """
+        :param sock: (socket) Receive socket
+        :param statistics: (bool) Read the counter with PACKET_STATISTICS (AF_PACKET ring) instead of SO_RXQ_OVFL
+        """
+        self.socket = sock
+        self.statistics = statistics
+        self.drops = 0
+        self.counter = 0
+        self.reported = 0
+        if not statistics:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+
+    def update(self, ancdata):
+        """
+        :param ancdata: (list) Ancillary data returned by recvmsg / recvmsg_into
+        :return:
+        """
+        for level, cmsg_type, data in ancdata:
+            if level == socket.SOL_SOCKET and cmsg_type == SO_RXQ_OVFL:
+                counter = RXQ_OVFL_COUNTER.unpack_from(data)[0]
+                # the kernel counter is a 32-bits value, which may wrap
+                self.drops += (counter - self.counter) & 0xFFFFFFFF
+                self.counter = counter
+
+    def read(self):
+        """
+        :return: (int) Total number of packets dropped for the socket
+        """
+        if self.statistics:
+            # struct tpacket_stats(_v3) : packets, drops (, freeze queue count)
+            self.drops += struct.unpack_from('II', self.socket.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))[1]
+        return self.drops
+
+    def delta(self):
+        """
+        :return: (int) Number of packets dropped since the last call
+        """
+        drops = self.read()
+        delta = drops - self.reported
+        self.reported = drops
+        return delta
@@ -0,0 +1,378 @@
+import argparse
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import config
+import packet_builder
+from headers.geneve import extract_aws_options
+from replay import percentiles
+
+# Linux constants which are not exposed by the socket module
+IP_PKTINFO = 8
+IP_RECVTTL = 12
+# struct in_pktinfo : interface index, local address, header destination address
+IN_PKTINFO = struct.Struct('i4s4s')
+ANCILLARY_BUFFER_SIZE = socket.CMSG_SPACE(4) + socket.CMSG_SPACE(IN_PKTINFO.size)
+
+# send timestamp (time.perf_counter_ns()) written at the start of the inner payload of each packet
+MARKER = struct.Struct('!Q')
+PROTOCOLS = {"tcp": 6, "udp": 17, "icmp": 1}
+# packets sent between two reads of the returned packets
+SEND_BURST = 32
+
+
+class EmulatedFlow:
+    """
+    Inner flow sent through the router, as GWLB would do : each direction has its own Geneve payload template (with the
+    same AWS flow cookie), in which the send timestamp is written before sending it
+    """
+
+    def __init__(self, index, protocol, args):
+        self.protocol = protocol
+        self.flow_cookie = random.getrandbits(32)
+        # GWLB picks the outter source port from the flow hash
+        self.src_port = 49152 + index % 16384
+        client = f"10.100.{index >> 8 & 0xFF}.{index & 0xFF}"
+        server = f"10.200.{index >> 8 & 0xFF}.{index & 0xFF}"
+        client_port, server_port = 1024 + index % 60000, {6: 443, 17: 53, 1: 0}[protocol]
+        payload = bytes(max(args.size, MARKER.size))
+
+        def template(src_addr, dst_addr, src_port, dst_port, flags, data):
+            inner = packet_builder.inner_packet(protocol, src_addr, dst_addr, src_port, dst_port, flags, data)
+            return packet_builder.gwlb_packet(inner, self.flow_cookie, args.source, args.router, self.src_port,
+                                              args.gwlbe_id, args.attachment_id, args.vni, args.ttl)
+
+        if protocol == 1:
+            # echo identifier and sequence number
+            client_port, server_port = index & 0xFFFF, 1
+        self.handshake = list()
+        if protocol == 6:
+            # the first packet of a TCP flow has to be a SYN for the flow tracker
+            self.handshake = [
+                template(client, server, client_port, server_port, packet_builder.TCP_SYN, bytes(MARKER.size)),
+                template(server, client, server_port, client_port, packet_builder.TCP_SYN | packet_builder.TCP_ACK,
+                         bytes(MARKER.size)),
+                template(client, server, client_port, server_port, packet_builder.TCP_ACK, bytes(MARKER.size)),
+            ]
+        flags = packet_builder.TCP_ACK | packet_builder.TCP_PSH
+        self.packets = [
+            template(client, server, client_port, server_port, flags, payload),
+            template(server, client, server_port, client_port, flags, payload),
+        ]
+        # position of the marker in the whole packet, and in the returned Geneve payload (after outter IPv4 and UDP)
+        self.marker_offset = len(self.packets[0]) - len(payload)
+        self.payload_marker_offset = self.marker_offset - 28
+        self.expected = {bytes(p[28:28 + self.payload_marker_offset]) for p in self.handshake + self.packets}
+
+
+class StepStats:
+    """
+    Results of a load step
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.sent = 0
+        self.received = 0
+        # time spent sending the packets
+        self.elapsed_ns = 0
+        self.rtt = list()
+        self.invalid = {"ttl": 0, "addresses": 0, "ports": 0, "payload": 0}
+
+    @property
+    def lost(self):
+        return max(self.sent - self.received, 0)
+
+    @property
+    def loss_percent(self):
+        return self.lost * 100 / self.sent if self.sent else 0.0
+
+    def report(self):
+        """
+        :return: (list) Report lines
+        """
+        seconds = self.elapsed_ns / 1e9
+        lines = [f"GWLB-EMULATOR - Sent {self.sent} packets in {seconds:.1f}s "
+                 f"({self.sent / seconds if seconds else 0:.0f} pps, target {self.rate} pps) - "
+                 f"Received {self.received} - Lost {self.lost} ({self.loss_percent:.2f}%)"]
+        if self.rtt:
+            lines.append("GWLB-EMULATOR - Round-trip time : " + " - ".join(
+                f"{'max' if p == 100 else f'p{p:g}'} {value / 1000:.1f}us"
+                for p, value in percentiles(self.rtt, (50, 99, 99.9)).items()))
+        if any(self.invalid.values()):
+            lines.append("GWLB-EMULATOR - Invalid responses : " + " - ".join(
+                f"{reason} {count}" for reason, count in self.invalid.items()))
+        return lines
+
+
+class HealthCheckProbe(threading.Thread):
+    """
+    Sends HTTP requests to the router health-check port at a fixed interval, from a background thread
+    """
+
+    def __init__(self, address, port, interval):
+        super().__init__(name="health-check-probe", daemon=True)
+        self.address = address
+        self.port = port
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.durations = list()
+        self.failed = 0
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            start = time.perf_counter_ns()
+            try:
+                with socket.create_connection((self.address, self.port), timeout=config.HEALTH_CHECK_TIMEOUT) as s:
+                    s.sendall(b"GET / HTTP/1.1\r\nHost: geneve-router\r\nConnection: close\r\n\r\n")
+                    response = s.recv(1024)
+                if not response.startswith(b"HTTP/1.1 200"):
+                    raise OSError(response.split(b"\n", 1)[0])
+                self.durations.append(time.perf_counter_ns() - start)
+            except OSError:
+                self.failed += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def report(self):
+        line = f"GWLB-EMULATOR - Health-check : {len(self.durations) + self.failed} probes - {self.failed} failed"
+        if self.durations:
+            line += " - " + " - ".join(f"{'max' if p == 100 else f'p{p:g}'} {value / 1e6:.2f}ms"
+                                       for p, value in percentiles(self.durations, (50, 99)).items())
+        return line
+
+
+class GwlbEmulator:
+    """
+    Local stand-in for GWLB : sends Geneve-encapsulated flows to a running router, and checks the packets it sends back
+
+    Packets are sent from a raw socket (so each flow has its own outter UDP source port, as with GWLB), and the
+    returned packets are received on an UDP socket bound to config.GENEVE_PORT. For each returned packet, the outter
+    header is checked (addresses swapped, TTL decremented, ports unchanged, valid checksum : the kernel drops the
+    others), as well as the Geneve payload, and the round-trip time is computed from the send timestamp written in
+    the inner payload.
+    Sending and receiving are interleaved in a single thread, so the measures are not disturbed by another thread.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        protocols = [PROTOCOLS[p] for p in args.protocols.split(',')]
+        self.flows = [EmulatedFlow(i, protocols[i % len(protocols)], args) for i in range(args.flows)]
+        self.flows_by_cookie = {flow.flow_cookie: flow for flow in self.flows}
+
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        self.recv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+        self.recv_socket.setsockopt(socket.IPPROTO_IP, IP_RECVTTL, 1)
+        self.recv_socket.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        self.recv_socket.bind((args.source, config.GENEVE_PORT))
+        self.recv_socket.setblocking(False)
+        self.buffer = bytearray(config.BUFFER_SIZE)
+        self.source = socket.inet_aton(args.source)
+        self.router = socket.inet_aton(args.router)
+
+    def send(self, flow, packet, stats):
+        MARKER.pack_into(packet, flow.marker_offset, time.perf_counter_ns())
+        self.send_socket.sendto(packet, (self.args.router, 0))
+        stats.sent += 1
+
+    def receive(self, stats):
+        """
+        Reads all the returned packets available
+        """
+        while True:
+            try:
+                nbytes, ancdata, _, addr = self.recv_socket.recvmsg_into([self.buffer], ANCILLARY_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+            now = time.perf_counter_ns()
+            data = memoryview(self.buffer)[:nbytes]
+            cookie = extract_aws_options(data)[0]
+            flow = self.flows_by_cookie.get(cookie)
+            if flow is None or nbytes < flow.payload_marker_offset + MARKER.size:
+                stats.invalid["payload"] += 1
+                continue
+            stats.received += 1
+            ttl = destination = None
+            for level, cmsg_type, cmsg_data in ancdata:
+                if level == socket.IPPROTO_IP and cmsg_type == socket.IP_TTL:
+                    ttl = struct.unpack('i', cmsg_data)[0]
+                elif level == socket.IPPROTO_IP and cmsg_type == IP_PKTINFO:
+                    destination = IN_PKTINFO.unpack(cmsg_data)[2]
+            if ttl != self.args.ttl - 1:
+                stats.invalid["ttl"] += 1
+            if socket.inet_aton(addr[0]) != self.router or destination != self.source:
+                stats.invalid["addresses"] += 1
+            if addr[1] != flow.src_port:
+                stats.invalid["ports"] += 1
+            if bytes(data[:flow.payload_marker_offset]) not in flow.expected:
+                stats.invalid["payload"] += 1
+            stats.rtt.append(now - MARKER.unpack_from(data, flow.payload_marker_offset)[0])
+
+    def wait_responses(self, stats, timeout):
+        """
+        Reads the returned packets until all of them have been received, or until timeout
+        """
+        deadline = time.monotonic() + timeout
+        while stats.received < stats.sent and (remaining := deadline - time.monotonic()) > 0:
+            select.select([self.recv_socket], [], [], remaining)
+            self.receive(stats)
+
+    def warmup(self):
+        """
+        Sends the TCP handshakes, and the first packet of the other flows, so the flows are known by the router
+        :return: (StepStats)
+        """
+        stats = StepStats(0)
+        start = time.perf_counter_ns()
+        for flow in self.flows:
+            for packet in flow.handshake or flow.packets[:1]:
+                self.send(flow, packet, stats)
+            self.receive(stats)
+        stats.elapsed_ns = time.perf_counter_ns() - start
+        self.wait_responses(stats, self.args.drain_timeout)
+        return stats
+
+    def run_step(self, rate, duration):
+        """
+        Sends packets of all the flows (alternating their directions) at a fixed rate
+        :param rate: (int) Packets per second
+        :param duration: (float) Seconds
+        :return: (StepStats)
+        """
+        stats = StepStats(rate)
+        packets = [(flow, packet) for packet_index in range(2) for flow in self.flows
+                   for packet in flow.packets[packet_index:packet_index + 1]]
+        total = int(rate * duration)
+        start = time.perf_counter_ns()
+        index = 0
+        while stats.sent < total:
+            due = min(int((time.perf_counter_ns() - start) * rate / 1e9), total) - stats.sent
+            if due <= 0:
+                # nothing to send until the next packet is due
+                select.select([self.recv_socket], [], [], max(1 / rate - 0.0001, 0))
+            for _ in range(min(due, SEND_BURST)):
+                flow, packet = packets[index]
+                index = (index + 1) % len(packets)
+                self.send(flow, packet, stats)
+            self.receive(stats)
+        stats.elapsed_ns = time.perf_counter_ns() - start
+        self.wait_responses(stats, self.args.drain_timeout)
+        return stats
+
+    def close(self):
+        self.send_socket.close()
+        self.recv_socket.close()
+
+
+def cli_parser():
+    parser = argparse.ArgumentParser(
+        prog="gwlb-emulator",
+        description="Local GWLB emulator : sends Geneve flows to a running Geneve router, checks the returned packets "
+                    "and measures the round-trip time and the maximum sustained rate. The router and the emulator "
+                    "can't share the same network stack (both use the Geneve UDP port) : run the emulator from "
+                    "another host, or from a network namespace connected to the router with a veth pair "
+                    "(ip netns exec NAME python3 gwlb_emulator.py ...). Requires root permissions (raw socket)",
+    )
+    parser.add_argument("router", help="Router address")
+    parser.add_argument("-s", "--source", help="Local address used to send the packets (guessed from the routing "
+                                               "table by default)")
+    parser.add_argument("-n", "--flows", type=int, default=100, help="Number of flows (100 by default)")
+    parser.add_argument("-p", "--protocols", default="tcp,udp,icmp",
+                        help="Comma-separated inner protocols of the flows, among tcp, udp and icmp (all by default)")
+    parser.add_argument("--size", type=int, default=256, help="Inner payload size, in bytes (256 by default)")
+    parser.add_argument("-r", "--rate", type=int, default=10000, help="Packets per second (10000 by default)")
+    parser.add_argument("-d", "--duration", type=float, default=10.0,
+                        help="Duration of the test (or of each step with --find-max), in seconds (10 by default)")
+    parser.add_argument("--find-max", action="store_true",
+                        help="Increases the rate step by step (by 25%%, from --rate), until the loss exceeds "
+                             "--max-loss, and reports the maximum sustained rate")
+    parser.add_argument("--max-loss", type=float, default=0.1,
+                        help="Maximum loss of a sustained rate, in percent (0.1 by default)")
+    parser.add_argument("--drain-timeout", type=float, default=1.0,
+                        help="Time to wait for the late packets after each test or step, in seconds (1 by default)")
+    parser.add_argument("--health-check-port", type=int, default=config.HEALTH_CHECK_PORT,
+                        help=f"Router health-check port, probed during the tests ({config.HEALTH_CHECK_PORT} by "
+                             f"default). 0 disables the probes")
+    parser.add_argument("--health-check-interval", type=float, default=0.2,
+                        help="Time between two health-check probes, in seconds (0.2 by default)")
+    parser.add_argument("--ttl", type=int, default=64, help="Outter TTL of the sent packets (64 by default)")
+    parser.add_argument("--vni", type=int, default=0, help="Geneve VNI (0 by default)")
+    parser.add_argument("--gwlbe-id", type=lambda v: int(v, 0), default=0x0123456789ABCDEF,
+                        help="GWLB endpoint ID option value")
+    parser.add_argument("--attachment-id", type=lambda v: int(v, 0), default=0xFEDCBA9876543210,
+                        help="Attachment ID option value")
+    args = parser.parse_args()
+
+    if args.flows < 1:
+        parser.error("--flows must be at least 1")
+    if args.rate < 1:
+        parser.error("--rate must be at least 1")
+    if any(p not in PROTOCOLS for p in args.protocols.split(',')):
+        parser.error(f"--protocols must be a list of {', '.join(PROTOCOLS)}")
+    if not args.source:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((args.router, config.GENEVE_PORT))
+            args.source = s.getsockname()[0]
+    return args
+
+
+def main():
+    args = cli_parser()
+    emulator = GwlbEmulator(args)
+    probe = None
+    if args.health_check_port:
+        probe = HealthCheckProbe(args.router, args.health_check_port, args.health_check_interval)
+        probe.start()
+
+    print(f"GWLB-EMULATOR - {len(emulator.flows)} flows from {args.source} to {args.router}:{config.GENEVE_PORT}")
+    warmup = emulator.warmup()
+    print(f"GWLB-EMULATOR - Flows set up : {warmup.received}/{warmup.sent} packets returned")
+
+    exit_code = 0
+    try:
+        if not args.find_max:
+            stats = emulator.run_step(args.rate, args.duration)
+            for line in stats.report():
+                print(line)
+            exit_code = 1 if stats.lost or any(stats.invalid.values()) else 0
+        else:
+            rate, sustained = args.rate, None
+            while True:
+                stats = emulator.run_step(rate, args.duration)
+                achieved = stats.sent * 1e9 / stats.elapsed_ns
+                print(f"GWLB-EMULATOR - Step {rate} pps : lost {stats.loss_percent:.2f}% - p99 round-trip time "
+                      f"{percentiles(stats.rtt, (99,)).get(99, 0) / 1000:.1f}us")
+                if stats.loss_percent > args.max_loss:
+                    break
+                sustained = stats
+                if achieved < rate * 0.9:
+                    print("GWLB-EMULATOR - The emulator can't send faster : run it on another core or host to go "
+                          "further")
+                    break
+                rate = int(rate * 1.25)
+            if sustained:
+                print(f"GWLB-EMULATOR - Maximum sustained rate : {sustained.rate} pps (loss <= {args.max_loss}%)")
+                for line in sustained.report():
+                    print(line)
+            else:
+                print(f"GWLB-EMULATOR - No sustained rate (loss > {args.max_loss}% at {args.rate} pps)")
+                exit_code = 1
+    except KeyboardInterrupt:
+        exit_code = 1
+    finally:
+        if probe:
+            probe.stop()
+            print(probe.report())
+        emulator.close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,23 @@
-from struct import unpack, pack_into
+from struct import Struct, pack_into
+
+# fixed part of the header (up to the options)
+GENEVE_HEADER = Struct('!BBH3sB')
+GENEVE_OPTION_HEADER = Struct('!HBB')
+UINT32 = Struct('!I')
+UINT64 = Struct('!Q')
+
+# AWS GWLB options (class 0x0108)
+AWS_OPTION_CLASS = 0x0108
+AWS_GWLBE_ID_TYPE = 1
+AWS_ATTACHMENT_ID_TYPE = 2
+AWS_FLOW_COOKIE_TYPE = 3
+# options sent by GWLB, in this order : GWLB endpoint ID, attachment ID and flow cookie. Each option header (class,
+# type and length) is read as a single 32-bits word
+AWS_OPTIONS = Struct('!IQIQII')
+AWS_OPTIONS_WORDS = AWS_OPTIONS.size // 4
+AWS_GWLBE_ID_HEADER = AWS_OPTION_CLASS << 16 | AWS_GWLBE_ID_TYPE << 8 | 2
+AWS_ATTACHMENT_ID_HEADER = AWS_OPTION_CLASS << 16 | AWS_ATTACHMENT_ID_TYPE << 8 | 2
+AWS_FLOW_COOKIE_HEADER = AWS_OPTION_CLASS << 16 | AWS_FLOW_COOKIE_TYPE << 8 | 1
 
 
 class CriticalUnparsedGeneveHeader(Exception):
@@ -32,8 +51,11 @@ class Geneve:
     Reserved:       Must be 0.
     """
 
+    __slots__ = ('version', 'options_length', 'control', 'critical', 'protocol', 'vni', 'parsed_options',
+                 'raw_options', 'header_length_bytes', 'header_end_byte')
+
     def __init__(self, rawpacket, start_padding=0, parse_options=True):
-        unpacked_struct = unpack('!BBH3sB', rawpacket[start_padding:start_padding + 8])
+        unpacked_struct = GENEVE_HEADER.unpack_from(rawpacket, start_padding)
 
         self.version = unpacked_struct[0] >> 6
         # The option length fields represent the options size in words count (multiple of 4 bytes)
@@ -85,7 +107,8 @@ class Geneve:
 
     @property
     def flow_cookie(self):
-        return self.get_header_option(option_class=0x0108, option_type=3).option_raw.hex()
+        return int.from_bytes(
+            self.get_header_option(option_class=AWS_OPTION_CLASS, option_type=AWS_FLOW_COOKIE_TYPE).option_raw, 'big')
 
     def __repr__(self):
         return f"[Geneve   Protocol type:{self.protocol} VNI:{self.vni.hex()} {[x for x in self.parsed_options]}"
@@ -111,8 +134,10 @@ class GeneveOption:
     Length:         Length of the option (in 32 bits words count), excluding the Option header.
     """
 
+    __slots__ = ('option_class', 'option_type', 'critical', 'option_length', 'total_length', 'option_raw')
+
     def __init__(self, rawpacket, start_padding=8):
-        unpacked_struct = unpack('!HBB', rawpacket[start_padding:start_padding + 4])
+        unpacked_struct = GENEVE_OPTION_HEADER.unpack_from(rawpacket, start_padding)
 
         # Class 0x0108 = Amazon
         self.option_class = unpacked_struct[0]
@@ -145,4 +170,45 @@ class GeneveOption:
         return repacked_bytes
 
     def __repr__(self):
-        return f"[ Opt class:{self.option_class} Opt type:{self.option_type} Value:{self.option_raw.hex()} ]"
\ No newline at end of file
+        return f"[ Opt class:{self.option_class} Opt type:{self.option_type} Value:{self.option_raw.hex()} ]"
+
+
+def extract_aws_options(rawpacket, start_padding=0):
+    """
+    Extracts the AWS GWLB options values (class 0x0108) of a Geneve header, walking the options directly in the raw
+    packet without building any GeneveOption object. The options are first read at once, as laid out by GWLB
+    (AWS_OPTIONS), and only walked if they don't match this layout
+    :param rawpacket: (bytes-like) Raw packet
+    :param start_padding: (int) Position of the Geneve header in the raw packet
+    :return: (tuple) (flow cookie, GWLB endpoint ID, attachment ID) integer values. None for a missing option
+    """
+    if rawpacket[start_padding] & 0x3F == AWS_OPTIONS_WORDS:
+        gwlbe_header, gwlbe_id, attachment_header, attachment_id, flow_cookie_header, flow_cookie = \
+            AWS_OPTIONS.unpack_from(rawpacket, start_padding + 8)
+        if gwlbe_header == AWS_GWLBE_ID_HEADER and attachment_header == AWS_ATTACHMENT_ID_HEADER \
+                and flow_cookie_header == AWS_FLOW_COOKIE_HEADER:
+            return flow_cookie, gwlbe_id, attachment_id
+
+    flow_cookie = gwlbe_id = attachment_id = None
+    position = start_padding + 8
+    options_end = position + (rawpacket[start_padding] & 0x3F) * 4
+    while position < options_end:
+        option_class, option_type, option_length = GENEVE_OPTION_HEADER.unpack_from(rawpacket, position)
+        option_length = (option_length & 0x1F) * 4
+        if option_class == AWS_OPTION_CLASS:
+            if option_type == AWS_FLOW_COOKIE_TYPE and option_length == 4:
+                flow_cookie = UINT32.unpack_from(rawpacket, position + 4)[0]
+            elif option_type == AWS_GWLBE_ID_TYPE and option_length == 8:
+                gwlbe_id = UINT64.unpack_from(rawpacket, position + 4)[0]
+            elif option_type == AWS_ATTACHMENT_ID_TYPE and option_length == 8:
+                attachment_id = UINT64.unpack_from(rawpacket, position + 4)[0]
+        position += 4 + option_length
+    return flow_cookie, gwlbe_id, attachment_id
+
+
+def format_flow_cookie(flow_cookie):
+    """
+    Returns the hexadecimal string representation of an AWS flow cookie, as used in the logs
+    :return: (str)
+    """
+    return f"{flow_cookie:08x}"
@@ -1,4 +1,6 @@
-from struct import unpack, pack_into
+from struct import Struct
+
+ICMP_HEADER = Struct('!BBH4s')
 
 
 class ICMP:
@@ -19,8 +21,10 @@ class ICMP:
     Checksum:       Calculated checksum of the ICMP header
     """
 
+    __slots__ = ('type', 'code', 'checksum', 'more', 'payload_length')
+
     def __init__(self, rawpacket, start_padding=0, ip_payload_length=0):
-        unpacked_struct = unpack('!BBH4s', rawpacket[start_padding:start_padding + 8])
+        unpacked_struct = ICMP_HEADER.unpack_from(rawpacket, start_padding)
 
         self.type = unpacked_struct[0]
         self.code = unpacked_struct[1]
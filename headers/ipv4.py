@@ -1,4 +1,43 @@
-from struct import unpack, pack_into
+from struct import Struct
+
+# fixed part of the header (up to the options field)
+IPV4_HEADER = Struct('!BBHHHBBH4s4s')
+# fields rewritten when routing the packet back : TTL, protocol, checksum, source and destination addresses
+IPV4_ROUTED_FIELDS = Struct('!BBH4s4s')
+# offset of the IPV4_ROUTED_FIELDS in the header
+IPV4_ROUTED_FIELDS_OFFSET = 8
+# header without options, as 16-bits words
+IPV4_HEADER_WORDS = Struct('!10H')
+
+
+def header_checksum(buffer, start_padding=0, header_length_bytes=20):
+    """
+    Computes the one's complement checksum of an IPv4 header. The result is 0 for a header with a valid checksum
+    :param buffer: (bytes / bytearray / memoryview) Buffer containing the IP header
+    :param start_padding: (int) Position of the IP header in the buffer
+    :param header_length_bytes: (int) Length of the header (including options)
+    :return: (int) Checksum value
+    """
+    if header_length_bytes == 20:
+        total = sum(IPV4_HEADER_WORDS.unpack_from(buffer, start_padding))
+    else:
+        total = sum(Struct(f'!{header_length_bytes // 2}H').unpack_from(buffer, start_padding))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def ttl_decrement_checksum(checksum):
+    """
+    Incrementally updates a header checksum for a TTL decremented by 1 (RFC 1624, eqn. 3 : HC' = ~(~HC + ~m + m')).
+    The TTL is the high-order byte of its 16-bits word, so ~m + m' is always ~0x0100 (0xFEFF) in one's complement.
+    Swapping the source and destination addresses does not change the sum, and needs no update
+    :param checksum: (int) Current header checksum value
+    :return: (int) Updated header checksum value
+    """
+    total = (~checksum & 0xFFFF) + 0xFEFF
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
 
 
 class IPv4:
@@ -43,11 +82,15 @@ class IPv4:
     Padding:        "0"s placed at the end of the header to ensure its length is a multiple of 32 bits words (4 bytes)
     """
 
+    __slots__ = ('version', 'ihl', 'header_length_bytes', 'header_end_byte', 'dscp', 'ecn', 'total_length',
+                 'identification', 'x_flag', 'dnf', 'more_fragments', 'fragment_offset', 'ttl', 'protocol',
+                 'checksum', 'src_addr', 'dst_addr', 'options_words_count', 'options_raw', 'payload_length')
+
     def __init__(self, rawpacket, start_padding=0, parse_options=True):
         # extracting bytes up to the options field
         # we need first to find the total length of the header (IHL) to know
         # the size of the options + padding
-        unpacked_struct = unpack('!BBHHHBBH4s4s', rawpacket[start_padding:start_padding + 20])
+        unpacked_struct = IPV4_HEADER.unpack_from(rawpacket, start_padding)
 
         self.version = unpacked_struct[0] >> 4
         if self.version != 4:
@@ -90,6 +133,14 @@ class IPv4:
         """
         self.src_addr, self.dst_addr = self.dst_addr, self.src_addr
 
+    def decrement_ttl(self):
+        """
+        Decrements the TTL, and updates the header checksum accordingly
+        :return:
+        """
+        self.ttl -= 1
+        self.checksum = ttl_decrement_checksum(self.checksum)
+
     def repack(self, null_checksum=False):
         """
         Rebuilds a byte-encoded IP header
@@ -100,17 +151,18 @@ class IPv4:
         repacked_bytes = bytearray(self.ihl * 4)
 
         # packing data to reconstruct the header
-        pack_into('!BBHHHBBH4s4s', repacked_bytes, 0,
-                  (self.version << 4) + self.ihl,
-                  (self.dscp << 2) + self.ecn,
-                  self.total_length,
-                  self.identification,
-                  (self.x_flag << 15) + (self.dnf << 14) + (self.more_fragments << 13) + self.fragment_offset,
-                  self.ttl,
-                  self.protocol,
-                  0 if null_checksum else self.checksum,
-                  self.src_addr,
-                  self.dst_addr)
+        IPV4_HEADER.pack_into(repacked_bytes, 0,
+                              (self.version << 4) + self.ihl,
+                              (self.dscp << 2) + self.ecn,
+                              self.total_length,
+                              self.identification,
+                              (self.x_flag << 15) + (self.dnf << 14) + (self.more_fragments << 13)
+                              + self.fragment_offset,
+                              self.ttl,
+                              self.protocol,
+                              0 if null_checksum else self.checksum,
+                              self.src_addr,
+                              self.dst_addr)
 
         # adding options if there was any in the initial header
         if self.options_words_count:
@@ -119,6 +171,21 @@ class IPv4:
         # returns the built new header
         return repacked_bytes
 
+    def patch_into(self, buffer, start_padding=0):
+        """
+        Writes the TTL, protocol, checksum and source / destination IP addresses values back into an existing
+        (writable) byte-encoded IP header, leaving the first 8 bytes and the options untouched
+        :param buffer: (bytearray / memoryview) Writable buffer containing the IP header to patch
+        :param start_padding: (int) Position of the IP header in the buffer
+        :return:
+        """
+        IPV4_ROUTED_FIELDS.pack_into(buffer, start_padding + IPV4_ROUTED_FIELDS_OFFSET,
+                                     self.ttl,
+                                     self.protocol,
+                                     self.checksum,
+                                     self.src_addr,
+                                     self.dst_addr)
+
     @property
     def src_addr_str(self):
         """
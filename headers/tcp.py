@@ -1,4 +1,7 @@
-from struct import unpack, pack_into
+from struct import Struct
+
+# fixed part of the header (up to the options field)
+TCP_HEADER = Struct('!HHIIHHHH')
 
 
 class TCP:
@@ -43,11 +46,14 @@ class TCP:
     Padding:        "0"s placed at the end of the header to ensure its length is a multiple of 32 bits words (4 bytes)
     """
 
+    __slots__ = ('src_port', 'dst_port', 'seq_num', 'ack_num', 'data_offset', 'urg', 'ack', 'psh', 'rst', 'syn',
+                 'fin', 'window', 'checksum', 'urg_pointer', 'options_raw', 'payload_length')
+
     def __init__(self, rawpacket, start_padding=0, ip_payload_length=0):
         # extracting bytes up to the options field (20 bytes)
         # we need first to find the total length of the header (data offset) to know
         # the size of the options + padding
-        unpacked_struct = unpack('!HHIIHHHH', rawpacket[start_padding:start_padding + 20])
+        unpacked_struct = TCP_HEADER.unpack_from(rawpacket, start_padding)
 
         self.src_port = unpacked_struct[0]
         self.dst_port = unpacked_struct[1]
@@ -1,4 +1,6 @@
-from struct import unpack, pack_into
+from struct import Struct
+
+UDP_HEADER = Struct('!HHHH')
 
 
 class UDP:
@@ -20,8 +22,10 @@ class UDP:
     Checksum:       Calculated from part of the IP header, UDP header + payload to ensure integrity
     """
 
+    __slots__ = ('src_port', 'dst_port', 'length', 'checksum', 'payload_length')
+
     def __init__(self, rawpacket, start_padding=0, ip_payload_length=0):
-        unpacked_struct = unpack('!HHHH', rawpacket[start_padding:start_padding + 8])
+        unpacked_struct = UDP_HEADER.unpack_from(rawpacket, start_padding)
 
         self.src_port = unpacked_struct[0]
         self.dst_port = unpacked_struct[1]
@@ -45,11 +49,11 @@ class UDP:
         """
         repacked_bytes = bytearray(8)
 
-        pack_into('!HHHH', repacked_bytes, 0,
-                  self.src_port,
-                  self.dst_port,
-                  self.length,
-                  self.checksum)
+        UDP_HEADER.pack_into(repacked_bytes, 0,
+                             self.src_port,
+                             self.dst_port,
+                             self.length,
+                             self.checksum)
 
         return repacked_bytes
 
@@ -0,0 +1,70 @@
+import asyncio
+import socket
+import threading
+import config
+
+
+class HealthCheckServer(threading.Thread):
+    """
+    Answers to the GWLB health-check requests from a dedicated thread, running an asyncio server
+
+    The requests are served concurrently and without blocking : a slow or half-open client only holds its own
+    connection (closed after config.HEALTH_CHECK_TIMEOUT seconds), and never the Geneve packets processing.
+    """
+
+    LOG_PREFIX = "HEALTH-CHECK"
+
+    def __init__(self, logger, response, port=config.HEALTH_CHECK_PORT):
+        """
+        :param response: (callable) Returns the HTTP response (str) to send back to a health-check request
+        """
+        super().__init__(name=self.LOG_PREFIX.lower(), daemon=True)
+        self.logger = logger
+        self.response = response
+        self.port = port
+        self.loop = None
+        self.stop_event = None
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('0.0.0.0', port))
+        self.socket.listen(config.HEALTH_CHECK_BACKLOG)
+        self.socket.setblocking(False)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        server = await asyncio.start_server(self.handle_request, sock=self.socket)
+        self.logger.info(f"{self.LOG_PREFIX} - Listening on port {self.port}")
+        async with server:
+            await self.stop_event.wait()
+
+    async def handle_request(self, reader, writer):
+        c_addr = writer.get_extra_info('peername')
+        try:
+            request = await asyncio.wait_for(reader.read(1024), timeout=config.HEALTH_CHECK_TIMEOUT)
+            self.logger.debug(f"{self.LOG_PREFIX} - Received request from {c_addr[0]}:{c_addr[1]}")
+            writer.write(self.build_response(request).encode('utf-8'))
+            await asyncio.wait_for(writer.drain(), timeout=config.HEALTH_CHECK_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"{self.LOG_PREFIX} - Timeout raised on socket from {c_addr[0]}:{c_addr[1]}")
+        except ConnectionError as e:
+            self.logger.warning(f"{self.LOG_PREFIX} - Connection error on socket from {c_addr[0]}:{c_addr[1]} : {e}")
+        finally:
+            writer.close()
+
+    def build_response(self, request):
+        """
+        :param request: (bytes) Beginning of the received HTTP request
+        :return: (str) HTTP response
+        """
+        return self.response()
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+            self.join(timeout=5)
+        self.socket.close()
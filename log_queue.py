@@ -0,0 +1,106 @@
+import logging
+import logging.handlers
+import queue
+import config
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which never blocks the caller : records are dropped (and counted) when the queue is full.
+    Records are only turned into their final message here, the formatting (timestamp, level...) is left to the
+    handlers of the listener thread
+    """
+
+    def __init__(self, records_queue):
+        super().__init__(records_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the message has to be built from the arguments now, as they may be modified once the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener waiting for some room in the queue to stop, so the pending records are written before leaving
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class LogQueue:
+    """
+    Moves the handlers of a logger to a background writer thread
+
+    The logger handlers are replaced with a DroppingQueueHandler, feeding a bounded queue of config.LOG_QUEUE_SIZE
+    records. The records are written by the original handlers from a QueueListener thread, so the packets processing
+    thread never waits for a file or console write, and a burst of log records can't stall it : records are dropped
+    when the queue is full.
+    The listener thread does not survive a fork : forked processes have to call restart().
+    """
+
+    def __init__(self, logger, queue_size=config.LOG_QUEUE_SIZE):
+        self.logger = logger
+        self.queue_size = queue_size
+        self.handlers = list(logger.handlers)
+        self.queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.listener = None
+        self.reported_drops = 0
+
+    def start(self):
+        for h in self.handlers:
+            self.logger.removeHandler(h)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = DrainingQueueListener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def restart(self):
+        """
+        Starts a new listener thread after a fork, with a new queue (the one of the parent process may have been left
+        locked by its listener thread)
+        :return:
+        """
+        self.queue_handler.queue = queue.Queue(self.queue_size)
+        self.queue_handler.dropped = 0
+        self.reported_drops = 0
+        self.listener = DrainingQueueListener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """
+        Writes the pending records, stops the listener thread and gives the handlers back to the logger, so the last
+        records are written synchronously
+        :return:
+        """
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        self.logger.removeHandler(self.queue_handler)
+        for h in self.handlers:
+            self.logger.addHandler(h)
+
+    @property
+    def dropped(self):
+        return self.queue_handler.dropped
+
+    def report_drops(self):
+        """
+        Logs the number of records dropped since the last call, if any
+        :return:
+        """
+        dropped = self.queue_handler.dropped - self.reported_drops
+        if dropped:
+            self.reported_drops += dropped
+            self.logger.warning(f"LOGGING - {dropped} log records dropped (queue full)")
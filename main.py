@@ -5,10 +5,27 @@ import logging, logging.handlers
 import daemon
 import lockfile
 import signal
-from rawpacket import RawPacket, UnmatchedGenevePort
+import time
+from bisect import bisect_right
+from rawpacket import RawPacket, UnmatchedGenevePort, InvalidChecksum, DroppedByPolicy, NonSynBlocked
 import config
 import argparse
-from flow_tracker import FlowTracker
+from flow_tracker import FlowTracker, SamplingControl
+from flow_export import FlowExporter
+from flow_table import SharedFlowTable, FlowTableError
+from policy import Policy, PolicyError
+from analytics import Analytics
+from buffer_pool import BufferPool
+from geneve_sockets import build_geneve_sockets, build_raw_send_socket, set_buffer_sizes, KernelDrops, \
+    RXQ_OVFL_CMSG_SIZE
+from packet_ring import PacketRing
+from pcap import PcapError
+from replay import replay
+from diagnostics import SamplingProfiler, dump_path, write_snapshot
+from worker_pool import WorkerPool
+from health_check import HealthCheckServer
+from log_queue import LogQueue
+from metrics import Metrics, SharedMetrics, MetricsServer, COUNTERS, FLOW_PROTOCOLS, LATENCY_BUCKETS_NS
 import setproctitle
 
 
@@ -21,7 +38,10 @@ LOG_LEVELS = {
 }
 
 logger = None
+log_queue = None
 prog_break = False
+profile_requested = False
+snapshot_requested = False
 
 
 def shutdown(signum, sigframe):
@@ -31,6 +51,16 @@ def shutdown(signum, sigframe):
     prog_break = True
 
 
+def request_profile(signum, sigframe):
+    global profile_requested
+    profile_requested = True
+
+
+def request_snapshot(signum, sigframe):
+    global snapshot_requested
+    snapshot_requested = True
+
+
 def cli_parser():
     parser = argparse.ArgumentParser(
         prog="geneve-router",
@@ -64,13 +94,235 @@ def cli_parser():
         help="Enables flow tracker, which provides only start/stop flow logging information"
     )
 
+    parser.add_argument(
+        "--flow-export",
+        action="store",
+        metavar="DESTINATION",
+        help="Exports a binary record for each ended flow (enables the flow tracker), to a file (rotated, one per "
+             "worker) or to a collector with udp://host:port. Overwrites the config.FLOW_EXPORT parameter",
+        default=config.FLOW_EXPORT
+    )
+
+    parser.add_argument(
+        "--flow-table",
+        action="store",
+        metavar="PATH",
+        help="Keeps the tracked flows in a memory-mapped file (e.g. /dev/shm/geneve-router-flows, enables the flow "
+             "tracker), shared by the workers and kept across restarts : the flows seen before a restart or by "
+             "another worker are taken over instead of being handled as new ones. Overwrites the config.FLOW_TABLE "
+             "parameter",
+        default=config.FLOW_TABLE
+    )
+
+    parser.add_argument(
+        "--max-flows",
+        action="store",
+        type=int,
+        metavar="N",
+        help="Maximum number of flows tracked by each worker. A new flow evicts the oldest half-open TCP flow, or the "
+             "least recently used one. 0 for no limit. Overwrites the config.MAX_FLOWS parameter "
+             f"({config.MAX_FLOWS})",
+        default=config.MAX_FLOWS
+    )
+
+    parser.add_argument(
+        "--max-half-open-flows",
+        action="store",
+        type=int,
+        metavar="N",
+        help="Maximum number of half-open (SYN / SYNACK) TCP flows tracked by each worker. A new half-open flow "
+             "evicts the oldest one, and they are evicted after config.TCP_SYN_FLOOD_TIMEOUT seconds once half of "
+             "them are used. 0 for no limit. Overwrites the config.MAX_HALF_OPEN_FLOWS parameter "
+             f"({config.MAX_HALF_OPEN_FLOWS})",
+        default=config.MAX_HALF_OPEN_FLOWS
+    )
+
+    parser.add_argument(
+        "--flow-sampling",
+        action="store",
+        type=int,
+        metavar="N",
+        help="Tracks only 1 in N flows (enables the flow tracker), selected by a hash of their AWS flow cookie. Their "
+             f"exported counters are multiplied by N. N and M can be changed at runtime by writing \"N M\" to the "
+             f"{config.SAMPLING_CONTROL_FILE} file of the log file directory. Overwrites the config.FLOW_SAMPLING "
+             f"parameter ({config.FLOW_SAMPLING})",
+        default=config.FLOW_SAMPLING
+    )
+
+    parser.add_argument(
+        "--packet-sampling",
+        action="store",
+        type=int,
+        metavar="M",
+        help="Counts 1 in M packets of the flows which are not tracked, to estimate their packets and bytes. 0 "
+             f"disables it. Overwrites the config.PACKET_SAMPLING parameter ({config.PACKET_SAMPLING})",
+        default=config.PACKET_SAMPLING
+    )
+
+    parser.add_argument(
+        "--policy",
+        action="store",
+        metavar="FILE",
+        dest="policy_file",
+        help="Allow / drop rules applied to the inner traffic (see the README for the format). The first packet of a "
+             "flow is evaluated, and its verdict applies to the whole flow. Overwrites the config.POLICY parameter "
+             "(everything is forwarded by default)",
+        default=config.POLICY
+    )
+
+    parser.add_argument(
+        "--analytics",
+        action="store_true",
+        help="Computes top talkers (inner sources, destinations and ports by bytes) and distinct flows and sources "
+             "by VNI and GWLB endpoint with fixed-size sketches, reported every config.ANALYTICS_INTERVAL seconds in "
+             "the log file directory. Overwrites the config.ANALYTICS parameter",
+        default=config.ANALYTICS
+    )
+
     parser.add_argument(
         "-u", "--udp-only",
         action="store_true",
-        help="Start without using raw socket (only UDP bind socket)"
+        help="Start without using raw socket (only UDP bind socket). Same as --engine udp"
+    )
+
+    parser.add_argument(
+        "-e", "--engine",
+        action="store",
+        choices=["raw", "udp", "mmap"],
+        help=f"Receive engine : raw socket, UDP bind socket, or AF_PACKET socket with a memory-mapped ring and a "
+             f"kernel filter for the Geneve packets. Overwrites the config.ENGINE parameter ({config.ENGINE})",
+        default=config.ENGINE
+    )
+
+    parser.add_argument(
+        "-b", "--batch-size",
+        action="store",
+        type=int,
+        help=f"Maximum number of packets drained from the Geneve socket on each wake-up. "
+             f"Overwrites the config.BATCH_SIZE parameter ({config.BATCH_SIZE})",
+        default=config.BATCH_SIZE
+    )
+
+    parser.add_argument(
+        "--rcvbuf",
+        action="store",
+        type=int,
+        metavar="BYTES",
+        help=f"Receive buffer size of the Geneve socket (SO_RCVBUF, forced above net.core.rmem_max when running as "
+             f"root). 0 keeps the system default. Overwrites the config.SOCKET_RCVBUF parameter "
+             f"({config.SOCKET_RCVBUF})",
+        default=config.SOCKET_RCVBUF
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--sndbuf",
+        action="store",
+        type=int,
+        metavar="BYTES",
+        help=f"Send buffer size of the Geneve socket (SO_SNDBUF, forced above net.core.wmem_max when running as "
+             f"root). 0 keeps the system default. Overwrites the config.SOCKET_SNDBUF parameter "
+             f"({config.SOCKET_SNDBUF})",
+        default=config.SOCKET_SNDBUF
+    )
+
+    parser.add_argument(
+        "--busy-poll",
+        action="store",
+        type=int,
+        metavar="USEC",
+        help=f"Time (in microseconds) spent spinning on the Geneve socket once it has been drained, before going back "
+             f"to sleep in epoll, when the traffic is high. 0 disables busy-polling. Overwrites the config.BUSY_POLL "
+             f"parameter ({config.BUSY_POLL})",
+        default=config.BUSY_POLL
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        action="store",
+        type=int,
+        help=f"Number of worker processes. Traffic is spread across the workers by the kernel, keeping all the "
+             f"packets of a flow on the same worker. Overwrites the config.WORKERS parameter ({config.WORKERS})",
+        default=config.WORKERS
+    )
+
+    parser.add_argument(
+        "--validate-checksum",
+        action="store_true",
+        help="Drop the received packets with an invalid outter IPv4 header checksum",
+        default=config.VALIDATE_CHECKSUM
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        action="store",
+        type=int,
+        metavar="PORT",
+        help="Serves the /metrics endpoint (Prometheus text format) on this port. Overwrites the config.METRICS_PORT "
+             "parameter (disabled by default)",
+        default=config.METRICS_PORT
+    )
+
+    parser.add_argument(
+        "--replay",
+        action="store",
+        metavar="PCAP",
+        help="Does not listen on the network : runs the packets of a pcap or pcapng capture of Geneve traffic through "
+             "the packets processing (as received by the raw socket engine) as fast as possible, and reports the "
+             "throughput and processing time percentiles",
+    )
+
+    parser.add_argument(
+        "--replay-output",
+        action="store",
+        metavar="PCAP",
+        help="Writes the packets forwarded during a --replay to a pcap file (discarded otherwise)",
+    )
+
+    parser.add_argument(
+        "--replay-loops",
+        action="store",
+        type=int,
+        metavar="N",
+        help="Number of times the --replay capture is replayed (1 by default)",
+        default=1
+    )
+
+    args = parser.parse_args()
+
+    if args.udp_only:
+        args.engine = "udp"
+    args.udp_only = args.engine == "udp"
+    if args.flow_export or args.flow_table or args.flow_sampling > 1:
+        args.flow_tracker = True
+
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.busy_poll < 0:
+        parser.error("--busy-poll can't be negative")
+    if args.replay_loops < 1:
+        parser.error("--replay-loops must be at least 1")
+    if args.replay_output and not args.replay:
+        parser.error("--replay-output requires --replay")
+    if args.rcvbuf < 0 or args.sndbuf < 0:
+        parser.error("--rcvbuf and --sndbuf can't be negative")
+    if args.max_flows < 0 or args.max_half_open_flows < 0:
+        parser.error("--max-flows and --max-half-open-flows can't be negative")
+    if args.flow_sampling < 1:
+        parser.error("--flow-sampling must be at least 1")
+    if args.packet_sampling < 0:
+        parser.error("--packet-sampling can't be negative")
+
+    # the policy is compiled once, before forking the workers
+    args.policy = None
+    if args.policy_file:
+        try:
+            args.policy = Policy.from_file(args.policy_file)
+        except (OSError, PolicyError) as e:
+            parser.error(f"unable to load the policy {args.policy_file} : {e}")
+
+    return args
 
 
 def check_permission():
@@ -80,92 +332,462 @@ def check_permission():
 
 def start(start_cli_args):
     global logger
-    global prog_break
+    global log_queue
+
+    # the log records are written from a background thread, which has to be started once daemonized
+    log_queue = LogQueue(logger)
+    log_queue.start()
 
     logger.info(f"Start with PID {os.getpid()}")
 
-    flow_tracker = None
+    # SIGUSR1 profiles the packets processing for config.PROFILE_DURATION seconds, SIGUSR2 dumps the flows table and
+    # the counters. The workers inherit those handlers, and the supervisor relays the signals to them
+    signal.signal(signal.SIGUSR1, request_profile)
+    signal.signal(signal.SIGUSR2, request_snapshot)
+
     logger.info("Logging initialized. Building sockets...")
-    sockets = list()
 
-    # the health_socket is the one used for the GWLB health-check requests
-    health_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-    health_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    health_socket.bind(('0.0.0.0', config.HEALTH_CHECK_PORT))
-    health_socket.listen(3)
-    sockets.append(health_socket)
+    if start_cli_args.workers > 1:
+        supervise(start_cli_args)
+    else:
+        recv_socket, send_socket = build_engine(start_cli_args)
+        # the GWLB health-check requests are answered from a dedicated thread, never blocking the Geneve packets
+        health_check = HealthCheckServer(logger, http_healthcheck_response)
+        health_check.start()
+        shared_metrics, metrics_server = start_metrics_server(start_cli_args, 1)
+        forward(start_cli_args, recv_socket, send_socket, shared_metrics=shared_metrics)
+        health_check.stop()
+        if metrics_server:
+            metrics_server.stop()
 
-    if not start_cli_args.udp_only:
-        # the raw_socket is the one used to receive the Geneve packets
-        main_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
-        # IP_HDRINCL permits to ask the system that we want to receive (and create) our own IP/UDP headers
-        # this is needed as Geneve requires that we send back the "routed" traffic on the GENEVE_PORT (src/dst ports
-        # are not swapped)
-        main_socket.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
-        main_socket.bind(('0.0.0.0', 0))
+    logger.warning("Bye bye")
+    log_queue.stop()
+
+
+def supervise(start_cli_args):
+    """
+    Forks the workers, restarts them if they die, and answers to the health-check requests.
+    The GWLB target is reported as healthy only when all the workers are alive
+    """
+    global prog_break
+    global profile_requested
+    global snapshot_requested
+
+    # all the workers join the same AF_PACKET fanout group in raw mode. The ID only needs to be unique on the host
+    fanout_group = os.getpid() & 0xFFFF
+    worker_pool = WorkerPool(
+        logger,
+        start_cli_args.workers,
+        lambda worker_id: run_worker(start_cli_args, worker_id, fanout_group, (health_check, metrics_server),
+                                     shared_metrics)
+    )
+    health_check = HealthCheckServer(logger, lambda: http_healthcheck_response(worker_pool.all_alive))
+    # the workers publish their metrics in a shared memory mapping, which has to exist before they are forked
+    shared_metrics, metrics_server = start_metrics_server(start_cli_args, start_cli_args.workers)
+    # the signal handlers of the daemon context are only installed when running as a daemon, but the workers always
+    # have to be stopped properly
+    signal.signal(signal.SIGTERM, shutdown)
+    worker_pool.start()
+    health_check.start()
+
+    while True and not prog_break:
+        try:
+            time.sleep(1)
+            worker_pool.reap()
+            if profile_requested:
+                profile_requested = False
+                worker_pool.send_signal(signal.SIGUSR1)
+            if snapshot_requested:
+                snapshot_requested = False
+                worker_pool.send_signal(signal.SIGUSR2)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            logger.error(f"Unexpected error : {e}")
+
+    logger.warning("Exit requested. Stopping workers...")
+    worker_pool.stop()
+    health_check.stop()
+    if metrics_server:
+        metrics_server.stop()
+
+
+def start_metrics_server(start_cli_args, workers_count):
+    """
+    Starts the /metrics endpoint server if enabled with --metrics-port
+    :return: (tuple) (SharedMetrics, MetricsServer), or (None, None)
+    """
+    if not start_cli_args.metrics_port:
+        return None, None
+    shared_metrics = SharedMetrics(workers_count)
+    metrics_server = MetricsServer(logger, shared_metrics, start_cli_args.metrics_port)
+    metrics_server.start()
+    return shared_metrics, metrics_server
+
+
+def run_worker(start_cli_args, worker_id, fanout_group, servers, shared_metrics):
+    """
+    Entry point of a forked worker process
+    """
+    # the health-check and metrics requests are answered by the supervisor only
+    for server in servers:
+        if server:
+            server.socket.close()
+    # the workers are stopped by the supervisor, using SIGTERM
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setproctitle.setproctitle(f"geneve-router: worker {worker_id}")
+    # the log writer thread of the supervisor is not running in the forked process
+    log_queue.restart()
+    logger.info(f"WORKER {worker_id} - Start with PID {os.getpid()}")
+
+    try:
+        recv_socket, send_socket = build_engine(start_cli_args, fanout_group)
+        forward(start_cli_args, recv_socket, send_socket, worker_id, shared_metrics)
+    finally:
+        log_queue.stop()
+    return 0
+
+
+def open_flow_table(start_cli_args):
+    """
+    Maps the shared flow table file if enabled with --flow-table. The flows are only tracked by the process if it
+    can't be used
+    :return: (SharedFlowTable) None if disabled, or on error
+    """
+    if not start_cli_args.flow_table:
+        return None
+    try:
+        flow_table = SharedFlowTable(logger, start_cli_args.flow_table)
+    except FlowTableError as e:
+        logger.error(f"FLOW-TABLE - Unable to use the shared flow table : {e}")
+        return None
+    logger.info(f"FLOW-TABLE - Using {start_cli_args.flow_table} ({flow_table.slots_count} slots)")
+    return flow_table
+
+
+def build_engine(start_cli_args, fanout_group=None):
+    """
+    Builds the receive engine selected with --engine, and sets the socket buffer sizes (--rcvbuf, --sndbuf)
+    :return: (tuple) (receive socket or PacketRing, send socket)
+    """
+    if start_cli_args.engine == "mmap":
+        recv_socket, send_socket = PacketRing(fanout_group), build_raw_send_socket()
+        # the ring replaces the receive buffer
+        _, sndbuf = set_buffer_sizes(send_socket, sndbuf=start_cli_args.sndbuf)
+        logger.info(f"Socket buffers : send {sndbuf} bytes")
+        return recv_socket, send_socket
+
+    recv_socket, send_socket = build_geneve_sockets(start_cli_args.udp_only, fanout_group)
+    if recv_socket is send_socket:
+        rcvbuf, sndbuf = set_buffer_sizes(recv_socket, start_cli_args.rcvbuf, start_cli_args.sndbuf)
     else:
-        # UDP socket for receiving the Geneve payloads if started with the --udp-only parameter
-        # (replacing the raw socket)
-        # Using this mode permits to start without root privileges, but it has an impact in the way Geneve packets will
-        # be sent back to the GWLB : when sending using a binded SOCK_DGRAM socket, the source port of the sent packets
-        # will always be the port used for the bind. Then, Geneve packets will be sent to port 6081, with a source port
-        # of 6081. AWS could block it at some time (this is even weird that it works actually)
-        main_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        main_socket.bind(('0.0.0.0', config.GENEVE_PORT))
+        rcvbuf, _ = set_buffer_sizes(recv_socket, rcvbuf=start_cli_args.rcvbuf)
+        _, sndbuf = set_buffer_sizes(send_socket, sndbuf=start_cli_args.sndbuf)
+    # the kernel doubles the requested values, and caps them to net.core.rmem_max / wmem_max without privileges
+    logger.info(f"Socket buffers : receive {rcvbuf} bytes, send {sndbuf} bytes")
+    return recv_socket, send_socket
+
+
+def forward(start_cli_args, main_socket, send_socket, worker_id=None, shared_metrics=None):
+    """
+    Main loop : receives the Geneve packets on main_socket, and sends back the responses using send_socket
+    (which is the same socket, except when an AF_PACKET socket is used to receive).
+
+    main_socket is registered as edge-triggered in epoll : once it has been reported as readable, it is drained
+    batch after batch until there is nothing left to read, before polling again. With --busy-poll, the loop keeps
+    spinning on non-blocking readiness checks for some microseconds once the socket is drained, as long as the traffic
+    is high enough (at least config.BUSY_POLL_THRESHOLD packets since the last wake-up). It blocks in epoll otherwise.
+
+    With shared_metrics, the packets processing counters are plain integer increments, published to the worker slot
+    of shared_metrics every config.METRICS_PUBLISH_INTERVAL seconds.
+
+    The profiling (SIGUSR1) and snapshot (SIGUSR2) requests are handled by the loop : their reports are written to the
+    log file directory. The flow tracker sampling control file (config.SAMPLING_CONTROL_FILE) is checked by the loop
+    as well.
+    """
+    global prog_break
+
+    flow_tracker = None
+    # the signals (e.g. SIGTERM) are written to the wakeup socket, so that they interrupt the epoll.poll() call
+    wakeup_socket, signal_socket = socket.socketpair()
+    wakeup_socket.setblocking(False)
+    signal_socket.setblocking(False)
+    signal.set_wakeup_fd(signal_socket.fileno())
 
-    sockets.append(main_socket)
+    poller = select.epoll()
+    poller.register(main_socket.fileno(), select.EPOLLIN | select.EPOLLET)
+    poller.register(wakeup_socket.fileno(), select.EPOLLIN)
 
     logger.info("Sockets are ready. Listening...")
 
     if start_cli_args.flow_tracker:
         logger.info("Starting flow tracker...")
-        flow_tracker = FlowTracker(logger)
+        exporter = None
+        if start_cli_args.flow_export:
+            destination = start_cli_args.flow_export
+            # each worker writes its own records file
+            if worker_id is not None and not destination.startswith("udp://"):
+                destination = f"{destination}.worker{worker_id}"
+            exporter = FlowExporter(logger, destination)
+            exporter.start()
+        flow_tracker = FlowTracker(logger, exporter, open_flow_table(start_cli_args), start_cli_args.max_flows,
+                                   start_cli_args.max_half_open_flows, start_cli_args.flow_sampling,
+                                   start_cli_args.packet_sampling)
+
+    if start_cli_args.policy:
+        logger.info(f"POLICY - {len(start_cli_args.policy.rules)} rules loaded from {start_cli_args.policy_file} "
+                    f"(default : {'allow' if start_cli_args.policy.default_allow else 'drop'})")
+
+    # one receive buffer per packet of a batch. Buffers are reused once the batch has been flushed
+    buffer_pool = BufferPool(start_cli_args.batch_size)
+    ring = main_socket if isinstance(main_socket, PacketRing) else None
+    kernel_drops = KernelDrops(ring.socket, statistics=True) if ring else KernelDrops(main_socket)
+    loop_stats = LoopStats(start_cli_args.batch_size, kernel_drops)
+    # an AF_PACKET socket provides the link-layer information instead of the source IP address
+    packet_socket = not ring and main_socket.family == socket.AF_PACKET
+    busy_poll_ns = start_cli_args.busy_poll * 1000
+
+    # epoll timeout (in seconds), so that the periodic tasks run when there is no traffic
+    poll_timeout = 10
+    metrics = None
+    if shared_metrics:
+        poll_timeout = min(poll_timeout, config.METRICS_PUBLISH_INTERVAL)
+        metrics = Metrics()
+    next_publish_ns = 0
+
+    def publish_metrics():
+        nonlocal next_publish_ns
+        flow_counts = dict()
+        flow_evictions = None
+        flow_memory = 0
+        untracked = sampling = (0, 0)
+        if flow_tracker:
+            with flow_tracker.lock:
+                flow_counts = dict(flow_tracker.flow_counts)
+                flow_evictions = dict(flow_tracker.evictions)
+            flow_memory = flow_tracker.memory_usage
+            untracked = (flow_tracker.untracked_packets, flow_tracker.untracked_bytes)
+            sampling = (flow_tracker.flow_sampling, flow_tracker.packet_sampling)
+        shared_metrics.publish(worker_id or 0, metrics, kernel_drops.read(), flow_counts, flow_evictions, flow_memory,
+                               untracked, sampling)
+        next_publish_ns = time.perf_counter_ns() + int(config.METRICS_PUBLISH_INTERVAL * 1e9)
+
+    profiler = SamplingProfiler()
+    dump_directory = os.path.dirname(os.path.abspath(start_cli_args.log_file))
+
+    analytics = None
+    if start_cli_args.analytics:
+        analytics = Analytics()
+        # the report file is replaced on each report
+        worker = f"-worker{worker_id}" if worker_id is not None else ""
+        analytics_path = os.path.join(dump_directory, f"geneve-router-analytics{worker}.txt")
+        logger.info(f"ANALYTICS - Sketches of up to {analytics.memory >> 10} KB "
+                    f"({'vectorized' if analytics.vectorized else 'numpy not installed, not vectorized'}), reported "
+                    f"every {config.ANALYTICS_INTERVAL}s to {analytics_path}")
+
+    sampling_control = None
+    if flow_tracker:
+        # the control file is shared by all the workers
+        sampling_control = SamplingControl(logger, flow_tracker,
+                                           os.path.join(dump_directory, config.SAMPLING_CONTROL_FILE))
+
+    def diagnostics():
+        """
+        Handles the profiling and snapshot requests, and ends the running profiling
+        """
+        global profile_requested
+        global snapshot_requested
+        if profile_requested:
+            profile_requested = False
+            if not profiler.running:
+                logger.warning(f"DIAGNOSTICS - Profiling for {config.PROFILE_DURATION}s")
+                profiler.start()
+        elif profiler.running and time.monotonic() >= profiler.deadline:
+            profiler.stop()
+            path = dump_path(dump_directory, "profile", worker_id)
+            try:
+                with open(path, 'w') as f:
+                    f.write(profiler.report())
+                logger.warning(f"DIAGNOSTICS - Profile of {profiler.samples_count} samples written to {path}")
+            except OSError as e:
+                logger.error(f"DIAGNOSTICS - Unable to write the profile to {path} : {e}")
+
+        if snapshot_requested:
+            snapshot_requested = False
+            counters = {
+                "packets_received_since_last_report": loop_stats.packets,
+                "kernel_drops": kernel_drops.read(),
+                "log_records_dropped": log_queue.dropped,
+            }
+            if metrics:
+                counters.update((name, getattr(metrics, name)) for name, _ in COUNTERS)
+            flows = list()
+            if flow_tracker:
+                with flow_tracker.lock:
+                    flows = list(flow_tracker.tracked_flows.values())
+                    flow_counts = dict(flow_tracker.flow_counts)
+                    flow_evictions = dict(flow_tracker.evictions)
+                counters["flows_scheduled_in_timer_wheel"] = len(flow_tracker.wheel)
+                counters["flows_half_open"] = len(flow_tracker.half_open_flows)
+                counters["tracked_flows_memory_bytes"] = flow_tracker.memory_usage
+                counters["flow_sampling_rate"] = flow_tracker.flow_sampling
+                counters["packet_sampling_rate"] = flow_tracker.packet_sampling
+                counters["untracked_packets_estimated"] = flow_tracker.untracked_packets
+                counters["untracked_bytes_estimated"] = flow_tracker.untracked_bytes
+                counters.update((f"flows_evicted_{reason}", count) for reason, count in flow_evictions.items())
+                counters.update((f"flows_{FLOW_PROTOCOLS.get(protocol, protocol)}_{state or 'NONE'}", count)
+                                for (protocol, state), count in flow_counts.items() if count)
+                if flow_tracker.flow_table:
+                    counters["shared_flow_table_records"] = flow_tracker.flow_table.count
+                    counters["flows_taken_over"] = flow_tracker.flows_taken_over
+                    counters["flows_not_shared_table_full"] = flow_tracker.flow_table_full
+                if flow_tracker.exporter:
+                    counters["flow_records_exported"] = flow_tracker.exporter.exported
+                    counters["flow_records_dropped"] = flow_tracker.exporter.dropped
+                    counters["flow_records_failed"] = flow_tracker.exporter.failed
+            if start_cli_args.policy:
+                counters["policy_rules"] = len(start_cli_args.policy.rules)
+                counters["policy_evaluations"] = start_cli_args.policy.evaluations
+                counters["policy_cached_verdicts"] = len(start_cli_args.policy.verdicts)
+            write_snapshot(logger, dump_path(dump_directory, "snapshot", worker_id), counters, flows)
+
+    def forward_batch():
+        """
+        Receives up to batch_size packets, processes the whole batch, and only then sends the responses back
+        :return: (bool) True if there may be more packets to read, False if the socket (or the ring) is drained
+        """
+        if ring:
+            batch = ring.receive_batch(start_cli_args.batch_size)
+        else:
+            batch = receive_batch(main_socket, buffer_pool, start_cli_args.batch_size, kernel_drops)
+        responses = list()
+        # the per-packet debug messages are only built when they will be logged
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if metrics:
+            batch_start = time.perf_counter_ns()
+        for data, addr in batch:
+            if packet_socket:
+                # the packets sent by the host, including our responses, are rejected by the socket filter
+                addr = (socket.inet_ntoa(data[12:16]), 0)
+            if debug:
+                if start_cli_args.udp_only:
+                    logger.debug(f"GENEVE - Received UDP Geneve packet from {addr[0]}:{addr[1]}")
+                else:
+                    logger.debug(f"GENEVE - Received raw packet from {addr[0]}:{addr[1]}")
+            if (geneve_response_packet := geneve_handler(data, flow_tracker, start_cli_args.udp_only,
+                                                         start_cli_args.validate_checksum, metrics,
+                                                         start_cli_args.policy, analytics)):
+                # we need to specify the destination of the packet (addr[0], config.GENEVE_PORT) only for
+                # the case where we are using an UDP socket. When using RAW socket, this value needs to be
+                # there too but is overrided by the values of the forged IP/UDP headers
+                responses.append((geneve_response_packet, (addr[0], config.GENEVE_PORT)))
+        sent_bytes = flush_responses(send_socket, responses)
+        if metrics and batch:
+            # the processing time is measured for the whole batch (from the packets parsing to the responses
+            # sending), and accounted to each of its packets as the batch average
+            batch_end = time.perf_counter_ns()
+            batch_ns = batch_end - batch_start
+            metrics.latency_buckets[bisect_right(LATENCY_BUCKETS_NS, batch_ns // len(batch))] += len(batch)
+            metrics.latency_sum_ns += batch_ns
+            metrics.packets_forwarded += len(responses)
+            metrics.bytes_forwarded += sent_bytes
+            if batch_end >= next_publish_ns:
+                publish_metrics()
+        if ring:
+            # the packets of the batch have been sent : the block can be given back to the kernel if it has
+            # been fully read
+            ring.release()
+            more = ring.pending
+        else:
+            # receive_batch stops before batch_size packets only when the socket has been drained
+            more = len(batch) == start_cli_args.batch_size
+        if batch:
+            loop_stats.update(len(batch))
+        return more
+
+    # packets may have been queued before the socket has been registered in epoll : those would not trigger any event
+    readable = True
+    wakeup_packets = 0
 
     while True and not prog_break:
         try:
-            # last parameter for select.select is a timeout which makes it non-blocking
-            # without this parameter, the function is blocking until there's one socket ready
-            read_sockets, _, _ = select.select(sockets, [], [], 10)
-            for s_sock in read_sockets:
-                if s_sock == main_socket:
-                    data, addr = s_sock.recvfrom(65536)
-                    if start_cli_args.udp_only:
-                        logger.debug(f"GENEVE - Received UDP Geneve packet from {addr[0]}:{addr[1]}")
-                    else:
-                        logger.debug(f"GENEVE - Received raw packet from {addr[0]}:{addr[1]}")
-                    if (geneve_response_packet := geneve_handler(data, flow_tracker, start_cli_args.udp_only)):
-                        # we need to specify the destination of the packet (addr[0], config.GENEVE_PORT) only for the
-                        # case where we are using an UDP socket. When using RAW socket, this value needs to be there too
-                        # but is overrided by the values of the forged IP/UDP headers
-                        s_sock.sendto(geneve_response_packet, (addr[0], config.GENEVE_PORT))
-                        logger.debug(f"GENEVE - Packet forwarded")
-                if s_sock == health_socket:
-                    c_sock, c_addr = s_sock.accept()
-                    c_sock.settimeout(1.0)
-                    try:
-                        c_sock.recv(1024)
-                        logger.debug(f"HEALTH-CHECK - Received request from {c_addr[0]}:{c_addr[1]}")
-                        c_sock.send(http_healthcheck_response().encode('utf-8'))
-                    except socket.timeout:
-                        logger.warning(f"HEALTH-CHECK - Timeout raised on socket from {c_addr[0]}:{c_addr[1]}")
-                    finally:
-                        c_sock.close()
+            if readable:
+                phase_start = time.perf_counter_ns()
+                before = loop_stats.packets
+                readable = forward_batch()
+                wakeup_packets += loop_stats.packets - before
+                loop_stats.process_ns += time.perf_counter_ns() - phase_start
+
+                if not readable and busy_poll_ns and wakeup_packets >= config.BUSY_POLL_THRESHOLD:
+                    # the traffic is high : new packets should arrive soon, spin instead of sleeping in epoll
+                    phase_start = time.perf_counter_ns()
+                    deadline = phase_start + busy_poll_ns
+                    while not readable and time.perf_counter_ns() < deadline:
+                        readable = ring.pending if ring else bool(poller.poll(0))
+                    loop_stats.spin_ns += time.perf_counter_ns() - phase_start
+                # the traffic may never leave time for the socket to be drained
+                loop_stats.report()
+                if analytics and analytics.report_due():
+                    analytics.write_report(logger, analytics_path)
+                if profile_requested or snapshot_requested or profiler.running:
+                    diagnostics()
+                if sampling_control and sampling_control.check_due():
+                    sampling_control.check()
+                continue
+
+            phase_start = time.perf_counter_ns()
+            # a running profiling has to be ended on time, even without traffic
+            events = poller.poll(min(poll_timeout, 1) if profiler.running else poll_timeout)
+            loop_stats.poll_ns += time.perf_counter_ns() - phase_start
+            wakeup_packets = 0
+            for fd, _ in events:
+                if fd == wakeup_socket.fileno():
+                    # the signal handler has already been executed, the data only needs to be consumed
+                    wakeup_socket.recv(1024)
+                else:
+                    readable = True
+            loop_stats.report()
+            if analytics and analytics.report_due():
+                analytics.write_report(logger, analytics_path)
+            if profile_requested or snapshot_requested or profiler.running:
+                diagnostics()
+            if sampling_control and sampling_control.check_due():
+                sampling_control.check()
+            if metrics and time.perf_counter_ns() >= next_publish_ns:
+                publish_metrics()
         except KeyboardInterrupt:
             break
         except Exception as e:
             logger.error(f"Unexpected error : {e}")
 
+    loop_stats.report(force=True)
+    if analytics:
+        analytics.write_report(logger, analytics_path)
+    if profiler.running:
+        profiler.stop()
     logger.warning("Exit requested. Closing sockets...")
+    if flow_tracker:
+        flow_tracker.stop()
 
-    for s in sockets:
+    signal.set_wakeup_fd(-1)
+    poller.close()
+    for s in {main_socket, send_socket, wakeup_socket, signal_socket}:
         s.close()
 
-    logger.warning("Bye bye")
-
 
 def main():
     start_cli_args = cli_parser()
 
+    if start_cli_args.replay:
+        # no socket is used : the replay runs attached, without root permissions
+        configure_logging(
+            config.LOG_LEVEL if start_cli_args.log_level == "default" else start_cli_args.log_level,
+            "geneve-router",
+            logfile=start_cli_args.log_file
+        )
+        return replay_capture(start_cli_args)
+
     if not start_cli_args.udp_only:
         check_permission()
 
@@ -198,6 +820,44 @@ def main():
     return 0
 
 
+def replay_capture(start_cli_args):
+    """
+    Runs the packets of a capture file through geneve_handler (--replay) instead of listening on the network, and
+    prints the throughput and processing time report
+    """
+    flow_tracker = None
+    if start_cli_args.flow_tracker:
+        exporter = None
+        if start_cli_args.flow_export:
+            exporter = FlowExporter(logger, start_cli_args.flow_export)
+            exporter.start()
+        flow_tracker = FlowTracker(logger, exporter, open_flow_table(start_cli_args), start_cli_args.max_flows,
+                                   start_cli_args.max_half_open_flows, start_cli_args.flow_sampling,
+                                   start_cli_args.packet_sampling)
+    analytics = Analytics() if start_cli_args.analytics else None
+
+    try:
+        stats = replay(
+            start_cli_args.replay,
+            lambda packet: geneve_handler(packet, flow_tracker, validate_checksum=start_cli_args.validate_checksum,
+                                          policy=start_cli_args.policy, analytics=analytics),
+            start_cli_args.replay_output,
+            start_cli_args.replay_loops
+        )
+    except (OSError, PcapError) as e:
+        logger.error(f"REPLAY - Unable to replay {start_cli_args.replay} : {e}")
+        return 1
+    finally:
+        if flow_tracker:
+            flow_tracker.stop()
+
+    for line in stats.report():
+        print(line)
+    if analytics:
+        print('\n'.join(analytics.report()))
+    return 0
+
+
 def configure_logging(level, loggername, logfile, on_screen=True, force_logging=False):
     global logger
     logger = logging.getLogger(loggername)
@@ -218,25 +878,143 @@ def configure_logging(level, loggername, logfile, on_screen=True, force_logging=
     return logger, h
 
 
-def http_healthcheck_response():
-    body = "Healthy\n"
+def http_healthcheck_response(healthy=True):
+    body = "Healthy\n" if healthy else "Unhealthy\n"
+    status = "200 OK" if healthy else "503 Service Unavailable"
 
-    header = f"HTTP/1.1 200 OK\nContent-Type: text/html; charset=utf-8\nContent-Length: {len(body)}\nConnection: close"
+    header = f"HTTP/1.1 {status}\nContent-Type: text/html; charset=utf-8\nContent-Length: {len(body)}\nConnection: close"
     return header + '\n\n' + body
 
 
-def geneve_handler(geneve_packet, flow_tracker, udp_only=False):
+class LoopStats:
+    """
+    Keeps track of the number of packets drained from the Geneve socket on each wake-up, and of the time spent in each
+    phase of the main loop (blocked in epoll, busy-polling, processing packets). Periodically logs the average batch
+    fill, the phases time distribution and the packets dropped by the kernel (every config.BATCH_STATS_INTERVAL
+    seconds)
+    """
+
+    def __init__(self, batch_size, kernel_drops=None):
+        """
+        :param kernel_drops: (geneve_sockets.KernelDrops) Drops counter of the receive socket
+        """
+        self.batch_size = batch_size
+        self.kernel_drops = kernel_drops
+        self.batches = 0
+        self.packets = 0
+        self.poll_ns = 0
+        self.spin_ns = 0
+        self.process_ns = 0
+        self.last_report = time.monotonic()
+
+    def update(self, batch_length):
+        self.batches += 1
+        self.packets += batch_length
+
+    def report(self, force=False):
+        if not force and time.monotonic() - self.last_report < config.BATCH_STATS_INTERVAL:
+            return
+        if self.batches:
+            average_fill = self.packets / self.batches
+            logger.info(f"GENEVE - {self.packets} packets received in {self.batches} batches - Average batch fill "
+                        f"{average_fill:.1f}/{self.batch_size} ({average_fill * 100 / self.batch_size:.1f}%)")
+        total_ns = self.poll_ns + self.spin_ns + self.process_ns
+        if total_ns:
+            logger.info(f"GENEVE - Loop phases : "
+                        f"poll {self.poll_ns / 1e6:.0f}ms ({self.poll_ns * 100 / total_ns:.1f}%) "
+                        f"- spin {self.spin_ns / 1e6:.0f}ms ({self.spin_ns * 100 / total_ns:.1f}%) "
+                        f"- process {self.process_ns / 1e6:.0f}ms ({self.process_ns * 100 / total_ns:.1f}%)")
+        if self.kernel_drops and (drops := self.kernel_drops.delta()):
+            logger.warning(f"GENEVE - {drops} packets dropped by the kernel (receive queue full) - "
+                           f"{self.kernel_drops.drops} since start")
+        log_queue.report_drops()
+        self.batches = 0
+        self.packets = 0
+        self.poll_ns = 0
+        self.spin_ns = 0
+        self.process_ns = 0
+        self.last_report = time.monotonic()
+
+
+def receive_batch(geneve_socket, buffer_pool, batch_size, kernel_drops=None):
+    """
+    Drains up to batch_size packets from the Geneve socket into the buffers of buffer_pool, without blocking once the
+    socket has been reported as readable by select()
+
+    With kernel_drops, the first packet of the batch is received with recvmsg_into, to get the kernel drops counter
+    from its ancillary data. The other ones are received with recvfrom_into, which is cheaper.
+    :return: (list) List of (data, addr) tuples, data being a memoryview over the part of the pool buffer filled with
+             the packet
+    """
+    batch = list()
+    while len(batch) < batch_size:
+        buffer = buffer_pool[len(batch)]
+        try:
+            # MSG_DONTWAIT makes this single call non-blocking, while the socket itself stays blocking for sendto
+            # MSG_TRUNC makes recvfrom_into return the real length of the packet, even if it did not fit in the buffer
+            if kernel_drops and not batch:
+                nbytes, ancdata, _, addr = geneve_socket.recvmsg_into([buffer], RXQ_OVFL_CMSG_SIZE,
+                                                                      socket.MSG_DONTWAIT | socket.MSG_TRUNC)
+                if ancdata:
+                    kernel_drops.update(ancdata)
+            else:
+                nbytes, addr = geneve_socket.recvfrom_into(buffer, 0, socket.MSG_DONTWAIT | socket.MSG_TRUNC)
+        except BlockingIOError:
+            break
+        if nbytes > buffer_pool.buffer_size:
+            logger.warning(f"GENEVE - Dropping {nbytes} bytes packet from {addr[0]} "
+                           f"(larger than config.BUFFER_SIZE = {buffer_pool.buffer_size})")
+            continue
+        batch.append((buffer[:nbytes], addr))
+    return batch
+
+
+def flush_responses(geneve_socket, responses):
+    """
+    Sends back all the responses built for a batch of received packets
+    :return: (int) Number of bytes sent
+    """
+    sent_bytes = 0
+    for geneve_response_packet, destination in responses:
+        sent_bytes += geneve_socket.sendto(geneve_response_packet, destination)
+    if responses and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"GENEVE - {len(responses)} packets forwarded")
+    return sent_bytes
+
+
+def geneve_handler(geneve_packet, flow_tracker, udp_only=False, validate_checksum=False, metrics=None, policy=None,
+                   analytics=None):
     global logger
     try:
-        rec_packet = RawPacket(logger, geneve_packet, flow_tracker, udp_only)
+        rec_packet = RawPacket(logger, geneve_packet, flow_tracker, udp_only, validate_checksum=validate_checksum,
+                               metrics=metrics, policy=policy, analytics=analytics)
     except UnmatchedGenevePort:
         logger.debug("Ignoring packet received on non-Geneve port")
+        if metrics:
+            metrics.non_geneve_packets += 1
+        return None
+    except InvalidChecksum:
+        logger.warning("GENEVE - Dropping packet with invalid outter IPv4 header checksum")
+        if metrics:
+            metrics.invalid_checksum += 1
+        return None
+    except DroppedByPolicy:
+        logger.debug("POLICY - Dropping packet of a denied flow")
+        if metrics:
+            metrics.policy_drops += 1
+        return None
+    except NonSynBlocked:
+        logger.debug("FLOW-TRACKER - Dropping packet of a TCP flow not seen starting with a SYN")
+        if metrics:
+            metrics.nonsyn_blocked += 1
         return None
     except Exception as e:
         logger.error(f"Unknown error while parsing new packet : {e}")
+        if metrics:
+            metrics.parse_errors += 1
         return None
     return rec_packet.resp
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import mmap
+import struct
+import time
+import config
+from flow_export import TCP_STATE_CODES
+from flow_tracker import EVICTION_REASONS
+from health_check import HealthCheckServer
+
+# hot path counters, in the order they are published
+COUNTERS = (
+    ('packets_forwarded', "Geneve packets sent back"),
+    ('bytes_forwarded', "Bytes of the Geneve packets sent back"),
+    ('parse_errors', "Packets which could not be parsed"),
+    ('non_geneve_packets', "Packets received on another port than the Geneve port"),
+    ('unknown_inner_protocol', "Packets with an inner protocol other than ICMP, TCP or UDP"),
+    ('invalid_checksum', "Packets dropped because of an invalid outter IPv4 header checksum"),
+    ('policy_drops', "Packets dropped by the policy"),
+    ('nonsyn_blocked', "Packets dropped as the first packet of their TCP flow is not a SYN (config.TCP_NONSYN_BLOCK)"),
+)
+# upper bounds of the packet processing time histogram buckets (the last bucket being +Inf)
+LATENCY_BUCKETS_NS = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 500000, 1000000)
+FLOW_PROTOCOLS = {1: "icmp", 6: "tcp", 17: "udp"}
+FLOW_STATES = tuple(TCP_STATE_CODES)
+
+# published values of a worker : counters, processing time histogram buckets and sum, kernel drops, active flows
+# by protocol and state, flow evictions by reason, tracked flows memory, untracked flows packets and bytes, flow and
+# packet sampling rates, publication time
+SLOT_VALUES_COUNT = len(COUNTERS) + len(LATENCY_BUCKETS_NS) + 1 + 1 + 1 + len(FLOW_PROTOCOLS) * len(FLOW_STATES) \
+    + len(EVICTION_REASONS) + 1 + 2 + 2 + 1
+SLOT = struct.Struct(f'{SLOT_VALUES_COUNT}Q')
+
+
+class Metrics:
+    """
+    Counters of a worker, incremented on the packets processing path
+
+    These are plain attributes, only published (to a SharedMetrics slot) periodically, so updating them costs an
+    integer increment.
+    """
+
+    __slots__ = tuple(name for name, _ in COUNTERS) + ('latency_buckets', 'latency_sum_ns')
+
+    def __init__(self):
+        for name, _ in COUNTERS:
+            setattr(self, name, 0)
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS_NS) + 1)
+        self.latency_sum_ns = 0
+
+
+class SharedMetrics:
+    """
+    Metrics of all the workers, kept in an anonymous shared memory mapping
+
+    The mapping is created before the workers are forked. Each worker periodically publishes its values to its own
+    slot, and the metrics are aggregated from all the slots when scraped.
+    """
+
+    def __init__(self, workers_count):
+        self.workers_count = workers_count
+        self.map = mmap.mmap(-1, SLOT.size * workers_count)
+
+    def publish(self, worker_id, metrics, kernel_drops, flow_counts, flow_evictions=None, flow_memory=0,
+                untracked=(0, 0), sampling=(0, 0)):
+        """
+        :param metrics: (Metrics) Worker counters
+        :param kernel_drops: (int) Packets dropped by the kernel on the worker receive socket
+        :param flow_counts: (dict) Tracked flows count by (protocol, state)
+        :param flow_evictions: (dict) Evicted flows count by flow_tracker.EVICTION_REASONS
+        :param flow_memory: (int) Estimated memory used by the tracked flows, in bytes
+        :param untracked: (tuple) Estimated (packets, bytes) of the flows which are not tracked, from the sampled
+        packets
+        :param sampling: (tuple) (flow sampling rate, packet sampling rate) of the flow tracker
+        :return:
+        """
+        values = [getattr(metrics, name) for name, _ in COUNTERS]
+        values.extend(metrics.latency_buckets)
+        values.append(metrics.latency_sum_ns)
+        values.append(kernel_drops)
+        for protocol in FLOW_PROTOCOLS:
+            values.extend(max(flow_counts.get((protocol, state), 0), 0) for state in FLOW_STATES)
+        values.extend((flow_evictions or dict()).get(reason, 0) for reason in EVICTION_REASONS)
+        values.append(flow_memory)
+        values.extend(untracked)
+        values.extend(sampling)
+        values.append(int(time.time()))
+        SLOT.pack_into(self.map, SLOT.size * worker_id, *values)
+
+    def render(self):
+        """
+        Builds the Prometheus text exposition of the metrics of all the workers
+        :return: (str)
+        """
+        slots = [SLOT.unpack_from(self.map, SLOT.size * i) for i in range(self.workers_count)]
+        lines = list()
+
+        for index, (name, description) in enumerate(COUNTERS):
+            lines.append(f"# HELP geneve_router_{name}_total {description}")
+            lines.append(f"# TYPE geneve_router_{name}_total counter")
+            for worker_id, values in enumerate(slots):
+                lines.append(f'geneve_router_{name}_total{{worker="{worker_id}"}} {values[index]}')
+
+        index = len(COUNTERS)
+        lines.append("# HELP geneve_router_packet_processing_seconds Processing time of a Geneve packet")
+        lines.append("# TYPE geneve_router_packet_processing_seconds histogram")
+        for worker_id, values in enumerate(slots):
+            buckets = values[index:index + len(LATENCY_BUCKETS_NS) + 1]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS_NS + (None,), buckets):
+                cumulative += count
+                le = "+Inf" if bound is None else f"{bound / 1e9:g}"
+                lines.append(f'geneve_router_packet_processing_seconds_bucket{{worker="{worker_id}",le="{le}"}} '
+                             f'{cumulative}')
+            lines.append(f'geneve_router_packet_processing_seconds_sum{{worker="{worker_id}"}} '
+                         f'{values[index + len(LATENCY_BUCKETS_NS) + 1] / 1e9}')
+            lines.append(f'geneve_router_packet_processing_seconds_count{{worker="{worker_id}"}} {cumulative}')
+
+        index += len(LATENCY_BUCKETS_NS) + 2
+        lines.append("# HELP geneve_router_kernel_drops_total Packets dropped by the kernel on the receive socket")
+        lines.append("# TYPE geneve_router_kernel_drops_total counter")
+        for worker_id, values in enumerate(slots):
+            lines.append(f'geneve_router_kernel_drops_total{{worker="{worker_id}"}} {values[index]}')
+
+        index += 1
+        lines.append("# HELP geneve_router_active_flows Tracked flows, by inner protocol and state")
+        lines.append("# TYPE geneve_router_active_flows gauge")
+        for worker_id, values in enumerate(slots):
+            for p, protocol in enumerate(FLOW_PROTOCOLS.values()):
+                for s, state in enumerate(FLOW_STATES):
+                    count = values[index + p * len(FLOW_STATES) + s]
+                    # only TCP flows go through the states
+                    if count or protocol == "tcp" or state == "RUN":
+                        lines.append(f'geneve_router_active_flows{{worker="{worker_id}",protocol="{protocol}",'
+                                     f'state="{state or "NONE"}"}} {count}')
+
+        index += len(FLOW_PROTOCOLS) * len(FLOW_STATES)
+        lines.append("# HELP geneve_router_flows_evicted_total Tracked flows ended before their timeout, by reason")
+        lines.append("# TYPE geneve_router_flows_evicted_total counter")
+        for worker_id, values in enumerate(slots):
+            for r, reason in enumerate(EVICTION_REASONS):
+                lines.append(f'geneve_router_flows_evicted_total{{worker="{worker_id}",reason="{reason}"}} '
+                             f'{values[index + r]}')
+
+        index += len(EVICTION_REASONS)
+        lines.append("# HELP geneve_router_tracked_flows_memory_bytes Estimated memory used by the tracked flows")
+        lines.append("# TYPE geneve_router_tracked_flows_memory_bytes gauge")
+        for worker_id, values in enumerate(slots):
+            lines.append(f'geneve_router_tracked_flows_memory_bytes{{worker="{worker_id}"}} {values[index]}')
+
+        index += 1
+        for offset, (name, description) in enumerate((
+                ('untracked_packets', "Estimated packets of the flows not tracked, from the sampled packets"),
+                ('untracked_bytes', "Estimated bytes (inner L4 payload, as the flow records) of the flows not "
+                                    "tracked, from the sampled packets"))):
+            lines.append(f"# HELP geneve_router_{name}_total {description}")
+            lines.append(f"# TYPE geneve_router_{name}_total counter")
+            for worker_id, values in enumerate(slots):
+                lines.append(f'geneve_router_{name}_total{{worker="{worker_id}"}} {values[index + offset]}')
+
+        index += 2
+        for offset, (name, description) in enumerate((
+                ('flow_sampling_rate', "1 in N new flows are tracked (0 when the flow tracker is disabled)"),
+                ('packet_sampling_rate', "1 in N packets of the flows not tracked are counted (0 for none)"))):
+            lines.append(f"# HELP geneve_router_{name} {description}")
+            lines.append(f"# TYPE geneve_router_{name} gauge")
+            for worker_id, values in enumerate(slots):
+                lines.append(f'geneve_router_{name}{{worker="{worker_id}"}} {values[index + offset]}')
+
+        index += 2
+        lines.append("# HELP geneve_router_last_publish_timestamp_seconds Last time the worker published its metrics")
+        lines.append("# TYPE geneve_router_last_publish_timestamp_seconds gauge")
+        for worker_id, values in enumerate(slots):
+            lines.append(f'geneve_router_last_publish_timestamp_seconds{{worker="{worker_id}"}} {values[index]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(HealthCheckServer):
+    """
+    Serves the /metrics endpoint (Prometheus text format) on config.METRICS_PORT, from a dedicated thread
+    """
+
+    LOG_PREFIX = "METRICS"
+
+    def __init__(self, logger, shared_metrics, port=config.METRICS_PORT):
+        super().__init__(logger, shared_metrics.render, port)
+
+    def build_response(self, request):
+        if not request.startswith(b"GET /metrics"):
+            body = "Not found\n"
+            status = "404 Not Found"
+        else:
+            body = self.response()
+            status = "200 OK"
+        header = f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n" \
+                 f"Content-Length: {len(body)}\r\nConnection: close"
+        return header + '\r\n\r\n' + body
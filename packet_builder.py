@@ -0,0 +1,133 @@
+import socket
+from struct import Struct
+import config
+from headers import ipv4
+from headers.geneve import AWS_OPTION_CLASS, AWS_GWLBE_ID_TYPE, AWS_ATTACHMENT_ID_TYPE, AWS_FLOW_COOKIE_TYPE
+
+# TCP control bits
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+# Geneve protocol type of the inner packets sent by GWLB
+GENEVE_PROTOCOL_IPV4 = 0x0800
+
+UDP_HEADER = Struct('!HHHH')
+TCP_HEADER = Struct('!HHIIHHHH')
+ICMP_ECHO_HEADER = Struct('!BBHHH')
+GENEVE_HEADER = Struct('!BBH3sB')
+GENEVE_OPTION_HEADER = Struct('!HBB')
+
+
+def ipv4_packet(src_addr, dst_addr, protocol, payload, ttl=64, identification=0):
+    """
+    Builds an IPv4 packet (header without options, with a valid checksum)
+    :param src_addr: (str) Source address, dotted notation
+    :param dst_addr: (str) Destination address, dotted notation
+    :param protocol: (int) IP protocol of the payload
+    :param payload: (bytes) Packet payload
+    :return: (bytearray)
+    """
+    packet = bytearray(20)
+    ipv4.IPV4_HEADER.pack_into(packet, 0, 0x45, 0, 20 + len(payload), identification, 0, ttl, protocol, 0,
+                               socket.inet_aton(src_addr), socket.inet_aton(dst_addr))
+    packet[10:12] = ipv4.header_checksum(packet).to_bytes(2, 'big')
+    packet += payload
+    return packet
+
+
+def udp_datagram(src_port, dst_port, payload=b''):
+    """
+    Builds an UDP datagram (without checksum, which is optional over IPv4)
+    :return: (bytes)
+    """
+    return UDP_HEADER.pack(src_port, dst_port, 8 + len(payload), 0) + payload
+
+
+def tcp_segment(src_port, dst_port, flags, payload=b'', seq_num=0, ack_num=0, window=65535):
+    """
+    Builds a TCP segment (header without options, and without checksum : it is never verified by the router)
+    :param flags: (int) Control bits, as a combination of the TCP_* values
+    :return: (bytes)
+    """
+    return TCP_HEADER.pack(src_port, dst_port, seq_num, ack_num, (5 << 12) | flags, window, 0, 0) + payload
+
+
+def icmp_echo(identifier, sequence, payload=b'', request=True):
+    """
+    Builds an ICMP echo request (or reply) message
+    :return: (bytes)
+    """
+    message = bytearray(ICMP_ECHO_HEADER.pack(ICMP_ECHO_REQUEST if request else ICMP_ECHO_REPLY, 0, 0, identifier,
+                                              sequence) + payload)
+    message[2:4] = ipv4.header_checksum(message + b'\x00' * (len(message) % 2), 0,
+                                        len(message) + len(message) % 2).to_bytes(2, 'big')
+    return bytes(message)
+
+
+def aws_options(flow_cookie, gwlbe_id=0, attachment_id=0):
+    """
+    Builds the Geneve options added by GWLB (class 0x0108) : GWLB endpoint ID, attachment ID and flow cookie
+    :param flow_cookie: (int) 32-bits AWS flow cookie
+    :param gwlbe_id: (int) 64-bits GWLB endpoint ID
+    :param attachment_id: (int) 64-bits attachment ID
+    :return: (bytes)
+    """
+    return b''.join((
+        GENEVE_OPTION_HEADER.pack(AWS_OPTION_CLASS, AWS_GWLBE_ID_TYPE, 2), gwlbe_id.to_bytes(8, 'big'),
+        GENEVE_OPTION_HEADER.pack(AWS_OPTION_CLASS, AWS_ATTACHMENT_ID_TYPE, 2), attachment_id.to_bytes(8, 'big'),
+        GENEVE_OPTION_HEADER.pack(AWS_OPTION_CLASS, AWS_FLOW_COOKIE_TYPE, 1), flow_cookie.to_bytes(4, 'big'),
+    ))
+
+
+def geneve_payload(inner_packet, vni=0, options=b''):
+    """
+    Builds a Geneve header followed by the inner packet
+    :param inner_packet: (bytes) Encapsulated IPv4 packet
+    :param vni: (int) 24-bits Virtual Network Identifier
+    :param options: (bytes) Encoded options (their length has to be a multiple of 4 bytes)
+    :return: (bytes)
+    """
+    return GENEVE_HEADER.pack(len(options) // 4, 0, GENEVE_PROTOCOL_IPV4, vni.to_bytes(3, 'big'), 0) + options \
+        + inner_packet
+
+
+def gwlb_packet(inner_packet, flow_cookie, gwlb_addr="10.0.0.1", appliance_addr="10.0.0.2", src_port=50000,
+                gwlbe_id=0, attachment_id=0, vni=0, ttl=64):
+    """
+    Builds a Geneve packet as sent by GWLB to an appliance : outter IPv4 and UDP headers (to config.GENEVE_PORT),
+    Geneve header with the AWS options, and the inner packet
+    :param inner_packet: (bytes) Encapsulated IPv4 packet, e.g. built with inner_packet()
+    :param flow_cookie: (int) 32-bits AWS flow cookie
+    :param gwlb_addr: (str) Outter source address (GWLB node)
+    :param appliance_addr: (str) Outter destination address (router)
+    :param src_port: (int) Outter UDP source port, which GWLB derives from the flow hash
+    :return: (bytearray)
+    """
+    payload = geneve_payload(inner_packet, vni, aws_options(flow_cookie, gwlbe_id, attachment_id))
+    return ipv4_packet(gwlb_addr, appliance_addr, 17, udp_datagram(src_port, config.GENEVE_PORT, payload), ttl)
+
+
+def inner_packet(protocol, src_addr, dst_addr, src_port=0, dst_port=0, flags=TCP_ACK, payload=b'', ttl=64):
+    """
+    Builds an inner IPv4 packet carrying a TCP segment, an UDP datagram or an ICMP echo request
+    :param protocol: (int) 6 (TCP), 17 (UDP) or 1 (ICMP)
+    :param src_port: (int) Source port (ICMP echo identifier)
+    :param dst_port: (int) Destination port (ICMP echo sequence number)
+    :param flags: (int) TCP control bits
+    :return: (bytearray)
+    """
+    if protocol == 6:
+        l4 = tcp_segment(src_port, dst_port, flags, payload)
+    elif protocol == 17:
+        l4 = udp_datagram(src_port, dst_port, payload)
+    elif protocol == 1:
+        l4 = icmp_echo(src_port, dst_port, payload)
+    else:
+        raise ValueError(f"Unsupported inner protocol {protocol}")
+    return ipv4_packet(src_addr, dst_addr, protocol, l4, ttl)
@@ -0,0 +1,133 @@
+import mmap
+import socket
+import struct
+import config
+from geneve_sockets import ETH_P_IP, SOL_PACKET, PACKET_FANOUT, PACKET_FANOUT_HASH, PACKET_FANOUT_FLAG_DEFRAG, \
+    PACKET_IGNORE_OUTGOING, geneve_bpf_filter, attach_filter
+
+# Linux constants which are not exposed by the socket module
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3 : block size, blocks count, frame size, frames count, block retire timeout (ms),
+# private area size, features
+TPACKET_REQ3 = struct.Struct('IIIIIII')
+# struct tpacket_block_desc : version, offset to private area, and the tpacket_hdr_v1 fields we need
+# (block status, packets count, offset to the first packet)
+BLOCK_DESC = struct.Struct('IIIII')
+# struct tpacket3_hdr : next packet offset, sec, nsec, snaplen, len, status, mac offset, network offset
+TPACKET3_HDR = struct.Struct('IIIIIIHH')
+# the struct sockaddr_ll follows the (aligned) tpacket3_hdr. sll_pkttype is at offset 10 of it
+SLL_PKTTYPE_OFFSET = 48 + 10
+
+
+class PacketRing:
+    """
+    AF_PACKET receive engine using a PACKET_MMAP TPACKET_V3 RX ring
+
+    A classic BPF filter is attached to the socket, so only the Geneve packets (UDP to config.GENEVE_PORT) are copied
+    into the ring by the kernel : the other packets never reach Python. The ring is made of
+    config.RING_BLOCKS_COUNT blocks of config.RING_BLOCK_SIZE bytes, mmap'd in the process memory. The kernel fills a
+    block with as many packets as possible, and hands it over to userspace when it is full, or after
+    config.RING_BLOCK_TIMEOUT ms.
+
+    Packets are returned as memoryview slices of the ring (no copy), which can be patched in place. A block is given
+    back to the kernel by release(), once the packets read from it have been sent back.
+    The ring can only receive : responses are sent using a raw IP socket.
+    """
+
+    def __init__(self, fanout_group=None):
+        self.block_size = config.RING_BLOCK_SIZE
+        self.blocks_count = config.RING_BLOCKS_COUNT
+        frame_size = config.RING_FRAME_SIZE
+
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+        attach_filter(self.socket, geneve_bpf_filter())
+        # the outgoing packets (including our own responses) are not even handed to the filter, which rejects them
+        self.socket.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+        self.socket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        self.socket.setsockopt(SOL_PACKET, PACKET_RX_RING, TPACKET_REQ3.pack(
+            self.block_size,
+            self.blocks_count,
+            frame_size,
+            self.block_size // frame_size * self.blocks_count,
+            config.RING_BLOCK_TIMEOUT,
+            0,
+            0
+        ))
+        self.ring = mmap.mmap(self.socket.fileno(), self.block_size * self.blocks_count,
+                              mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.view = memoryview(self.ring)
+
+        if fanout_group is not None:
+            # the fanout group has to be joined once the ring is set up
+            self.socket.setsockopt(SOL_PACKET, PACKET_FANOUT, struct.pack(
+                'I', fanout_group | ((PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG) << 16)))
+
+        # current block index, and position of the next packet to read in it
+        self.block_index = 0
+        self.packets_left = 0
+        self.packet_offset = 0
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    @property
+    def pending(self):
+        """
+        Tells if packets can be read from the ring without waiting for the kernel
+        :return: (bool)
+        """
+        if self.packets_left:
+            return True
+        return bool(BLOCK_DESC.unpack_from(self.ring, self.block_index * self.block_size)[2] & TP_STATUS_USER)
+
+    def receive_batch(self, batch_size):
+        """
+        Reads up to batch_size packets from the current block of the ring
+        :return: (list) List of (data, addr) tuples, data being a memoryview over the IP packet in the ring, and
+                 addr the (source IP address, 0) tuple, as returned by recvfrom on a raw socket
+        """
+        block_offset = self.block_index * self.block_size
+        if not self.packets_left:
+            _, _, block_status, packets_count, first_packet_offset = BLOCK_DESC.unpack_from(self.ring, block_offset)
+            if not block_status & TP_STATUS_USER:
+                return list()
+            self.packets_left = packets_count
+            self.packet_offset = block_offset + first_packet_offset
+
+        batch = list()
+        while self.packets_left and len(batch) < batch_size:
+            next_offset, _, _, snaplen, length, _, _, net_offset = TPACKET3_HDR.unpack_from(self.ring,
+                                                                                             self.packet_offset)
+            # packets larger than a block are truncated by the kernel. They can't be forwarded
+            if snaplen == length and self.ring[self.packet_offset + SLL_PKTTYPE_OFFSET] != socket.PACKET_OUTGOING:
+                start = self.packet_offset + net_offset
+                data = self.view[start:start + snaplen]
+                batch.append((data, (socket.inet_ntoa(data[12:16]), 0)))
+            self.packets_left -= 1
+            self.packet_offset += next_offset
+        return batch
+
+    def release(self):
+        """
+        Gives the current block back to the kernel if all its packets have been read. Must be called only once the
+        packets of the last batch are not used anymore
+        """
+        if not self.packets_left:
+            block_offset = self.block_index * self.block_size
+            if BLOCK_DESC.unpack_from(self.ring, block_offset)[2] & TP_STATUS_USER:
+                struct.pack_into('I', self.ring, block_offset + 8, TP_STATUS_KERNEL)
+                self.block_index = (self.block_index + 1) % self.blocks_count
+
+    def close(self):
+        try:
+            self.view.release()
+            self.ring.close()
+        except BufferError:
+            # packets views are still referenced somewhere. The mapping is released with the process
+            pass
+        self.socket.close()
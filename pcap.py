@@ -0,0 +1,239 @@
+import mmap
+import struct
+
+# link-layer header types (https://www.tcpdump.org/linktypes.html)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+# magic, version major, version minor, timezone offset, timestamps accuracy, snapshot length, link-layer type
+PCAP_HEADER = struct.Struct('IHHiIII')
+# seconds, microseconds (or nanoseconds), captured length, original length
+PCAP_RECORD = 'IIII'
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPTION_TSRESOL = 9
+
+
+class PcapError(Exception):
+    "raised when the capture file format or its link-layer type is not supported"
+    pass
+
+
+def network_layer(linktype, data):
+    """
+    Strips the link-layer header of a captured frame
+    :return: (memoryview) The IPv4 packet, or None if the frame is not carrying IPv4
+    """
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        start = 0
+    elif linktype == LINKTYPE_ETHERNET:
+        start = 12
+        ethertype = int.from_bytes(data[start:start + 2], 'big')
+        while ethertype in ETHERTYPE_VLAN:
+            start += 4
+            ethertype = int.from_bytes(data[start:start + 2], 'big')
+        if ethertype != ETHERTYPE_IPV4:
+            return None
+        start += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if int.from_bytes(data[14:16], 'big') != ETHERTYPE_IPV4:
+            return None
+        start = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if int.from_bytes(data[0:2], 'big') != ETHERTYPE_IPV4:
+            return None
+        start = 20
+    elif linktype == LINKTYPE_NULL:
+        # the address family is written in the byte order of the capturing host. AF_INET is 2 everywhere
+        if data[0:4] not in (b'\x02\x00\x00\x00', b'\x00\x00\x00\x02'):
+            return None
+        start = 4
+    else:
+        raise PcapError(f"Unsupported link-layer type {linktype}")
+    if len(data) < start + 20 or data[start] >> 4 != 4:
+        return None
+    return data[start:]
+
+
+class PcapReader:
+    """
+    Reads the IPv4 packets of a pcap or pcapng capture file
+
+    The file is memory-mapped, and the packets are returned as read-only memoryview slices of the mapping : they are
+    never copied, and the file is not loaded in memory. The link-layer header (Ethernet, with VLAN tags, Linux cooked
+    capture, BSD loopback) is skipped, so each packet starts with its IPv4 header.
+    Non-IPv4 frames and packets truncated by the capture snapshot length are skipped, and counted in skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.skipped = 0
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise PcapError(f"{path} is empty")
+        self.view = memoryview(self.map)
+        if len(self.map) < 24:
+            self.close()
+            raise PcapError(f"{path} is not a pcap or pcapng file")
+        self.pcapng = struct.unpack_from('I', self.map)[0] == PCAPNG_SHB
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        """
+        :return: (generator) (timestamp, packet) tuples, timestamp being the capture time in seconds since epoch and
+                 packet a memoryview over the IPv4 packet
+        """
+        records = self.pcapng_records() if self.pcapng else self.pcap_records()
+        for timestamp, linktype, data in records:
+            packet = network_layer(linktype, data)
+            if packet is None:
+                self.skipped += 1
+                continue
+            yield timestamp, packet
+
+    def pcap_records(self):
+        magic = struct.unpack_from('<I', self.map)[0]
+        if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            byte_order = '<'
+        elif struct.unpack_from('>I', self.map)[0] in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            byte_order = '>'
+            magic = struct.unpack_from('>I', self.map)[0]
+        else:
+            raise PcapError(f"{self.path} is not a pcap or pcapng file")
+        linktype = struct.unpack_from(byte_order + 'I', self.map, 20)[0] & 0xFFFF
+        resolution = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        record = struct.Struct(byte_order + PCAP_RECORD)
+
+        offset = 24
+        while offset + record.size <= len(self.map):
+            seconds, fraction, captured_length, original_length = record.unpack_from(self.map, offset)
+            offset += record.size
+            if offset + captured_length > len(self.map):
+                # the capture has been interrupted while writing this record
+                break
+            if captured_length < original_length:
+                self.skipped += 1
+            else:
+                yield seconds + fraction * resolution, linktype, self.view[offset:offset + captured_length]
+            offset += captured_length
+
+    def pcapng_records(self):
+        byte_order = '<'
+        # link-layer type and timestamps resolution of each interface of the current section
+        interfaces = list()
+        offset = 0
+        while offset + 12 <= len(self.map):
+            block_type, block_length = struct.unpack_from(byte_order + 'II', self.map, offset)
+            if block_type == PCAPNG_SHB:
+                # each section has its own byte order and interfaces
+                byte_order = '<' if struct.unpack_from('<I', self.map, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC \
+                    else '>'
+                block_length = struct.unpack_from(byte_order + 'I', self.map, offset + 4)[0]
+                interfaces = list()
+            if block_length < 12 or offset + block_length > len(self.map):
+                break
+
+            if block_type == PCAPNG_IDB:
+                if block_length < 20:
+                    raise PcapError(f"{self.path} : truncated interface description block at offset {offset}")
+                linktype = struct.unpack_from(byte_order + 'H', self.map, offset + 8)[0]
+                interfaces.append((linktype, self.timestamps_resolution(byte_order, offset + 16,
+                                                                        offset + block_length - 4)))
+            elif block_type == PCAPNG_EPB:
+                if block_length < 32:
+                    raise PcapError(f"{self.path} : truncated enhanced packet block at offset {offset}")
+                interface_id, timestamp_high, timestamp_low, captured_length, original_length = struct.unpack_from(
+                    byte_order + 'IIIII', self.map, offset + 8)
+                if interface_id >= len(interfaces):
+                    raise PcapError(f"{self.path} : packet of unknown interface {interface_id} at offset {offset}")
+                if captured_length > block_length - 32:
+                    raise PcapError(f"{self.path} : truncated enhanced packet block at offset {offset}")
+                linktype, resolution = interfaces[interface_id]
+                if captured_length < original_length:
+                    self.skipped += 1
+                else:
+                    yield ((timestamp_high << 32 | timestamp_low) * resolution, linktype,
+                           self.view[offset + 28:offset + 28 + captured_length])
+            elif block_type == PCAPNG_SPB and interfaces:
+                # simple packet blocks have no timestamp, and always belong to the first interface
+                original_length = struct.unpack_from(byte_order + 'I', self.map, offset + 8)[0]
+                if original_length > block_length - 16:
+                    self.skipped += 1
+                else:
+                    yield 0.0, interfaces[0][0], self.view[offset + 12:offset + 12 + original_length]
+            offset += block_length
+
+    def timestamps_resolution(self, byte_order, offset, end):
+        """
+        Reads the if_tsresol option of an interface description block
+        :return: (float) Duration of a timestamp unit, in seconds
+        """
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(byte_order + 'HH', self.map, offset)
+            if code == 0:
+                break
+            if code == PCAPNG_OPTION_TSRESOL:
+                value = self.map[offset + 4]
+                return 2 ** -(value & 0x7F) if value & 0x80 else 10 ** -value
+            offset += 4 + (length + 3) // 4 * 4
+        return 1e-6
+
+    def close(self):
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
+            # packets views are still referenced somewhere. The mapping is released with the process
+            pass
+        self.file.close()
+
+
+class PcapWriter:
+    """
+    Writes IPv4 packets to a pcap file (LINKTYPE_RAW, microseconds timestamps)
+    """
+
+    def __init__(self, path, snaplen=65535):
+        self.file = open(path, 'wb')
+        self.record = struct.Struct(PCAP_RECORD)
+        self.file.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, snaplen, LINKTYPE_RAW))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, packet, timestamp=0.0):
+        """
+        :param packet: (bytes-like) IPv4 packet
+        :param timestamp: (float) Time in seconds since epoch
+        :return:
+        """
+        seconds = int(timestamp)
+        self.file.write(self.record.pack(seconds, int((timestamp - seconds) * 1e6), len(packet), len(packet)))
+        self.file.write(packet)
+
+    def close(self):
+        self.file.close()
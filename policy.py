@@ -0,0 +1,337 @@
+import ipaddress
+from bisect import bisect_right
+from collections import OrderedDict
+from time import monotonic
+from struct import Struct
+import config
+
+PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17}
+ACTIONS = {"allow": True, "drop": False}
+# inner TCP / UDP source and destination ports
+L4_PORTS = Struct('!HH')
+
+
+class PolicyError(Exception):
+    "raised when a policy file can't be parsed"
+    pass
+
+
+class Rule:
+    """
+    Allow or drop rule, matching the inner packets on their 5-tuple and on the Geneve VNI and GWLB endpoint ID.
+    A None field matches any value
+    """
+
+    __slots__ = ('line', 'allow', 'protocol', 'src_net', 'dst_net', 'src_ports', 'dst_ports', 'vni', 'gwlbe_id')
+
+    def __init__(self, line, allow, protocol=None, src_net=None, dst_net=None, src_ports=None, dst_ports=None,
+                 vni=None, gwlbe_id=None):
+        """
+        :param line: (int) Line of the rule in the policy file
+        :param allow: (bool) Action of the rule
+        :param src_net: (tuple) (network address, prefix length) of the inner source address
+        :param src_ports: (tuple) (lowest, highest) inner source port. Only TCP and UDP packets match a port range
+        """
+        self.line = line
+        self.allow = allow
+        self.protocol = protocol
+        self.src_net = src_net
+        self.dst_net = dst_net
+        self.src_ports = src_ports
+        self.dst_ports = dst_ports
+        self.vni = vni
+        self.gwlbe_id = gwlbe_id
+
+    def __repr__(self):
+        return f"Rule line {self.line} - {'allow' if self.allow else 'drop'} - IP {self.protocol} - " \
+               f"SRC {self.src_net}:{self.src_ports} - DST {self.dst_net}:{self.dst_ports} - VNI {self.vni} - " \
+               f"GWLBE {self.gwlbe_id}"
+
+
+def parse_network(value):
+    network = ipaddress.IPv4Network(value, strict=False)
+    return int(network.network_address), network.prefixlen
+
+
+def parse_ports(value):
+    low, _, high = value.partition('-')
+    ports = (int(low), int(high or low))
+    if not 0 <= ports[0] <= ports[1] <= 65535:
+        raise ValueError(f"invalid port range {value}")
+    return ports
+
+
+def parse_protocol(value):
+    protocol = PROTOCOLS[value] if value in PROTOCOLS else int(value)
+    if not 0 <= protocol <= 255:
+        raise ValueError(f"invalid protocol {value}")
+    return protocol
+
+
+FIELD_PARSERS = {
+    "proto": ("protocol", parse_protocol),
+    "src": ("src_net", parse_network),
+    "dst": ("dst_net", parse_network),
+    "sport": ("src_ports", parse_ports),
+    "dport": ("dst_ports", parse_ports),
+    "vni": ("vni", lambda value: int(value, 0)),
+    "gwlbe": ("gwlbe_id", lambda value: int(value, 0)),
+}
+
+
+def read_policy(path):
+    """
+    Reads a policy file. Each line is either a rule, or the default action :
+
+        <allow|drop> [proto <tcp|udp|icmp|number>] [src <cidr>] [dst <cidr>] [sport <port[-port]>]
+                     [dport <port[-port]>] [vni <number>] [gwlbe <number>]
+        default <allow|drop>
+
+    Any field can be omitted or set to "any". Empty lines and comments (starting with #) are ignored.
+    :param path: (str) Policy file
+    :return: (tuple) (list of Rule, default action or None if not set)
+    """
+    rules = list()
+    default_allow = None
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            tokens = line.split('#', 1)[0].split()
+            if not tokens:
+                continue
+            action = tokens[0].lower()
+            if action == "default":
+                if len(tokens) != 2 or tokens[1].lower() not in ACTIONS:
+                    raise PolicyError(f"line {line_number} : expected 'default allow' or 'default drop'")
+                default_allow = ACTIONS[tokens[1].lower()]
+                continue
+            if action not in ACTIONS:
+                raise PolicyError(f"line {line_number} : unknown action '{tokens[0]}'")
+            if len(tokens) % 2 == 0:
+                raise PolicyError(f"line {line_number} : missing value of field '{tokens[-1]}'")
+            fields = dict()
+            for name, value in zip(tokens[1::2], tokens[2::2]):
+                name = name.lower()
+                if name not in FIELD_PARSERS:
+                    raise PolicyError(f"line {line_number} : unknown field '{name}' (expected one of "
+                                      f"{', '.join(FIELD_PARSERS)})")
+                attribute, parse = FIELD_PARSERS[name]
+                if value.lower() == "any":
+                    continue
+                try:
+                    fields[attribute] = parse(value.lower())
+                except ValueError as e:
+                    raise PolicyError(f"line {line_number} : invalid {name} '{value}' ({e})")
+            rules.append(Rule(line_number, ACTIONS[action], **fields))
+    return rules, default_allow
+
+
+class PrefixTable:
+    """
+    Longest prefix match of an IPv4 address, returning the rules (as a bit mask) whose prefix contains the address
+
+    The prefixes are kept in one hash table per prefix length, which are looked up from the longest length : the cost
+    is one dict lookup per distinct prefix length, whatever the number of prefixes. Each prefix is stored with the
+    rules of all the shorter prefixes containing it, so the lookup stops at the first (longest) match.
+    """
+
+    def __init__(self, prefixes):
+        """
+        :param prefixes: (list) (network address, prefix length, rule bit) tuples
+        """
+        own = dict()
+        for network, length, bit in prefixes:
+            key = (length, network >> (32 - length))
+            own[key] = own.get(key, 0) | bit
+        lengths = sorted({length for length, _ in own} | {0}, reverse=True)
+        tables = {length: dict() for length in lengths}
+        for (length, prefix), bits in own.items():
+            for shorter in lengths:
+                if shorter < length:
+                    bits |= own.get((shorter, prefix >> (length - shorter)), 0)
+            tables[length][prefix] = bits
+        tables[0].setdefault(0, 0)
+        # (shift of the address, table) by decreasing prefix length
+        self.levels = tuple((32 - length, tables[length]) for length in lengths)
+
+    def lookup(self, address):
+        for shift, table in self.levels:
+            bits = table.get(address >> shift)
+            if bits is not None:
+                return bits
+        return 0
+
+
+class IntervalTable:
+    """
+    Port ranges lookup, returning the rules (as a bit mask) whose range contains the port
+
+    The ranges bounds split the ports in elementary intervals, each one stored with the rules covering it, and the
+    interval of a port is found with a binary search.
+    """
+
+    def __init__(self, ranges):
+        """
+        :param ranges: (list) (lowest, highest, rule bit) tuples
+        """
+        toggles = dict()
+        for low, high, bit in ranges:
+            # a rule bit is set at the start of its range, and cleared after its end
+            toggles[low] = toggles.get(low, 0) ^ bit
+            if high < 65535:
+                toggles[high + 1] = toggles.get(high + 1, 0) ^ bit
+        self.bounds = sorted(toggles.keys() | {0})
+        self.masks = list()
+        bits = 0
+        for bound in self.bounds:
+            bits ^= toggles.get(bound, 0)
+            self.masks.append(bits)
+
+    def lookup(self, port):
+        return self.masks[bisect_right(self.bounds, port) - 1]
+
+
+class Policy:
+    """
+    Allow / drop policy applied to the inner packets, with a first match semantic (the rules are evaluated in the
+    policy file order)
+
+    The rules are compiled into one lookup table per field, each returning the set of rules matching the field value
+    as a bit mask (bit i for the rule i) : longest prefix match tables for the addresses, interval tables for the
+    ports, and dicts for the protocol, VNI and GWLB endpoint ID. The rules matching a packet are the intersection of
+    the masks, and the first one is the lowest bit set, so the cost of an evaluation barely depends on the number of
+    rules.
+
+    Only the first packet of a flow is evaluated, and its verdict applies to all the packets of the flow, in both
+    directions. The verdict of a flow tracked by the flow tracker is kept with the flow (flow_tracker.Flow.allowed),
+    and ends with it. The other verdicts (dropped flows, flows not tracked) are cached by AWS flow cookie, with the
+    inner 5-tuple of the flow : a packet only gets the verdict of the flow with the same cookie and 5-tuple, and is
+    evaluated otherwise. The cache holds up to config.POLICY_CACHE_SIZE verdicts, the least recently used one being
+    removed first, and a verdict expires config.POLICY_CACHE_TIMEOUT seconds after the last packet of its flow.
+    """
+
+    def __init__(self, rules, default_allow=config.POLICY_DEFAULT == "allow", cache_size=config.POLICY_CACHE_SIZE,
+                 cache_timeout=config.POLICY_CACHE_TIMEOUT):
+        """
+        :param rules: (list) Rule objects, in evaluation order
+        :param default_allow: (bool) Verdict of the packets matching no rule
+        """
+        self.rules = rules
+        self.default_allow = default_allow
+        self.cache_size = cache_size
+        self.cache_timeout = cache_timeout
+        # (5-tuple, verdict, expiry time) by AWS flow cookie, in least recently used order
+        self.verdicts = OrderedDict()
+        self.evaluations = 0
+        all_rules = (1 << len(rules)) - 1
+
+        def exact_table(attribute):
+            """
+            :return: (tuple) (dict of the rules by field value, rules matching any value)
+            """
+            any_bits = sum(1 << i for i, rule in enumerate(rules) if getattr(rule, attribute) is None)
+            values = dict()
+            for i, rule in enumerate(rules):
+                if getattr(rule, attribute) is not None:
+                    values[getattr(rule, attribute)] = values.get(getattr(rule, attribute), any_bits) | 1 << i
+            return values, any_bits
+
+        self.protocols, self.any_protocol = exact_table("protocol")
+        self.vnis, self.any_vni = exact_table("vni")
+        self.gwlbe_ids, self.any_gwlbe_id = exact_table("gwlbe_id")
+        self.src_nets = PrefixTable([rule.src_net + (1 << i,) if rule.src_net else (0, 0, 1 << i)
+                                     for i, rule in enumerate(rules)])
+        self.dst_nets = PrefixTable([rule.dst_net + (1 << i,) if rule.dst_net else (0, 0, 1 << i)
+                                     for i, rule in enumerate(rules)])
+        self.src_ports = IntervalTable([rule.src_ports + (1 << i,) if rule.src_ports else (0, 65535, 1 << i)
+                                        for i, rule in enumerate(rules)])
+        self.dst_ports = IntervalTable([rule.dst_ports + (1 << i,) if rule.dst_ports else (0, 65535, 1 << i)
+                                        for i, rule in enumerate(rules)])
+        # rules matching the packets without ports (other than TCP and UDP)
+        self.portless = all_rules & ~sum(1 << i for i, rule in enumerate(rules)
+                                         if rule.src_ports or rule.dst_ports)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        :param path: (str) Policy file (see read_policy for the format)
+        :return: (Policy)
+        """
+        rules, default_allow = read_policy(path)
+        return cls(rules) if default_allow is None else cls(rules, default_allow)
+
+    def evaluate(self, protocol, src_addr, dst_addr, src_port, dst_port, vni, gwlbe_id):
+        """
+        :param src_addr: (int) Inner source address
+        :param src_port: (int) Inner source port, ignored if the protocol is not TCP or UDP
+        :return: (Rule) First matching rule, None if no rule matches
+        """
+        self.evaluations += 1
+        bits = self.protocols.get(protocol, self.any_protocol) & self.src_nets.lookup(src_addr) \
+            & self.dst_nets.lookup(dst_addr) & self.vnis.get(vni, self.any_vni) \
+            & self.gwlbe_ids.get(gwlbe_id, self.any_gwlbe_id)
+        if bits:
+            if protocol == 6 or protocol == 17:
+                bits &= self.src_ports.lookup(src_port) & self.dst_ports.lookup(dst_port)
+            else:
+                bits &= self.portless
+        if not bits:
+            return None
+        # the lowest bit set is the first matching rule
+        return self.rules[(bits & -bits).bit_length() - 1]
+
+    def allows(self, packet, flow_tracker=None):
+        """
+        :param packet: (rawpacket.RawPacket) Received packet
+        :param flow_tracker: (flow_tracker.FlowTracker) Flow tracker holding the verdicts of the tracked flows, if any
+        :return: (bool) Verdict of the flow of the packet
+        """
+        data = packet.raw_data
+        protocol = packet.inner_protocol
+        src_addr, dst_addr = packet.inner_addresses
+        src_port = dst_port = 0
+        if protocol == 6 or protocol == 17:
+            # the ports are read right after the inner IPv4 header
+            src_port, dst_port = L4_PORTS.unpack_from(data, packet.inner_start + (data[packet.inner_start] & 0x0F) * 4)
+        flow_cookie = packet.flow_cookie
+        # packets without flow cookie are evaluated one by one
+        if flow_cookie is None:
+            return self.verdict(protocol, src_addr, dst_addr, src_port, dst_port, packet)
+
+        if flow_tracker is not None:
+            flow = flow_tracker.tracked_flows.get(flow_cookie)
+            # the verdict of a tracked flow only applies to the packets with its 5-tuple, in either direction
+            if flow is not None and flow.protocol == protocol:
+                flow_ends = (flow.src_addr, flow.src_port, flow.dst_addr, flow.dst_port)
+                if flow_ends == (src_addr, src_port, dst_addr, dst_port) \
+                        or flow_ends == (dst_addr, dst_port, src_addr, src_port):
+                    return flow.allowed
+
+        # both directions of a flow have the same key
+        if (src_addr, src_port) <= (dst_addr, dst_port):
+            key = (protocol, src_addr, src_port, dst_addr, dst_port)
+        else:
+            key = (protocol, dst_addr, dst_port, src_addr, src_port)
+        now = monotonic()
+        entry = self.verdicts.get(flow_cookie)
+        if entry is not None and entry[0] == key and entry[2] > now:
+            self.verdicts[flow_cookie] = (key, entry[1], now + self.cache_timeout)
+            self.verdicts.move_to_end(flow_cookie)
+            return entry[1]
+        verdict = self.verdict(protocol, src_addr, dst_addr, src_port, dst_port, packet)
+        if entry is None and len(self.verdicts) >= self.cache_size:
+            self.verdicts.popitem(last=False)
+        self.verdicts[flow_cookie] = (key, verdict, now + self.cache_timeout)
+        self.verdicts.move_to_end(flow_cookie)
+        return verdict
+
+    def verdict(self, protocol, src_addr, dst_addr, src_port, dst_port, packet):
+        """
+        Evaluates a packet
+        :param packet: (rawpacket.RawPacket) Packet, for its Geneve VNI and GWLB endpoint ID
+        :return: (bool) Verdict of the packet
+        """
+        data = packet.raw_data
+        rule = self.evaluate(protocol, src_addr, dst_addr, src_port, dst_port,
+                             int.from_bytes(data[packet.geneve_start + 4:packet.geneve_start + 7], 'big'),
+                             packet.aws_options[1])
+        return self.default_allow if rule is None else rule.allow
@@ -1,59 +1,211 @@
+import logging
+from struct import Struct
 from headers import ipv4, icmp, tcp, udp, geneve
 import config
 
+# outter IPv4 header (without options), UDP header and Geneve fixed header, decoded with a single call
+OUTTER_HEADERS = Struct('!BBHHHBBH4s4sHHHHBBH3sB')
+OUTTER_HEADERS_LENGTH = OUTTER_HEADERS.size
+# inner IPv4 source and destination addresses, as integers
+IPV4_ADDRESSES = Struct('!II')
+IPV4_ADDRESSES_OFFSET = 12
+
 
 class UnmatchedGenevePort(Exception):
-    "raised when the UDP destination port is not matching config.GENEVE_PORT"
+    "raised when the packet is not UDP, or when the UDP destination port is not matching config.GENEVE_PORT"
+    pass
+
+
+class InvalidChecksum(Exception):
+    "raised when the outter IPv4 header checksum is not valid"
+    pass
+
+
+class DroppedByPolicy(Exception):
+    "raised when the flow of the packet is dropped by the policy"
+    pass
+
+
+class NonSynBlocked(Exception):
+    "raised when the first packet of a TCP flow seen by the flow tracker is not a SYN, with config.TCP_NONSYN_BLOCK"
     pass
 
 
 class RawPacket:
-    def __init__(self, logger, raw_geneve_packet, flow_tracker, udp_only):
+    """
+    Parsed representation of a received Geneve packet
+
+    raw_geneve_packet is expected to be a writable buffer (usually a memoryview over a buffer_pool.BufferPool buffer),
+    as the outter IPv4 header is rewritten in place when coming from the raw socket.
+
+    With lazy parsing (config.LAZY_PARSING), only the fixed fields needed to route the packet back are decoded when
+    the packet is received (with a single unpack_from call for the outter IPv4, UDP and Geneve headers). The header
+    objects (outter_ipv4, outter_udp, geneve, inner_ipv4, inner_l4) are only built when they are accessed, for example
+    by the flow tracker. Without lazy parsing, they are all built when the packet is received.
+
+    The outter IPv4 header checksum is updated incrementally for the TTL decrement. With validate_checksum, the
+    checksum of the received outter header is verified first (the raw socket gets it from the IP stack, which already
+    drops invalid headers, but the AF_PACKET socket does not).
+    metrics is the metrics.Metrics instance of the worker, if enabled.
+    With a policy (policy.Policy), the packets of the dropped flows are neither tracked nor routed back. So are the
+    packets of the TCP flows blocked by the flow tracker (not seen starting with a SYN, with config.TCP_NONSYN_BLOCK).
+    With analytics (analytics.Analytics), the forwarded packets are added to the traffic analytics.
+    """
+
+    __slots__ = ('udp_only', 'raw_data', 'geneve_start', 'inner_start', 'inner_protocol',
+                 '_outter_ipv4', '_outter_udp', '_geneve', '_inner_ipv4', '_inner_l4', '_aws_options')
+
+    def __init__(self, logger, raw_geneve_packet, flow_tracker, udp_only, lazy=config.LAZY_PARSING,
+                 validate_checksum=config.VALIDATE_CHECKSUM, metrics=None, policy=None, analytics=None):
         self.udp_only = udp_only
         self.raw_data = raw_geneve_packet
+        self._outter_ipv4 = None
+        self._outter_udp = None
+        self._geneve = None
+        self._inner_ipv4 = None
+        self._inner_l4 = None
+        self._aws_options = None
 
         # if the data is coming from a raw socket (which should be the case), let's unpack the outter IP/UDP headers
-        if not udp_only:
-            self.outter_ipv4 = ipv4.IPv4(self.raw_data)
-            self.outter_udp = udp.UDP(self.raw_data, self.outter_ipv4.header_end_byte)
+        routed_fields = None
+        if udp_only:
+            self.geneve_start = 0
+            geneve_options_length = self.raw_data[0] & 0x3F
+        elif lazy and self.raw_data[0] == 0x45 and len(self.raw_data) >= OUTTER_HEADERS_LENGTH:
+            # IPv4 header without options : the outter IPv4, UDP and Geneve fixed headers are decoded at once
+            unpacked_struct = OUTTER_HEADERS.unpack_from(self.raw_data)
+            # an AF_PACKET socket receives all the IP packets, not only the UDP ones
+            if not unpacked_struct[6] == 17 or not unpacked_struct[11] == config.GENEVE_PORT:
+                raise UnmatchedGenevePort
+            if validate_checksum and ipv4.header_checksum(self.raw_data):
+                raise InvalidChecksum
+            # TTL, protocol, checksum, source address, destination address
+            routed_fields = unpacked_struct[5:10]
+            self.geneve_start = 28
+            geneve_options_length = unpacked_struct[14] & 0x3F
+        else:
+            # an AF_PACKET socket receives all the IP packets, not only the UDP ones
+            if not self.outter_ipv4.protocol == 17:
+                raise UnmatchedGenevePort
             if not self.outter_udp.dst_port == config.GENEVE_PORT:
                 raise UnmatchedGenevePort
+            if validate_checksum and ipv4.header_checksum(self.raw_data, 0, self.outter_ipv4.header_length_bytes):
+                raise InvalidChecksum
+            self.geneve_start = self.outter_ipv4.header_length_bytes + 8
+            geneve_options_length = self.geneve.options_length
 
-        self.geneve = geneve.Geneve(self.raw_data, 0 if udp_only else self.outter_ipv4.header_length_bytes + 8)
-        self.inner_ipv4 = ipv4.IPv4(self.raw_data, self.geneve.header_end_byte)
-        if self.inner_ipv4.protocol == 17:
-            self.inner_l4 = udp.UDP(self.raw_data, self.inner_ipv4.header_end_byte, self.inner_ipv4.payload_length)
-        elif self.inner_ipv4.protocol == 6:
-            self.inner_l4 = tcp.TCP(self.raw_data, self.inner_ipv4.header_end_byte, self.inner_ipv4.payload_length)
-        elif self.inner_ipv4.protocol == 1:
-            self.inner_l4 = icmp.ICMP(self.raw_data, self.inner_ipv4.header_end_byte, self.inner_ipv4.payload_length)
-        else:
-            logger.error(f"GENEVE - Unknown inner packet type ({self.inner_ipv4.protocol})")
-            self.inner_l4 = None
+        self.inner_start = self.geneve_start + 8 + geneve_options_length * 4
+        self.inner_protocol = self.raw_data[self.inner_start + 9]
+        if self.inner_protocol not in (1, 6, 17):
+            logger.error(f"GENEVE - Unknown inner packet type ({self.inner_protocol})")
+            if metrics:
+                metrics.unknown_inner_protocol += 1
 
-        if not self.udp_only:
-            logger.debug(f"GENEVE - {self.outter_ipv4} {self.outter_udp} {self.geneve} {self.inner_ipv4} {self.inner_l4}")
-        else:
-            logger.debug(
-                f"GENEVE - {self.geneve} {self.inner_ipv4} {self.inner_l4}")
+        if not lazy:
+            self.parse_all()
 
-        if flow_tracker and self.inner_ipv4.protocol in [1, 6, 17]:
-            flow_tracker.update_flow(self)
+        if logger.isEnabledFor(logging.DEBUG):
+            if not self.udp_only:
+                logger.debug(
+                    f"GENEVE - {self.outter_ipv4} {self.outter_udp} {self.geneve} {self.inner_ipv4} {self.inner_l4}")
+            else:
+                logger.debug(
+                    f"GENEVE - {self.geneve} {self.inner_ipv4} {self.inner_l4}")
+
+        if policy is not None and not policy.allows(self, flow_tracker):
+            raise DroppedByPolicy
+
+        if flow_tracker and self.inner_protocol in (1, 6, 17) and not flow_tracker.update_flow(self):
+            raise NonSynBlocked
+
+        if analytics is not None:
+            analytics.add(self)
 
         # if raw data comes from the raw socket, we need to swap the IP addresses and decrease the TTL as the kernel
-        # will not do that for us
+        # will not do that for us. The outter IP header is patched in place, so the payload is never copied, and its
+        # checksum is updated incrementally
         if not udp_only:
-            self.outter_ipv4.swap_addresses()
-            self.outter_ipv4.ttl -= 1
+            if routed_fields and self._outter_ipv4 is None:
+                ttl, protocol, checksum, src_addr, dst_addr = routed_fields
+                ipv4.IPV4_ROUTED_FIELDS.pack_into(self.raw_data, ipv4.IPV4_ROUTED_FIELDS_OFFSET,
+                                                  ttl - 1, protocol, ipv4.ttl_decrement_checksum(checksum),
+                                                  dst_addr, src_addr)
+            else:
+                self.outter_ipv4.swap_addresses()
+                self.outter_ipv4.decrement_ttl()
+                self.outter_ipv4.patch_into(self.raw_data)
+
+    def parse_all(self):
+        """
+        Builds all the header objects
+        :return:
+        """
+        if not self.udp_only:
+            _ = self.outter_ipv4, self.outter_udp
+        _ = self.geneve, self.inner_ipv4, self.inner_l4
+
+    @property
+    def outter_ipv4(self):
+        if self._outter_ipv4 is None:
+            self._outter_ipv4 = ipv4.IPv4(self.raw_data)
+        return self._outter_ipv4
+
+    @property
+    def outter_udp(self):
+        if self._outter_udp is None:
+            self._outter_udp = udp.UDP(self.raw_data, self.outter_ipv4.header_end_byte)
+        return self._outter_udp
+
+    @property
+    def geneve(self):
+        if self._geneve is None:
+            self._geneve = geneve.Geneve(self.raw_data, self.geneve_start)
+        return self._geneve
+
+    @property
+    def inner_ipv4(self):
+        if self._inner_ipv4 is None:
+            self._inner_ipv4 = ipv4.IPv4(self.raw_data, self.inner_start)
+        return self._inner_ipv4
+
+    @property
+    def inner_l4(self):
+        if self._inner_l4 is None:
+            if self.inner_protocol == 17:
+                self._inner_l4 = udp.UDP(self.raw_data, self.inner_ipv4.header_end_byte,
+                                         self.inner_ipv4.payload_length)
+            elif self.inner_protocol == 6:
+                self._inner_l4 = tcp.TCP(self.raw_data, self.inner_ipv4.header_end_byte,
+                                         self.inner_ipv4.payload_length)
+            elif self.inner_protocol == 1:
+                self._inner_l4 = icmp.ICMP(self.raw_data, self.inner_ipv4.header_end_byte,
+                                           self.inner_ipv4.payload_length)
+        return self._inner_l4
+
+    @property
+    def inner_addresses(self):
+        """
+        Inner IPv4 source and destination addresses, read directly from the raw packet
+        :return: (tuple) (source address, destination address) integer values
+        """
+        return IPV4_ADDRESSES.unpack_from(self.raw_data, self.inner_start + IPV4_ADDRESSES_OFFSET)
+
+    @property
+    def aws_options(self):
+        """
+        AWS GWLB options values, extracted from the raw Geneve header
+        :return: (tuple) (flow cookie, GWLB endpoint ID, attachment ID) integer values. None for a missing option
+        """
+        if self._aws_options is None:
+            self._aws_options = geneve.extract_aws_options(self.raw_data, self.geneve_start)
+        return self._aws_options
+
+    @property
+    def flow_cookie(self):
+        return self.aws_options[0]
 
     @property
     def resp(self):
-        # if we need to send back the data to a raw buffer, send back the repacked (updated) IP header, and then
-        # the rest of the raw data untouched
-        if not self.udp_only:
-            return b''.join([
-                self.outter_ipv4.repack(),
-                self.raw_data[self.outter_ipv4.header_length_bytes::]
-            ])
-        # else (if it comes from a bind UDP socket), let's just send back the full raw data untouched
+        # the raw data already contains the updated IP header if it comes from the raw socket, and has to be sent back
+        # untouched if it comes from a bind UDP socket
         return self.raw_data
@@ -0,0 +1,108 @@
+import time
+from array import array
+import config
+from pcap import PcapReader, PcapWriter
+
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentiles(values, points=LATENCY_PERCENTILES):
+    """
+    :param values: (iterable) Measures
+    :param points: (tuple) Percentiles to compute
+    :return: (dict) Value by percentile, including the maximum (100). Empty if there is no value
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return dict()
+    result = {p: ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)] for p in points}
+    result[100] = ordered[-1]
+    return result
+
+
+class ReplayStats:
+    """
+    Counters and per-packet processing times of a capture replay
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.loops = 0
+        self.packets = 0
+        self.bytes = 0
+        self.forwarded = 0
+        self.skipped = 0
+        self.too_large = 0
+        self.elapsed_ns = 0
+        # processing time of each packet, in nanoseconds
+        self.latencies = array('Q')
+
+    def report(self):
+        """
+        :return: (list) Report lines
+        """
+        seconds = self.elapsed_ns / 1e9
+        lines = [
+            f"REPLAY - {self.packets} packets ({self.bytes} bytes) from {self.path} in {seconds:.3f}s "
+            f"({self.loops} loop{'s' if self.loops > 1 else ''})",
+            f"REPLAY - Forwarded {self.forwarded} - Dropped {self.packets - self.forwarded} (not Geneve, invalid, "
+            f"dropped by the policy or by the flow tracker) - Skipped {self.skipped} (not IPv4, or truncated by the "
+            f"capture) - Skipped {self.too_large} (larger than config.BUFFER_SIZE)",
+        ]
+        if seconds:
+            lines.append(f"REPLAY - Throughput : {self.packets / seconds:.0f} pps - "
+                         f"{self.bytes * 8 / seconds / 1e6:.1f} Mbps")
+        if self.latencies:
+            lines.append("REPLAY - Processing time : " + " - ".join(
+                f"{'max' if p == 100 else f'p{p:g}'} {value / 1000:.2f}us"
+                for p, value in percentiles(self.latencies).items()))
+        return lines
+
+
+def replay(path, handler, output=None, loops=1):
+    """
+    Runs the IPv4 packets of a capture file through handler, as fast as possible
+
+    Each packet is copied from the (memory-mapped) capture into a receive buffer, as recvfrom_into would do, and
+    handed to handler, which may patch it in place. The processing time of a packet covers the copy, the handler call
+    and the response writing.
+    :param path: (str) pcap or pcapng file
+    :param handler: (callable) Takes a packet (memoryview), returns the response to send back, or None to drop it
+    :param output: (str) pcap file the responses are written to. They are discarded if None
+    :param loops: (int) Number of times the capture is replayed
+    :return: (ReplayStats)
+    """
+    stats = ReplayStats(path)
+    buffer = memoryview(bytearray(config.BUFFER_SIZE))
+    writer = PcapWriter(output) if output else None
+    latencies = stats.latencies
+    perf_counter_ns = time.perf_counter_ns
+
+    try:
+        start = perf_counter_ns()
+        for _ in range(loops):
+            with PcapReader(path) as reader:
+                for timestamp, packet in reader:
+                    length = len(packet)
+                    if length > len(buffer):
+                        stats.too_large += 1
+                        continue
+                    packet_start = perf_counter_ns()
+                    buffer[:length] = packet
+                    response = handler(buffer[:length])
+                    if response is not None:
+                        stats.forwarded += 1
+                        if writer:
+                            writer.write(response, timestamp)
+                    latencies.append(perf_counter_ns() - packet_start)
+                    stats.bytes += length
+                packet = None
+            stats.skipped += reader.skipped
+            stats.loops += 1
+        stats.elapsed_ns = perf_counter_ns() - start
+    finally:
+        if writer:
+            writer.close()
+
+    stats.packets = len(latencies)
+    return stats
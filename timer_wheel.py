@@ -0,0 +1,64 @@
+import config
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel, used to expire the tracked flows
+
+    Time is divided in ticks of config.TIMER_WHEEL_RESOLUTION seconds. A key scheduled for a deadline is stored in the
+    bucket of the deadline tick, so advancing the wheel only visits the buckets of the elapsed ticks : the cost is
+    proportional to the number of due keys, not to the number of scheduled ones.
+    A bucket only ever holds the keys of a single tick : deadlines further than a full turn of the wheel are scheduled
+    on the last tick of the turn, and the owner is expected to schedule them again when they come out.
+
+    Keys can't be removed from the wheel : the owner has to check, when a key is returned as due, if it is still
+    relevant (deleted entry, or deadline pushed back in the meantime), and schedule it again if needed.
+    The wheel is not thread-safe.
+    """
+
+    def __init__(self, now, resolution=config.TIMER_WHEEL_RESOLUTION, slots_count=config.TIMER_WHEEL_SLOTS):
+        """
+        :param now: (float) Current time (time.monotonic() value)
+        """
+        self.resolution = resolution
+        self.slots_count = slots_count
+        self.slots = [list() for _ in range(slots_count)]
+        # last tick for which the due keys have been returned
+        self.current_tick = self.tick(now)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def tick(self, timestamp):
+        return int(timestamp // self.resolution)
+
+    def schedule(self, key, deadline):
+        """
+        Schedules a key
+        :param deadline: (float) time.monotonic() value after which the key is due
+        :return: (int) The tick the key has been scheduled for
+        """
+        # a deadline in the past is due on the next advance
+        tick = min(max(self.tick(deadline) + 1, self.current_tick + 1), self.current_tick + self.slots_count)
+        self.slots[tick % self.slots_count].append(key)
+        self.count += 1
+        return tick
+
+    def advance(self, now):
+        """
+        Moves the wheel up to the current time, and returns the keys which became due
+        :param now: (float) Current time (time.monotonic() value)
+        :return: (list) List of (tick, keys list) tuples
+        """
+        due = list()
+        now_tick = self.tick(now)
+        # after a long pause, a full turn empties all the buckets
+        for tick in range(self.current_tick + 1, min(now_tick, self.current_tick + self.slots_count) + 1):
+            slot_index = tick % self.slots_count
+            if self.slots[slot_index]:
+                due.append((tick, self.slots[slot_index]))
+                self.count -= len(self.slots[slot_index])
+                self.slots[slot_index] = list()
+        self.current_tick = now_tick
+        return due
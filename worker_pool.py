@@ -0,0 +1,103 @@
+import os
+import signal
+import time
+import config
+
+
+class WorkerPool:
+    """
+    Supervises a pool of forked worker processes
+
+    Each worker runs target(worker_id) in its own process, and exits when it returns. The supervisor has to call
+    reap() periodically : dead workers are collected and restarted (no more than once every
+    config.WORKER_RESTART_DELAY seconds for a given worker ID, to avoid a fork loop when a worker can't start).
+    """
+
+    def __init__(self, logger, workers_count, target):
+        self.logger = logger
+        self.workers_count = workers_count
+        self.target = target
+        # worker ID -> PID of the running worker process
+        self.workers = dict()
+        # worker ID -> time of the last (re)start
+        self.started_at = dict()
+        self.stopping = False
+
+    def start(self):
+        for worker_id in range(self.workers_count):
+            self.spawn(worker_id)
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            # child process : run the worker, and never return to the caller (which is the supervisor code)
+            exit_code = 1
+            try:
+                exit_code = self.target(worker_id) or 0
+            except Exception as e:
+                self.logger.critical(f"WORKER {worker_id} - Unexpected error : {e}")
+            finally:
+                os._exit(exit_code)
+        self.workers[worker_id] = pid
+        self.started_at[worker_id] = time.monotonic()
+        self.logger.info(f"WORKER {worker_id} - Started with PID {pid}")
+
+    def reap(self):
+        """
+        Collects the dead workers without blocking, and restarts them
+        :return:
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            for worker_id, worker_pid in list(self.workers.items()):
+                if worker_pid == pid:
+                    del self.workers[worker_id]
+                    if not self.stopping:
+                        self.logger.error(f"WORKER {worker_id} - Process {pid} died (status {status})")
+
+        if self.stopping:
+            return
+
+        for worker_id in range(self.workers_count):
+            if worker_id not in self.workers \
+                    and time.monotonic() - self.started_at.get(worker_id, 0) >= config.WORKER_RESTART_DELAY:
+                self.logger.warning(f"WORKER {worker_id} - Restarting")
+                self.spawn(worker_id)
+
+    def send_signal(self, signum):
+        """
+        Sends a signal to all the running workers
+        :return:
+        """
+        for pid in self.workers.values():
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                # died since the last reap
+                pass
+
+    @property
+    def all_alive(self):
+        return len(self.workers) == self.workers_count
+
+    def stop(self, timeout=5):
+        """
+        Sends SIGTERM to all the workers, waits for them to exit, and kills the remaining ones after timeout seconds
+        :return:
+        """
+        self.stopping = True
+        for pid in self.workers.values():
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for worker_id, pid in self.workers.items():
+            self.logger.error(f"WORKER {worker_id} - Process {pid} did not exit, killing it")
+            os.kill(pid, signal.SIGKILL)
+        self.workers.clear()